@@ -0,0 +1,507 @@
+"""Offline load test for the bot.
+
+Drives the real Application from main.build_application() with synthetic
+Telegram updates. The Telegram Bot API and the AI service are replaced by
+in-process stubs with configurable latency, so no network access or tokens are
+needed. Every simulated user goes through the full flow: /start, profile entry,
+calorie calculation, menu generation and menu paging.
+
+    python benchmark.py --users 200 --ai-latency 2.0
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import httpx
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+import main
+from webhook import WebhookServer
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Nutrition Bot", "username": "nutrition_bench_bot"}
+
+
+class StubBotRequest(BaseRequest):
+    """Answers Bot API calls in-process, the way Telegram would, after an optional delay."""
+
+    def __init__(self, latency: float = 0.0, flood_limit: int = 0):
+        self.latency = latency
+        self.flood_limit = flood_limit
+        self.calls = 0
+        self.flood_errors = 0
+        self._recent = {}
+        self._next_message_id = {}
+        self.last_message_id = {}
+        self.menu_shown = {}
+        self.reactions = {}
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, chat_id: int, message_id: int, text: str) -> dict:
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": text or "",
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls += 1
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        chat_id = int(params.get("chat_id", 0) or 0)
+
+        if self.flood_limit and chat_id and endpoint.startswith(("send", "edit")):
+            # Like Telegram's flood control: too many messages to one chat within a second get a 429
+            now = time.monotonic()
+            recent = [stamp for stamp in self._recent.get(chat_id, []) if now - stamp < 1.0]
+            if len(recent) >= self.flood_limit:
+                self.flood_errors += 1
+                return 429, json.dumps({
+                    "ok": False, "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }).encode("utf-8")
+            recent.append(now)
+            self._recent[chat_id] = recent
+
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint == "sendMessage":
+            message_id = self._next_message_id.get(chat_id, 1000) + 1
+            self._next_message_id[chat_id] = message_id
+            self.last_message_id[chat_id] = message_id
+            result = self._message(chat_id, message_id, params.get("text"))
+        elif endpoint == "editMessageText":
+            message_id = int(params.get("message_id") or self.last_message_id.get(chat_id, 1000))
+            result = self._message(chat_id, message_id, params.get("text"))
+        else:
+            # answerCallbackQuery, sendChatAction, deleteWebhook, ...
+            result = True
+
+        for key in (("chat", chat_id), ("callback", params.get("callback_query_id"))):
+            if key in self.reactions:
+                self.reactions[key].set()
+
+        markup = params.get("reply_markup")
+        if chat_id in self.menu_shown and markup and "📍 Day" in json.dumps(markup, ensure_ascii=False):
+            self.menu_shown[chat_id].set()
+
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+class StubInferenceClient:
+    """Stands in for AsyncInferenceClient and returns a canned 7-day menu after a delay.
+
+    Answers use the compact or the verbose format, whichever the system prompt
+    asks for. With `broken_days`, that fraction of a menu's days comes back
+    without a lunch, so the bot has to repair them.
+    """
+
+    def __init__(self, latency: float = 2.0, jitter: float = 0.25, chunks: int = 60, broken_days: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunks = chunks
+        self.broken_days = broken_days
+        self.calls = 0
+
+    def _delay(self) -> float:
+        return max(0.0, random.uniform(self.latency * (1 - self.jitter), self.latency * (1 + self.jitter)))
+
+    @staticmethod
+    def _day(day: str, compact: bool = False) -> dict:
+        if compact:
+            return {
+                "d": day, "k": 2100, "p": 130, "c": 220, "f": 70,
+                "b": "Oatmeal with berries and Greek yogurt (450 kcal)",
+                "s1": "Apple with 20g almonds (200 kcal)",
+                "l": "Grilled chicken, quinoa and roasted vegetables (650 kcal)",
+                "s2": "Cottage cheese with cucumber (180 kcal)",
+                "n": "Baked salmon with sweet potato and salad (620 kcal)",
+            }
+        return {
+            "day": day,
+            "calories": 2100,
+            "macronutrients": "Protein 130g, Carbs 220g, Fat 70g",
+            "breakfast": "Oatmeal with berries and Greek yogurt (450 kcal)",
+            "snack1": "Apple with 20g almonds (200 kcal)",
+            "lunch": "Grilled chicken, quinoa and roasted vegetables (650 kcal)",
+            "snack2": "Cottage cheese with cucumber (180 kcal)",
+            "dinner": "Baked salmon with sweet potato and salad (620 kcal)",
+        }
+
+    def _menu_text(self, compact: bool = False, broken_days: float = 0.0) -> str:
+        days = []
+        for day in ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]:
+            day = self._day(day, compact)
+            if random.random() < broken_days:
+                day.pop("l" if compact else "lunch")
+            days.append(day)
+        return json.dumps({"m" if compact else "menu": days})
+
+    def _answer(self, messages: list) -> str:
+        """A canned answer in the shape the system prompt asks for: a whole menu, one day or one meal."""
+        prompt = messages[0]["content"]
+        if prompt in (main.MENU_DAY_SYSTEM_PROMPT, main.MENU_DAY_COMPACT_SYSTEM_PROMPT):
+            day = messages[-1]["content"].rsplit("Create a new plan for ", 1)[-1].rstrip(".")
+            return json.dumps(self._day(day, prompt == main.MENU_DAY_COMPACT_SYSTEM_PROMPT))
+        if prompt == main.MENU_MEAL_SYSTEM_PROMPT:
+            meal = messages[-1]["content"].rsplit("Meal to replace: ", 1)[-1].strip()
+            return json.dumps({meal: "Turkey chili with beans and brown rice (610 kcal)"})
+        return self._menu_text(prompt == main.MENU_COMPACT_SYSTEM_PROMPT, self.broken_days)
+
+    def _scaled_delay(self, answer: str) -> float:
+        # Generation time grows with the output, so a single day or meal is much quicker than a
+        # menu, and a compact menu quicker than a verbose one
+        return self._delay() * max(0.1, len(answer) / len(self._menu_text()))
+
+    async def complete(self, messages, model, **params):
+        self.calls += 1
+        answer = self._answer(messages)
+        await asyncio.sleep(self._scaled_delay(answer))
+        return {
+            "choices": [{"message": {"role": "assistant", "content": answer}}],
+            "usage": {"prompt_tokens": 180, "completion_tokens": 1400},
+        }
+
+    async def stream(self, messages, model, **params):
+        self.calls += 1
+        text = self._answer(messages)
+        size = max(1, len(text) // self.chunks)
+        delay = self._scaled_delay(text) / self.chunks
+        for start in range(0, len(text), size):
+            await asyncio.sleep(delay)
+            yield text[start:start + size]
+
+    async def aclose(self):
+        pass
+
+
+class FaultInjectingClient:
+    """Wraps an inference client and makes a share of its calls fail or stall, like a degraded AI service.
+
+    `error_rate` of the calls fail with a 503 answer or a read timeout, and
+    `slow_rate` of them take `slow_seconds` longer to start answering.
+    """
+
+    def __init__(self, client, error_rate: float = 0.0, slow_rate: float = 0.0, slow_seconds: float = 5.0):
+        self.client = client
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.faults = 0
+
+    async def _inject(self):
+        if random.random() < self.slow_rate:
+            await asyncio.sleep(self.slow_seconds)
+        if random.random() < self.error_rate:
+            self.faults += 1
+            request = httpx.Request("POST", "http://stub/chat/completions")
+            if random.random() < 0.5:
+                raise httpx.ReadTimeout("injected timeout", request=request)
+            raise httpx.HTTPStatusError(
+                "injected 503", request=request, response=httpx.Response(503, request=request)
+            )
+
+    async def complete(self, messages, model, **params):
+        await self._inject()
+        return await self.client.complete(messages, model, **params)
+
+    async def stream(self, messages, model, **params):
+        await self._inject()
+        async for chunk in self.client.stream(messages, model, **params):
+            yield chunk
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class Simulation:
+    """Runs simulated users against the application and records per-step latencies.
+
+    By default updates are fed straight into the application's update processor
+    and a step ends when it has been fully handled. With `webhook_url` set,
+    updates are POSTed to the webhook server instead, like Telegram would, and a
+    step ends at the bot's first reaction (a reply or callback answer).
+    """
+
+    def __init__(self, application: Application, bot_request: StubBotRequest,
+                 webhook_url: str = None, secret_token: str = None):
+        self.application = application
+        self.bot_request = bot_request
+        self.webhook_url = webhook_url
+        self.http = httpx.AsyncClient(headers={"X-Telegram-Bot-Api-Secret-Token": secret_token or ""})
+        self.latencies = {}
+        self.updates = 0
+        self.failures = 0
+        self._update_id = 0
+
+    def _user(self, chat_id: int) -> dict:
+        return {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"}
+
+    def _message_update(self, chat_id: int, text: str) -> dict:
+        self._update_id += 1
+        message = {
+            "message_id": self._update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": self._user(chat_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self._update_id, "message": message}
+
+    def _callback_update(self, chat_id: int, data: str) -> dict:
+        self._update_id += 1
+        message_id = self.bot_request.last_message_id.get(chat_id, 1000)
+        callback_query = {
+            "id": str(self._update_id),
+            "from": self._user(chat_id),
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": self.bot_request._message(chat_id, message_id, "…"),
+        }
+        return {"update_id": self._update_id, "callback_query": callback_query}
+
+    async def _deliver(self, chat_id: int, data: dict):
+        """Delivers one update either directly or through the webhook server."""
+        if not self.webhook_url:
+            update = Update.de_json(data, self.application.bot)
+            await self.application.update_processor.process_update(
+                update, self.application.process_update(update)
+            )
+            return
+
+        if "callback_query" in data:
+            key = ("callback", data["callback_query"]["id"])
+        else:
+            key = ("chat", chat_id)
+        reaction = self.bot_request.reactions[key] = asyncio.Event()
+        try:
+            response = await self.http.post(self.webhook_url, json=data)
+            response.raise_for_status()
+            await asyncio.wait_for(reaction.wait(), timeout=60)
+        finally:
+            self.bot_request.reactions.pop(key, None)
+
+    async def _process(self, step: str, data: dict, wait_for_menu: bool = False):
+        """Delivers one update and times it."""
+        chat_id = (data.get("message") or data.get("callback_query")["message"])["chat"]["id"]
+        if wait_for_menu:
+            self.bot_request.menu_shown[chat_id] = asyncio.Event()
+        started = time.perf_counter()
+        try:
+            await self._deliver(chat_id, data)
+            if wait_for_menu:
+                # Generation runs in a non-blocking handler; the step ends when day 1 is on screen
+                await asyncio.wait_for(self.bot_request.menu_shown[chat_id].wait(), timeout=300)
+        except Exception as e:
+            self.failures += 1
+            print(f"Step {step} failed for chat {chat_id}: {e!r}", file=sys.stderr)
+        finally:
+            self.bot_request.menu_shown.pop(chat_id, None)
+        self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+        self.updates += 1
+
+    async def run_user(self, chat_id: int, weight: int, think_time: float):
+        """Walks one user through the full conversation."""
+        steps = [
+            ("start", self._message_update, "/start", False),
+            ("fill_in", self._callback_update, "fill_in", False),
+            ("sex", self._callback_update, "sex_male" if chat_id % 2 else "sex_female", False),
+            ("weight", self._message_update, str(weight), False),
+            ("height", self._message_update, "175", False),
+            ("age", self._message_update, "30", False),
+            ("activity", self._callback_update, "activity_medium", False),
+            ("goal", self._callback_update, "goal_lost_weight", False),
+            ("calculate_calories", self._callback_update, "calculate_calories", False),
+            ("generate_menu", self._callback_update, "generate_menu_confirmed", True),
+            ("menu_next", self._callback_update, "menu_page:1", False),
+            ("menu_next", self._callback_update, "menu_page:2", False),
+            ("menu_prev", self._callback_update, "menu_page:1", False),
+            ("regen_day", self._callback_update, "menu_regen_day:1", True),
+            ("swap_picker", self._callback_update, "menu_swap:1:1", False),
+            ("swap_meal", self._callback_update, "menu_swap_meal:1:dinner", True),
+            ("last_plan", self._callback_update, "last_plan", False),
+        ]
+        for step, make_update, payload, wait_for_menu in steps:
+            if step == "regen_day":
+                # Days can only be changed once the whole menu has arrived
+                while chat_id in main.generating_chats:
+                    await asyncio.sleep(0.05)
+            await self._process(step, make_update(chat_id, payload), wait_for_menu)
+            if think_time:
+                await asyncio.sleep(random.uniform(0, think_time))
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def print_report(simulation: Simulation, elapsed: float, ai_calls: int, bot_calls: int):
+    print(f"\nUpdates processed: {simulation.updates} in {elapsed:.2f} s "
+          f"({simulation.updates / elapsed:.1f} updates/sec), failures: {simulation.failures}")
+    print(f"AI calls: {ai_calls}, Bot API calls: {bot_calls}, peak RSS: {peak_rss_mb():.1f} MB\n")
+    print(f"{'step':<20}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for step, values in simulation.latencies.items():
+        print(
+            f"{step:<20}{len(values):>7}"
+            f"{percentile(values, 0.50) * 1000:>10.1f}"
+            f"{percentile(values, 0.95) * 1000:>10.1f}"
+            f"{percentile(values, 0.99) * 1000:>10.1f}"
+            f"{max(values) * 1000:>10.1f}"
+        )
+
+
+async def run_benchmark(args: argparse.Namespace):
+    workdir = tempfile.mkdtemp(prefix="nutrition-bench-")
+    main.CSV_FILE_NAME = os.path.join(workdir, "user_data.csv")
+    main.SQLITE_FILE_NAME = os.path.join(workdir, "user_data.db")
+    main.MENU_STORE_FILE = os.path.join(workdir, "menus.db")
+    main.UI_DELAY_SECONDS = args.ui_delay
+    main.SEND_RATE_LIMIT = args.rate_limit
+    main.MENU_ENGINE = args.menu_engine
+    main.MENU_COMPACT_OUTPUT = args.menu_format == "compact"
+    stubs, faults = {}, {}
+    for entry in args.models.split(","):
+        # "model" or "model:latency factor"
+        name, _, factor = entry.strip().partition(":")
+        stubs[name] = StubInferenceClient(
+            latency=args.ai_latency * float(factor or 1), jitter=args.ai_jitter, broken_days=args.ai_broken_days
+        )
+        error_rate = 1.0 if name == args.failing_model else args.ai_error_rate
+        faults[name] = FaultInjectingClient(stubs[name], error_rate, args.ai_slow_rate, args.ai_slow_seconds)
+    main.INFERENCE_HEDGE_PERCENTILE = args.hedge_percentile
+    main.INFERENCE_LOW_PRIORITY_MODELS = {name for name in args.low_priority_models.split(",") if name}
+    main.client = main.build_inference_pool(faults)
+    main.MENU_CACHE_MODELS = ",".join(sorted(faults))
+    main.initialize_csv()
+
+    bot_request = StubBotRequest(latency=args.bot_latency, flood_limit=args.flood_limit)
+    builder = (
+        Application.builder()
+        .token("123456:BENCHMARK")
+        .request(bot_request)
+        .get_updates_request(StubBotRequest())
+    )
+    application = main.build_application(builder)
+
+    await application.initialize()
+    await main.on_startup(application)
+    await application.start()
+
+    server = None
+    if args.webhook:
+        secret_token = "benchmark-secret"
+        server = WebhookServer(application, "127.0.0.1", 0, "/telegram", secret_token)
+        await server.start()
+        simulation = Simulation(
+            application, bot_request,
+            webhook_url=f"http://127.0.0.1:{server.port}/telegram", secret_token=secret_token,
+        )
+    else:
+        simulation = Simulation(application, bot_request)
+
+    print(f"Simulating {args.users} users (AI latency {args.ai_latency}s, "
+          f"Bot API latency {args.bot_latency * 1000:.0f}ms), data in {workdir}")
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        simulation.run_user(
+            chat_id=100000 + index,
+            weight=70 if args.identical_profiles else 50 + index % 80,
+            think_time=args.think_time,
+        )
+        for index in range(args.users)
+    ])
+    elapsed = time.perf_counter() - started
+    sessions = main.session_janitor.sweep(application)
+
+    await simulation.http.aclose()
+    if server is not None:
+        await server.stop()
+    await application.stop()
+    await main.on_shutdown(application)
+    await application.shutdown()
+
+    print_report(simulation, elapsed, sum(stub.calls for stub in stubs.values()), bot_request.calls)
+    if len(stubs) > 1 or args.ai_error_rate or args.ai_slow_rate or args.hedge_percentile:
+        print(f"AI faults injected: {sum(fault.faults for fault in faults.values())}")
+        for name, stats in main.client.stats().items():
+            print(f"  {name}: {stats}")
+    print(f"Sessions in memory: {sessions['sessions']}, {sessions['bytes_per_session']} bytes each on average")
+    if args.flood_limit:
+        print(f"Bot API calls refused with 429: {bot_request.flood_errors}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test for the nutrition bot")
+    parser.add_argument("--users", type=int, default=50, help="Number of concurrent simulated users")
+    parser.add_argument("--ai-latency", type=float, default=2.0, help="Mean seconds per AI generation")
+    parser.add_argument("--ai-jitter", type=float, default=0.25, help="Relative +/- jitter of AI latency")
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="Seconds per Bot API call")
+    parser.add_argument("--ui-delay", type=float, default=0.0,
+                        help="Value for UI_DELAY_SECONDS (the bot's cosmetic pauses)")
+    parser.add_argument("--think-time", type=float, default=0.0,
+                        help="Max random pause between a user's steps, in seconds")
+    parser.add_argument("--identical-profiles", action="store_true",
+                        help="Give every user the same profile to exercise caching and coalescing")
+    parser.add_argument("--webhook", action="store_true",
+                        help="POST updates to the embedded webhook server instead of feeding them directly")
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="Throttle outgoing messages like the bot does in production (SEND_RATE_LIMIT)")
+    parser.add_argument("--flood-limit", type=int, default=0,
+                        help="Answer 429 once a chat gets more than this many messages per second")
+    parser.add_argument("--menu-engine", choices=("ai", "local"), default="ai",
+                        help="Value for MENU_ENGINE: the stub AI model or the local recipe planner")
+    parser.add_argument("--menu-format", choices=("compact", "verbose"), default="compact",
+                        help="Output format the AI is asked to answer menus in")
+    parser.add_argument("--ai-broken-days", type=float, default=0.0,
+                        help="Fraction of menu days the simulated AI answers broken")
+    parser.add_argument("--ai-error-rate", type=float, default=0.0,
+                        help="Fraction of AI calls that fail with a 503 or a timeout")
+    parser.add_argument("--ai-slow-rate", type=float, default=0.0,
+                        help="Fraction of AI calls that stall before answering")
+    parser.add_argument("--ai-slow-seconds", type=float, default=5.0, help="How long a stalled AI call stalls")
+    parser.add_argument("--models", default=main.MENU_MODEL,
+                        help="Simulated AI models, comma-separated, each optionally with a latency factor (name:1.5)")
+    parser.add_argument("--low-priority-models", default="",
+                        help="Value for INFERENCE_LOW_PRIORITY_MODELS: models that get edits and repairs first")
+    parser.add_argument("--failing-model", default="", help="A model whose every call fails")
+    parser.add_argument("--hedge-percentile", type=float, default=0.0,
+                        help="Value for INFERENCE_HEDGE_PERCENTILE (0 disables hedged requests)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_benchmark(parse_args()))
@@ -0,0 +1,48 @@
+# Define activity multipliers for calorie calculation
+ACTIVITY_MULTIPLIERS = {
+    "minimum": 1.2,
+    "low": 1.375,
+    "medium": 1.55,
+    "hard": 1.725,
+    "extremely high": 1.9
+}
+DEFAULT_ACTIVITY_MULTIPLIER = 1.2
+
+# Sex-specific constant of the Mifflin-St Jeor equation
+SEX_OFFSETS = {"man": 5, "woman": -161}
+
+
+def calculate_bmr(sex: str, weight: float, height: float, age: int) -> float:
+    """Basal metabolic rate from the Mifflin-St Jeor equation."""
+    return (10 * weight) + (6.25 * height) - (5 * age) + SEX_OFFSETS.get(sex, SEX_OFFSETS["woman"])
+
+
+def calculate_daily_calories(profile: dict) -> tuple:
+    """Returns (BMR, activity multiplier, daily calories) for a profile."""
+    bmr = calculate_bmr(profile['sex'], profile['weight'], profile['height'], profile['age'])
+    multiplier = ACTIVITY_MULTIPLIERS.get(profile['activity'], DEFAULT_ACTIVITY_MULTIPLIER)
+    return bmr, multiplier, bmr * multiplier
+
+
+def calculate_daily_calories_batch(sex, weight, height, age, activity):
+    """Vectorized `calculate_daily_calories` over columns of many profiles.
+
+    Takes sequences (or arrays) of equal length and returns a NumPy int64 array of
+    rounded daily calories, identical to `int(round(...))` of the scalar version.
+    """
+    import numpy as np  # Only needed for bulk jobs, not to run the bot
+
+    sex = np.asarray(sex)
+    bmr = (
+        10 * np.asarray(weight, dtype=np.float64)
+        + 6.25 * np.asarray(height, dtype=np.float64)
+        - 5 * np.asarray(age, dtype=np.float64)
+        + np.where(sex == "man", SEX_OFFSETS["man"], SEX_OFFSETS["woman"])
+    )
+    # Map the few distinct activity names once instead of looking up every row
+    names, inverse = np.unique(np.asarray(activity), return_inverse=True)
+    multipliers = np.array(
+        [ACTIVITY_MULTIPLIERS.get(name, DEFAULT_ACTIVITY_MULTIPLIER) for name in names.tolist()],
+        dtype=np.float64,
+    )
+    return np.rint(bmr * multipliers[inverse]).astype(np.int64)
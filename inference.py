@@ -0,0 +1,708 @@
+import asyncio
+import json
+import random
+import time
+from collections import OrderedDict, deque
+
+import httpx
+
+from metrics import AI_BREAKER_TRANSITIONS, AI_FAILOVERS, AI_HEDGES, AI_REQUESTS, AI_RETRIES, AI_SECONDS, AI_TOKENS
+
+# Answers worth trying again: the service is overloaded, restarting or timed out
+TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+# Answers not worth trying again that still say the endpoint is unusable: bad key, unknown model
+ENDPOINT_FAILURE_STATUS_CODES = {401, 403, 404}
+
+# Model routing: how much recent errors and low rate-limit headroom count against a route,
+# how long outcomes are remembered, and how long a rate-limited route is skipped by default
+ROUTE_ERROR_WEIGHT = 4.0
+ROUTE_LOW_HEADROOM = 0.1
+ROUTE_OUTCOME_SECONDS = 300.0
+ROUTE_RATE_LIMIT_COOLDOWN = 10.0
+
+
+class InferenceQueueFull(Exception):
+    """Raised when the inference queue is at capacity and a request is refused."""
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the AI service while its circuit breaker is open."""
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a failed AI request may succeed if sent again."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in TRANSIENT_STATUS_CODES
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+def _counts_against_service(error: Exception) -> bool:
+    """Whether a failed AI request says something about the service's health, not just about the request."""
+    if isinstance(error, httpx.HTTPStatusError) and error.response.status_code in ENDPOINT_FAILURE_STATUS_CODES:
+        return True
+    return is_transient(error)
+
+
+def _failure_reason(error: Exception) -> str:
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"status_{error.response.status_code}"
+    if isinstance(error, (httpx.TimeoutException, asyncio.TimeoutError)):
+        return "timeout"
+    return "connection"
+
+
+def _retry_after(error: Exception):
+    """Seconds the service asked us to wait in a Retry-After header, if any."""
+    if not isinstance(error, httpx.HTTPStatusError):
+        return None
+    try:
+        return float(error.response.headers.get("retry-after", ""))
+    except ValueError:
+        return None
+
+
+def record_usage(model: str, usage: dict):
+    """Adds the token counts from a response's `usage` block to the metrics."""
+    if not usage:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage.get(kind):
+            AI_TOKENS.inc(usage[kind], model=model, kind=kind.replace("_tokens", ""))
+
+
+class AsyncInferenceClient:
+    """Async client for an OpenAI-compatible chat completions endpoint.
+
+    All calls share one httpx connection pool with keep-alive, so concurrent
+    generations cost coroutines and sockets rather than OS threads.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        token: str,
+        timeout: float = 120.0,
+        connect_timeout: float = 10.0,
+        max_connections: int = 20,
+    ):
+        self.endpoint = endpoint.rstrip("/")
+        # Smallest remaining share of the request and token rate limits, from the last response's headers
+        self.headroom = None
+        self._http = httpx.AsyncClient(
+            base_url=self.endpoint,
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+
+    async def complete(self, messages: list, model: str, **params) -> dict:
+        """Sends a chat completion request and returns the decoded JSON response."""
+        started = time.perf_counter()
+        try:
+            response = await self._http.post(
+                "/chat/completions",
+                json={"model": model, "messages": messages, **params},
+            )
+            self._update_rate_limits(response.headers)
+            response.raise_for_status()
+            result = response.json()
+        except Exception:
+            AI_REQUESTS.inc(model=model, outcome="error")
+            raise
+        finally:
+            AI_SECONDS.observe(time.perf_counter() - started, model=model, mode="complete")
+        AI_REQUESTS.inc(model=model, outcome="ok")
+        record_usage(model, result.get("usage"))
+        return result
+
+    async def stream(self, messages: list, model: str, **params):
+        """Sends a streaming chat completion request and yields content deltas as they arrive."""
+        started = time.perf_counter()
+        try:
+            async with self._http.stream(
+                "POST",
+                "/chat/completions",
+                json={"model": model, "messages": messages, "stream": True, **params},
+            ) as response:
+                self._update_rate_limits(response.headers)
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    record_usage(model, chunk.get("usage"))
+                    for choice in chunk.get("choices", []):
+                        content = (choice.get("delta") or {}).get("content")
+                        if content:
+                            yield content
+        except Exception:
+            AI_REQUESTS.inc(model=model, outcome="error")
+            raise
+        finally:
+            AI_SECONDS.observe(time.perf_counter() - started, model=model, mode="stream")
+        AI_REQUESTS.inc(model=model, outcome="ok")
+
+    def _update_rate_limits(self, headers):
+        ratios = []
+        for kind in ("requests", "tokens"):
+            try:
+                ratios.append(
+                    float(headers[f"x-ratelimit-remaining-{kind}"]) / float(headers[f"x-ratelimit-limit-{kind}"])
+                )
+            except (KeyError, ValueError, ZeroDivisionError):
+                continue
+        if ratios:
+            self.headroom = min(ratios)
+
+    async def aclose(self):
+        """Closes the connection pool."""
+        await self._http.aclose()
+
+
+class CircuitBreaker:
+    """Stops calls to a failing AI service for a while instead of letting every request time out.
+
+    The breaker opens once at least `failure_threshold` of the last `window`
+    calls failed transiently or with an answer saying the endpoint is
+    unusable (401, 403, 404), and they make up at least `failure_ratio` of
+    them. While open, calls fail fast with CircuitOpenError. Once
+    `reset_timeout` seconds have passed, one trial call is let through
+    (half-open): the breaker closes if it succeeds and opens again if it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, failure_ratio: float = 0.5,
+                 window: int = 20, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_ratio = failure_ratio
+        self.clock = clock
+        self.state = self.CLOSED
+        self.opened = 0
+        self._outcomes = deque(maxlen=window)  # True for a failed call
+        self._opened_at = 0.0
+        self._trial_running = False
+
+    @property
+    def failures(self) -> int:
+        """Failed calls among the recent ones."""
+        return sum(self._outcomes)
+
+    def available(self) -> bool:
+        """Whether a call would be let through right now."""
+        if self.state == self.OPEN:
+            return self.clock() - self._opened_at >= self.reset_timeout
+        return not (self.state == self.HALF_OPEN and self._trial_running)
+
+    def allow(self) -> bool:
+        """Admits a call, or raises CircuitOpenError. Returns whether it is the half-open trial call.
+
+        Every admitted call must be reported back with one of the record methods or `release`.
+        """
+        if self.state == self.OPEN:
+            remaining = self.reset_timeout - (self.clock() - self._opened_at)
+            if remaining > 0:
+                raise CircuitOpenError(f"AI service unhealthy, retrying it in {remaining:.0f}s")
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._trial_running:
+                raise CircuitOpenError("AI service unhealthy, a trial request is in progress")
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self._outcomes.append(False)
+        self._trial_running = False
+        if self.state != self.CLOSED:
+            self._outcomes.clear()
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self._outcomes.append(True)
+        self._trial_running = False
+        failures = self.failures
+        if self.state == self.HALF_OPEN or (
+            failures >= self.failure_threshold and failures >= self.failure_ratio * len(self._outcomes)
+        ):
+            self._opened_at = self.clock()
+            if self.state != self.OPEN:
+                self.opened += 1
+                self._set_state(self.OPEN)
+
+    def release(self, trial: bool):
+        """Reports a call that says nothing about the service's health, such as a cancelled one."""
+        if trial:
+            self._trial_running = False
+
+    def _set_state(self, state: str):
+        print(f"AI circuit breaker {self.state} -> {state}, {self.failures} of {len(self._outcomes)} recent calls failed")
+        self.state = state
+        AI_BREAKER_TRANSITIONS.inc(state=state)
+
+
+class ResilientInferenceClient:
+    """Wraps an inference client with retries, hedged requests and a circuit breaker.
+
+    Transient failures (timeouts, connection errors, 429 and 5xx answers) are
+    retried up to `retries` times after a jittered exponential backoff, or after
+    the Retry-After the service asked for. With `hedge_percentile`, a request
+    still unanswered after that percentile of recent latencies of the same kind
+    of request gets a second, identical one; the first answer wins and the
+    other request is cancelled. Streams are hedged and retried on their first
+    chunk only, since the caller has already used anything yielded after it.
+
+    Calls go through `breaker`, so while the service is unhealthy they fail
+    fast with CircuitOpenError and callers can switch to a fallback.
+    """
+
+    def __init__(
+        self,
+        client,
+        retries: int = 2,
+        backoff: float = 1.0,
+        max_backoff: float = 20.0,
+        hedge_percentile: float = 0.0,
+        hedge_min_samples: int = 20,
+        breaker: CircuitBreaker = None,
+    ):
+        self.client = client
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.retried = 0
+        self.hedged = 0
+        self.hedges_won = 0
+        # (mode, model, system prompt) -> recent latencies in seconds, full answer or first chunk
+        self._latencies = {}
+
+    def available(self) -> bool:
+        return self.breaker.available()
+
+    @property
+    def headroom(self):
+        return getattr(self.client, "headroom", None)
+
+    async def complete(self, messages: list, model: str, **params) -> dict:
+        """Sends a chat completion request, retried and hedged, and returns the decoded JSON response."""
+        kind = ("complete", model, messages[0]["content"] if messages else "")
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                result = await self._hedged(kind, lambda: self.client.complete(messages, model, **params))
+            except Exception as e:
+                if attempt >= self.retries or not is_transient(e):
+                    raise
+                await self._wait_before_retry(e, attempt, model)
+                attempt += 1
+                continue
+            self._record_latency(kind, time.perf_counter() - started)
+            return result
+
+    async def stream(self, messages: list, model: str, **params):
+        """Sends a streaming chat completion request and yields content deltas as they arrive."""
+        kind = ("stream", model, messages[0]["content"] if messages else "")
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                stream, first = await self._hedged(
+                    kind, lambda: self._open_stream(messages, model, params), discard=lambda opened: opened[0].aclose()
+                )
+            except Exception as e:
+                if attempt >= self.retries or not is_transient(e):
+                    raise
+                await self._wait_before_retry(e, attempt, model)
+                attempt += 1
+                continue
+            self._record_latency(kind, time.perf_counter() - started)
+            break
+
+        try:
+            if first is not None:
+                yield first
+            async for chunk in stream:
+                yield chunk
+        except Exception as e:
+            if is_transient(e):
+                self.breaker.record_failure()
+            raise
+        finally:
+            await stream.aclose()
+
+    async def _open_stream(self, messages: list, model: str, params: dict) -> tuple:
+        """Starts a stream and waits for its first chunk. Returns (stream, first chunk or None)."""
+        stream = self.client.stream(messages, model, **params).__aiter__()
+        try:
+            return stream, await stream.__anext__()
+        except StopAsyncIteration:
+            return stream, None
+        except BaseException:
+            await stream.aclose()
+            raise
+
+    async def _attempt(self, factory):
+        trial = self.breaker.allow()
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            self.breaker.release(trial)
+            raise
+        except Exception as e:
+            if _counts_against_service(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.release(trial)
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def _hedged(self, kind: tuple, factory, discard=None):
+        """Awaits `factory()`, starting a second one if the first is slower than usual for its kind.
+
+        `discard` is awaited with the result of a request that finished but lost.
+        """
+        delay = self._hedge_delay(kind)
+        if delay is None:
+            return await self._attempt(factory)
+
+        tasks = [asyncio.ensure_future(self._attempt(factory))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self.breaker.state == CircuitBreaker.CLOSED:
+                tasks.append(asyncio.ensure_future(self._attempt(factory)))
+                self.hedged += 1
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None]
+                if not winners:
+                    error = error or next(iter(done)).exception()
+                    continue
+                winner = winners[0]
+                for loser in winners[1:]:
+                    if discard:
+                        await discard(loser.result())
+                if len(tasks) > 1:
+                    hedge_won = winner is tasks[1]
+                    self.hedges_won += hedge_won
+                    AI_HEDGES.inc(model=kind[1], winner="hedge" if hedge_won else "first")
+                return winner.result()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _hedge_delay(self, kind: tuple):
+        """Seconds after which a request of this kind gets a hedge, or None if it shouldn't."""
+        samples = self._latencies.get(kind)
+        if not self.hedge_percentile or not samples or len(samples) < self.hedge_min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    def _record_latency(self, kind: tuple, seconds: float):
+        self._latencies.setdefault(kind, deque(maxlen=200)).append(seconds)
+
+    async def _wait_before_retry(self, error: Exception, attempt: int, model: str):
+        # Full jitter, so clients that failed together don't all retry together
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = min(self.max_backoff, max(delay, retry_after))
+        reason = _failure_reason(error)
+        self.retried += 1
+        AI_RETRIES.inc(model=model, reason=reason)
+        print(f"AI request failed ({reason}), retry {attempt + 1}/{self.retries} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        """Returns the breaker state and lifetime counters."""
+        return {
+            "breaker": self.breaker.state,
+            "recent_failures": self.breaker.failures,
+            "breaker_opened": self.breaker.opened,
+            "retried": self.retried,
+            "hedged": self.hedged,
+            "hedges_won": self.hedges_won,
+        }
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class ModelRoute:
+    """One model at one endpoint of an InferencePool, with its recent latency and errors."""
+
+    def __init__(self, name: str, model: str, client, low_priority: bool = False, window: int = 20):
+        self.name = name
+        self.model = model
+        self.client = client
+        self.low_priority = low_priority
+        self.requests = 0
+        self.cooldown_until = 0.0
+        # mode -> moving average of seconds to the full answer ("complete") or the first chunk ("stream")
+        self.latency = {}
+        self._outcomes = deque(maxlen=window)  # (time, failed)
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until and self.client.available()
+
+    def error_rate(self, now: float) -> float:
+        recent = [failed for at, failed in self._outcomes if now - at < ROUTE_OUTCOME_SECONDS]
+        return sum(recent) / len(recent) if recent else 0.0
+
+    def score(self, mode: str, now: float, prior: float = 1.0) -> float:
+        """Expected cost of sending a request here; lower is better.
+
+        A route that has failed but never answered is scored as if it had the
+        `prior` latency, so its errors still count against it.
+        """
+        latency = self.latency.get(mode)
+        if latency is None:
+            if not self._outcomes:
+                return 0.0  # Not tried yet: try it once to learn its latency
+            latency = prior
+        score = latency * (1 + ROUTE_ERROR_WEIGHT * self.error_rate(now))
+        headroom = getattr(self.client, "headroom", None)
+        if headroom is not None and headroom < ROUTE_LOW_HEADROOM:
+            score *= ROUTE_LOW_HEADROOM / max(headroom, 0.01)
+        return score
+
+    def record_success(self, mode: str, seconds: float):
+        self.requests += 1
+        previous = self.latency.get(mode)
+        self.latency[mode] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+        self._outcomes.append((time.monotonic(), False))
+
+    def record_failure(self, error: Exception):
+        self.requests += 1
+        now = time.monotonic()
+        self._outcomes.append((now, True))
+        if isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429:
+            self.cooldown_until = now + (_retry_after(error) or ROUTE_RATE_LIMIT_COOLDOWN)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        stats = {
+            "requests": self.requests,
+            "latency": {mode: round(seconds, 2) for mode, seconds in self.latency.items()},
+            "error_rate": round(self.error_rate(now), 2),
+            "headroom": getattr(self.client, "headroom", None),
+            "cooling_down": now < self.cooldown_until,
+        }
+        if hasattr(self.client, "stats"):
+            stats.update(self.client.stats())
+        return stats
+
+
+class InferencePool:
+    """Routes AI requests across several models, possibly at different endpoints.
+
+    Each request goes to the available route with the lowest score: its recent
+    latency for that kind of request, raised by its recent error rate and by
+    low rate-limit headroom. If the request fails there, it fails over to the
+    next route. Low-priority requests try the routes marked `low_priority`
+    (usually cheaper models) first; other requests try them last. Routes whose
+    circuit breaker is open are skipped, and a route answering 429 is skipped
+    until its Retry-After has passed, unless nothing else is left.
+    """
+
+    def __init__(self, routes: list):
+        if not routes:
+            raise ValueError("an inference pool needs at least one route")
+        self.routes = routes
+
+    def available(self) -> bool:
+        return any(route.client.available() for route in self.routes)
+
+    def _candidates(self, mode: str, low_priority: bool) -> list:
+        now = time.monotonic()
+        # Routes that never answered are scored as if they were as fast as the fastest one that did
+        known = [route.latency[mode] for route in self.routes if mode in route.latency]
+        prior = min(known) if known else 1.0
+        ordered = []
+        for group in (True, False):
+            routes = [route for route in self.routes if (route.low_priority == low_priority) == group]
+            # A stable sort, so the configured order breaks ties
+            ordered.extend(sorted(
+                (route for route in routes if route.available(now)), key=lambda route: route.score(mode, now, prior)
+            ))
+        cooling = sorted(
+            (route for route in self.routes if route.client.available() and not route.available(now)),
+            key=lambda route: route.cooldown_until,
+        )
+        return ordered + cooling
+
+    def _failed(self, route: ModelRoute, error: Exception, last: bool):
+        if not isinstance(error, CircuitOpenError):
+            route.record_failure(error)
+        if not last:
+            AI_FAILOVERS.inc(route=route.name)
+            print(f"AI request failed on {route.name}, failing over: {error!r}")
+
+    async def complete(self, messages: list, low_priority: bool = False, **params) -> dict:
+        """Sends a chat completion request to the best route and returns the decoded JSON response."""
+        candidates = self._candidates("complete", low_priority)
+        error = CircuitOpenError("every AI model is unavailable")
+        for position, route in enumerate(candidates):
+            started = time.perf_counter()
+            try:
+                result = await route.client.complete(messages, route.model, **params)
+            except Exception as e:
+                self._failed(route, e, position == len(candidates) - 1)
+                error = e
+                continue
+            route.record_success("complete", time.perf_counter() - started)
+            return result
+        raise error
+
+    async def stream(self, messages: list, low_priority: bool = False, **params):
+        """Sends a streaming chat completion request to the best route and yields content deltas.
+
+        Fails over only until the first chunk has been yielded.
+        """
+        candidates = self._candidates("stream", low_priority)
+        error = CircuitOpenError("every AI model is unavailable")
+        for position, route in enumerate(candidates):
+            started = time.perf_counter()
+            stream = route.client.stream(messages, route.model, **params).__aiter__()
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except Exception as e:
+                await stream.aclose()
+                self._failed(route, e, position == len(candidates) - 1)
+                error = e
+                continue
+            route.record_success("stream", time.perf_counter() - started)
+            try:
+                if first is not None:
+                    yield first
+                async for chunk in stream:
+                    yield chunk
+            except Exception as e:
+                route.record_failure(e)
+                raise
+            finally:
+                await stream.aclose()
+            return
+        raise error
+
+    def stats(self) -> dict:
+        """Returns each route's recent performance and resilience counters."""
+        return {route.name: route.stats() for route in self.routes}
+
+    async def aclose(self):
+        for route in self.routes:
+            await route.client.aclose()
+
+
+class InferenceScheduler:
+    """Limits concurrent AI calls and queues the rest fairly across chats.
+
+    At most `max_concurrency` calls run at once. Waiting requests are grouped
+    per chat and served round-robin, so one chat can't hold every slot. Once
+    `max_queue` requests are waiting, new ones are refused with InferenceQueueFull.
+    """
+
+    def __init__(self, max_concurrency: int = 4, max_queue: int = 100, initial_estimate: float = 45.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.average_seconds = initial_estimate
+        self._running = 0
+        self._waiting = OrderedDict()
+        self._queued = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def estimate(self):
+        """Returns (requests ahead, estimated seconds until done) for a new request."""
+        if self._running < self.max_concurrency:
+            return 0, self.average_seconds
+        # Round-robin gives every chat already waiting one turn before a newcomer
+        ahead = len(self._waiting)
+        rounds = ahead // self.max_concurrency + 1
+        return ahead, (rounds + 1) * self.average_seconds
+
+    async def submit(self, chat_id: int, factory):
+        """Waits for a free slot, then awaits `factory()` and returns its result."""
+        loop = asyncio.get_running_loop()
+        if self._running < self.max_concurrency and not self._queued:
+            self._running += 1
+        else:
+            if self._queued >= self.max_queue:
+                self.rejected += 1
+                raise InferenceQueueFull(f"{self._queued} inference requests already waiting")
+            future = loop.create_future()
+            waiters = self._waiting.setdefault(chat_id, deque())
+            waiters.append(future)
+            self._queued += 1
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    # _dispatch may already have dropped the cancelled future from the queue
+                    if future in waiters:
+                        waiters.remove(future)
+                        self._queued -= 1
+                        if not waiters and self._waiting.get(chat_id) is waiters:
+                            del self._waiting[chat_id]
+                else:
+                    # The slot was granted just as we were cancelled; hand it on
+                    self._release()
+                raise
+
+        started = loop.time()
+        try:
+            return await factory()
+        finally:
+            elapsed = loop.time() - started
+            self.average_seconds = 0.8 * self.average_seconds + 0.2 * elapsed
+            self.completed += 1
+            self._release()
+
+    def _release(self):
+        self._running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency and self._waiting:
+            chat_id, waiters = next(iter(self._waiting.items()))
+            del self._waiting[chat_id]
+            future = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                # Move the chat to the back of the rotation
+                self._waiting[chat_id] = waiters
+            if future.done():
+                # Cancelled, but its task hasn't run its cleanup yet
+                continue
+            self._running += 1
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        """Returns current load and lifetime counters."""
+        return {
+            "running": self._running,
+            "queued": self._queued,
+            "waiting_chats": len(self._waiting),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "average_seconds": round(self.average_seconds, 1),
+        }
@@ -1,9 +1,13 @@
 import os
+import argparse
 import asyncio
-import csv
+import datetime
 import json
+import random
+import secrets
+import signal
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -11,11 +15,32 @@ from telegram.ext import (
     ContextTypes,
     filters,
     CallbackQueryHandler,
+    TypeHandler,
 )
+from telegram.constants import MessageLimit
 from telegram.error import NetworkError
-from azure.ai.inference import ChatCompletionsClient
-from azure.ai.inference.models import SystemMessage, UserMessage
-from azure.core.credentials import AzureKeyCredential
+from calories import calculate_daily_calories, calculate_daily_calories_batch
+from inference import (
+    AsyncInferenceClient, CircuitBreaker, InferencePool, InferenceQueueFull, InferenceScheduler, ModelRoute,
+    ResilientInferenceClient,
+)
+from menu_cache import MenuCache, SingleFlight, menu_cache_key
+from menu_model import MEAL_FIELDS, CompactMenu
+from menu_parser import (
+    COMPACT_DAY_SCHEMA, COMPACT_MENU_SCHEMA, MenuFormatError, MenuStreamParser, normalize_day, parse_menu,
+    response_format,
+)
+from meal_planner import DAY_NAMES, PLANNER_VERSION, LocalMenuPlanner, recipe_name
+import metrics
+from metrics import LOCAL_MENU_SECONDS, MENU_EDITS, MENU_REPAIRS, MENUS_SERVED, STORE_SECONDS, instrument_handler
+from storage import SqliteMenuStore, WriteBehindProfileStore, format_compaction_report, open_profile_store
+from update_processor import ChatOrderedUpdateProcessor
+from sharding import ShardRouter, ShardRouterServer, WorkerPool, poll_updates
+from state_store import SqliteStatePersistence
+from sessions import SessionJanitor
+from snapshot import ProfileSnapshot, format_stats, write_snapshot
+from rate_limiter import PRIORITY_BULK, PRIORITY_INTERACTIVE, TokenBucketRateLimiter
+from webhook import WebhookServer
 
 # Load environment variables
 load_dotenv()
@@ -23,15 +48,110 @@ load_dotenv()
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
 
-# Initialize GitHub AI client
+# How updates are received: "polling" (default) or "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # public base URL registered with Telegram
+WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN", "")
+
+# Updates from different chats are handled concurrently, up to this many at once;
+# updates from the same chat are always handled one at a time, in order
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "32"))
+update_processor = None
+
+# Outgoing messages are throttled to Telegram's limits (messages per second)
+SEND_RATE_LIMIT = os.environ.get("SEND_RATE_LIMIT", "1") == "1"
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = float(os.environ.get("SEND_CHAT_BURST", "3"))
+SEND_GROUP_RATE = float(os.environ.get("SEND_GROUP_RATE", str(20 / 60)))
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", "3"))
+rate_limiter = None
+
+# Multi-process mode: a front-end routes updates to WORKERS processes by chat id.
+# WORKER_INDEX/WORKER_COUNT are set by the front-end for each worker it starts.
+WORKERS = int(os.environ.get("WORKERS", "1"))
+WORKER_BASE_PORT = int(os.environ.get("WORKER_BASE_PORT", "8600"))
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "1"))
+# Shared by the front-end and its workers only; never leaves the machine
+worker_secret_token = secrets.token_urlsafe(32)
+
+# Conversation state kept in SQLite so it survives restarts (empty keeps it in memory only)
+STATE_STORE_FILE = os.environ.get("STATE_STORE_FILE", "")
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "1.0"))
+
+# AI requests that fail transiently are retried with jittered backoff. With a hedge
+# percentile set, a request slower than that percentile of recent ones gets a second,
+# identical request, and the first answer wins. Once INFERENCE_BREAKER_FAILURES of the last
+# 20 AI calls failed, and at least INFERENCE_BREAKER_RATIO of them, AI calls fail fast for
+# INFERENCE_BREAKER_RESET seconds and menus come from the local planner (if MENU_LOCAL_FALLBACK is on)
+INFERENCE_RETRIES = int(os.environ.get("INFERENCE_RETRIES", "2"))
+INFERENCE_RETRY_BACKOFF = float(os.environ.get("INFERENCE_RETRY_BACKOFF", "1.0"))
+INFERENCE_HEDGE_PERCENTILE = float(os.environ.get("INFERENCE_HEDGE_PERCENTILE", "0"))
+INFERENCE_BREAKER_FAILURES = int(os.environ.get("INFERENCE_BREAKER_FAILURES", "5"))
+INFERENCE_BREAKER_RATIO = float(os.environ.get("INFERENCE_BREAKER_RATIO", "0.5"))
+INFERENCE_BREAKER_RESET = float(os.environ.get("INFERENCE_BREAKER_RESET", "30"))
+
+def resilient_client(inference_client, retries: int = None) -> ResilientInferenceClient:
+    """Wraps an inference client with the configured retries, hedging and circuit breaker."""
+    return ResilientInferenceClient(
+        inference_client,
+        retries=INFERENCE_RETRIES if retries is None else retries,
+        backoff=INFERENCE_RETRY_BACKOFF,
+        hedge_percentile=INFERENCE_HEDGE_PERCENTILE,
+        breaker=CircuitBreaker(INFERENCE_BREAKER_FAILURES, INFERENCE_BREAKER_RESET, INFERENCE_BREAKER_RATIO),
+    )
+
+# AI models, as "model" or "model@endpoint", comma-separated. Each request goes to the model
+# with the best recent latency, error rate and rate-limit headroom, and fails over to the
+# next one if it fails. Models also listed in INFERENCE_LOW_PRIORITY_MODELS (cheaper ones)
+# get day regenerations, meal swaps and repairs first, and full menus only as a last resort.
+# MENU_MODEL is the default model
+MENU_MODEL = "openai/gpt-4.1-nano"
+INFERENCE_ENDPOINT = "https://models.github.ai/inference"
+INFERENCE_MODELS = [name.strip() for name in os.environ.get("INFERENCE_MODELS", MENU_MODEL).split(",") if name.strip()]
+INFERENCE_LOW_PRIORITY_MODELS = {
+    name.strip() for name in os.environ.get("INFERENCE_LOW_PRIORITY_MODELS", "").split(",") if name.strip()
+}
+# AI menus are cached under the whole set of models, since failover means any of them may have
+# answered; a different set starts with a fresh cache instead of serving another set's menus
+MENU_CACHE_MODELS = ",".join(sorted(INFERENCE_MODELS))
+
+def build_inference_pool(clients: dict) -> InferencePool:
+    """Routes between per-model clients, keyed by "model" or "model@endpoint".
+
+    Each model gets its own retries, hedging and circuit breaker. With more than
+    one model, a failed request moves on to the next model instead of being
+    retried on the same one.
+    """
+    routes = []
+    for name, inference_client in clients.items():
+        model = name.partition("@")[0]
+        routes.append(ModelRoute(
+            name,
+            model,
+            resilient_client(inference_client, retries=None if len(clients) == 1 else 0),
+            low_priority=bool({name, model} & INFERENCE_LOW_PRIORITY_MODELS),
+        ))
+    return InferencePool(routes)
+
+# Initialize GitHub AI clients (async, each with a shared keep-alive connection pool)
 client = None
 if GITHUB_TOKEN:
-    endpoint = "https://models.github.ai/inference"
     try:
-        client = ChatCompletionsClient(
-            endpoint=endpoint,
-            credential=AzureKeyCredential(GITHUB_TOKEN),
-        )
+        client = build_inference_pool({
+            name: AsyncInferenceClient(
+                endpoint=name.partition("@")[2] or INFERENCE_ENDPOINT,
+                token=GITHUB_TOKEN,
+                timeout=float(os.environ.get("INFERENCE_TIMEOUT", "120")),
+                connect_timeout=float(os.environ.get("INFERENCE_CONNECT_TIMEOUT", "10")),
+                max_connections=int(os.environ.get("INFERENCE_MAX_CONNECTIONS", "20")),
+            )
+            for name in INFERENCE_MODELS
+        })
     except Exception as e:
         print(f"Error initializing AI client: {e}")
         client = None
@@ -42,50 +162,193 @@ else:
 CSV_FILE_NAME = "user_data.csv"
 CSV_HEADERS = ["chat_id", "sex", "weight", "height", "age", "activity", "goal", "calories"]
 
-# Define activity multipliers for calorie calculation
-ACTIVITY_MULTIPLIERS = {
-    "minimum": 1.2,
-    "low": 1.375,
-    "medium": 1.55,
-    "hard": 1.725,
-    "extremely high": 1.9
-}
+# Profile storage backend: "csv" (indexed append-only log) or "sqlite"
+PROFILE_STORE_BACKEND = os.environ.get("PROFILE_STORE_BACKEND", "csv")
+SQLITE_FILE_NAME = os.environ.get("SQLITE_FILE_NAME", "user_data.db")
+
+# Profile writes are queued and flushed in batches off the event loop
+PROFILE_WRITE_BEHIND = os.environ.get("PROFILE_WRITE_BEHIND", "1") == "1"
+PROFILE_WRITE_BATCH_SIZE = int(os.environ.get("PROFILE_WRITE_BATCH_SIZE", "50"))
+PROFILE_WRITE_FLUSH_INTERVAL = float(os.environ.get("PROFILE_WRITE_FLUSH_INTERVAL", "1.0"))
+
+# Periodic compaction of the profile history (0 disables it)
+PROFILE_COMPACT_INTERVAL = float(os.environ.get("PROFILE_COMPACT_INTERVAL", "0"))
+PROFILE_COMPACT_KEEP_HISTORY = int(os.environ.get("PROFILE_COMPACT_KEEP_HISTORY", "0"))
+
+# Directory of the columnar profile snapshot used by the stats command
+PROFILE_SNAPSHOT_DIR = os.environ.get("PROFILE_SNAPSHOT_DIR", "profile_snapshot")
+
+# Metrics: served on METRICS_PORT (0 disables) and/or written to METRICS_DUMP_FILE
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_DUMP_FILE = os.environ.get("METRICS_DUMP_FILE", "")
+METRICS_DUMP_INTERVAL = float(os.environ.get("METRICS_DUMP_INTERVAL", "60"))
+
+# Background tasks started in on_startup and cancelled in on_shutdown
+background_tasks = []
+profile_store = None
+
+# AI menu generation settings. Bump MENU_SYSTEM_PROMPT_VERSION whenever the prompt changes
+# so that cached menus built from the old prompt are no longer reused.
+MENU_DAYS = 7
+MENU_SYSTEM_PROMPT_VERSION = 2
+MENU_SYSTEM_PROMPT = (
+    "You are a professional nutritionist creating personalized 7-day meal plans. "
+    "Create a JSON response with a 'menu' key containing an array of 7 day objects. "
+    "Each day object must have: day, calories, macronutrients, breakfast, snack1, lunch, snack2, dinner. "
+    "Make meals practical, detailed with portions and calories, balanced and realistic for home cooking. "
+    "Adjust calories based on goals: deficit for weight loss, surplus for weight gain. "
+    "RESPOND ONLY WITH VALID JSON - NO OTHER TEXT."
+)
+# The same plan in the compact format: short keys, calories and macros as plain numbers
+MENU_COMPACT_SYSTEM_PROMPT = (
+    "You are a professional nutritionist creating personalized 7-day meal plans. "
+    "Answer with JSON {\"m\": [7 day objects]}. Day keys: d = day name, k = total kcal, "
+    "p, c, f = grams of protein, carbs and fat (integers), b = breakfast, s1 = morning snack, l = lunch, "
+    "s2 = afternoon snack, n = dinner. Each meal is one line with the dishes, portions and kcal. "
+    "Make meals practical, balanced and realistic for home cooking. "
+    "Adjust calories based on goals: deficit for weight loss, surplus for weight gain."
+)
+
+# Prompts for changing one part of a shown menu. Only the changed part is generated,
+# with the rest of the plan sent as a short list of dishes
+MENU_DAY_SYSTEM_PROMPT = (
+    "You are a professional nutritionist revising one day of an existing 7-day meal plan. "
+    "Create a JSON object for the requested day with: day, calories, macronutrients, breakfast, snack1, lunch, snack2, dinner. "
+    "Make meals practical, detailed with portions and calories, and different from the rest of the plan. "
+    "RESPOND ONLY WITH VALID JSON - NO OTHER TEXT."
+)
+MENU_DAY_COMPACT_SYSTEM_PROMPT = (
+    "You are a professional nutritionist writing one day of an existing 7-day meal plan. "
+    "Answer with one JSON day object. Keys: d = day name, k = total kcal, "
+    "p, c, f = grams of protein, carbs and fat (integers), b = breakfast, s1 = morning snack, l = lunch, "
+    "s2 = afternoon snack, n = dinner. Each meal is one line with the dishes, portions and kcal, "
+    "different from the rest of the plan."
+)
+MENU_MEAL_SYSTEM_PROMPT = (
+    "You are a professional nutritionist swapping one meal of an existing meal plan. "
+    "Create a JSON object with one key, the meal to replace, describing a different dish with portions "
+    "and calories, close to the calories of the meal it replaces and different from the rest of the day. "
+    "RESPOND ONLY WITH VALID JSON - NO OTHER TEXT."
+)
+
+# Ask for menus in the compact format (MENU_COMPACT_OUTPUT=0 uses the verbose one), enforced
+# with a JSON schema where the model supports structured output. Days that still come back
+# broken or missing are generated again one by one, unless more than MENU_REPAIR_MAX_DAYS are
+MENU_COMPACT_OUTPUT = os.environ.get("MENU_COMPACT_OUTPUT", "1") == "1"
+MENU_STRUCTURED_OUTPUT = os.environ.get("MENU_STRUCTURED_OUTPUT", "1") == "1"
+MENU_REPAIR_MAX_DAYS = int(os.environ.get("MENU_REPAIR_MAX_DAYS", "3"))
+
+# Stream the completion and show each day as soon as it has been generated
+MENU_STREAMING = os.environ.get("MENU_STREAMING", "1") == "1"
+
+# Opt-in: start generating a menu in the background as soon as calories are calculated
+MENU_SPECULATIVE = os.environ.get("MENU_SPECULATIVE", "0") == "1"
+
+# Menu engine: "ai" asks the AI model, "local" plans every menu from the local recipe
+# database in milliseconds. With "ai", the local planner also stands in whenever the AI
+# fails, is overloaded or isn't configured (MENU_LOCAL_FALLBACK=0 turns that off)
+MENU_ENGINE = os.environ.get("MENU_ENGINE", "ai")
+MENU_LOCAL_FALLBACK = os.environ.get("MENU_LOCAL_FALLBACK", "1") == "1"
+LOCAL_MENU_MODEL = "local-planner"
+local_planner = LocalMenuPlanner()
+
+# Every menu shown to a chat is saved with its profile snapshot, so it can be shown
+# again after a restart without another generation (empty MENU_STORE_FILE disables this)
+MENU_STORE_FILE = os.environ.get("MENU_STORE_FILE", "menus.db")
+MENU_STORE_KEEP = int(os.environ.get("MENU_STORE_KEEP", "5"))
+menu_store = None
+
+# Cache of generated menus keyed by the prompt inputs
+menu_cache = MenuCache(
+    ttl=float(os.environ.get("MENU_CACHE_TTL", str(7 * 24 * 3600))),
+    max_bytes=int(os.environ.get("MENU_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+    disk_dir=os.environ.get("MENU_CACHE_DIR") or None,
+)
+
+# Identical concurrent generations share one AI call; a chat runs one generation at a time
+menu_generation = SingleFlight()
+generating_chats = set()
+
+# Speculative generations per chat: chat_id -> (cache key, task)
+speculative_menus = {}
+
+# Bounded, per-chat fair scheduling of AI calls
+inference_scheduler = InferenceScheduler(
+    max_concurrency=int(os.environ.get("INFERENCE_MAX_CONCURRENCY", "4")),
+    max_queue=int(os.environ.get("INFERENCE_MAX_QUEUE", "100")),
+)
+
+# Idle conversation state is trimmed so memory doesn't grow with the lifetime user count:
+# menus are dropped (and reloaded from the menu cache on demand) after SESSION_IDLE_TTL seconds
+# or beyond SESSION_MAX_MENUS users, whole sessions after SESSION_DROP_AFTER seconds (0 = never)
+session_janitor = SessionJanitor(
+    idle_ttl=float(os.environ.get("SESSION_IDLE_TTL", "1800")),
+    max_menus=int(os.environ.get("SESSION_MAX_MENUS", "10000")),
+    drop_after=float(os.environ.get("SESSION_DROP_AFTER", str(30 * 24 * 3600))),
+)
+SESSION_SWEEP_INTERVAL = float(os.environ.get("SESSION_SWEEP_INTERVAL", "60"))
+
+# Pause before some replies so the conversation feels natural
+UI_DELAY_SECONDS = float(os.environ.get("UI_DELAY_SECONDS", "1.5"))
 
 def initialize_csv():
-    """Creates a CSV file with headers if it doesn't exist."""
-    if not os.path.exists(CSV_FILE_NAME):
-        with open(CSV_FILE_NAME, "w", newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(CSV_HEADERS)
-        print(f"Created new CSV file: {CSV_FILE_NAME}")
+    """Opens the configured profile and menu stores, creating the CSV file if it doesn't exist."""
+    global profile_store, menu_store
+    if MENU_STORE_FILE:
+        menu_store = SqliteMenuStore(MENU_STORE_FILE, keep_per_chat=MENU_STORE_KEEP)
+    profile_store = open_profile_store(
+        PROFILE_STORE_BACKEND, CSV_FILE_NAME, SQLITE_FILE_NAME, CSV_HEADERS
+    )
+    if PROFILE_WRITE_BEHIND:
+        profile_store = WriteBehindProfileStore(
+            profile_store,
+            batch_size=PROFILE_WRITE_BATCH_SIZE,
+            flush_interval=PROFILE_WRITE_FLUSH_INTERVAL,
+        )
 
 def store_user_data(user_data: dict):
-    """Appends a new row of user data to the CSV file."""
-    with open(CSV_FILE_NAME, "a", newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([user_data.get(header) for header in CSV_HEADERS])
+    """Appends a new row of user data to the profile store."""
+    with STORE_SECONDS.time(operation="store"):
+        profile_store.store(user_data)
     print(f"Stored data for chat_id: {user_data.get('chat_id')}")
 
 def get_latest_user_data(chat_id: int):
-    """Retrieves the last saved user data from the CSV."""
-    user_data = None
-    if os.path.exists(CSV_FILE_NAME):
-        with open(CSV_FILE_NAME, "r", newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reversed(list(reader)):
-                if int(row["chat_id"]) == chat_id:
-                    if all(key in row for key in ['weight', 'height', 'age', 'sex', 'activity', 'goal']):
-                        try:
-                            row['weight'] = float(row['weight'])
-                            row['height'] = float(row['height'])
-                            row['age'] = int(row['age'])
-                            row['calories'] = float(row['calories']) if row['calories'] else None
-                            user_data = row
-                            break
-                        except (ValueError, KeyError) as e:
-                            print(f"Skipping incomplete or corrupt row for chat_id {chat_id}: {e}")
-                            continue
-    return user_data
+    """Retrieves the last saved user data from the profile store."""
+    with STORE_SECONDS.time(operation="get"):
+        return profile_store.get_latest(chat_id)
+
+def register_metrics():
+    """Registers gauges for the bot's queues and caches."""
+    metrics.Gauge("bot_inference_running", "AI generations currently running.",
+                  lambda: inference_scheduler.stats()["running"])
+    metrics.Gauge("bot_inference_queued", "AI generations waiting for a slot.",
+                  lambda: inference_scheduler.stats()["queued"])
+    metrics.Gauge("bot_inference_rejected", "AI generations refused because the queue was full.",
+                  lambda: inference_scheduler.stats()["rejected"])
+    metrics.Gauge("bot_ai_breaker_open", "AI models whose calls fail fast because they are unhealthy.",
+                  lambda: sum(route["breaker"] == CircuitBreaker.OPEN for route in client.stats().values())
+                  if client else 0)
+    metrics.Gauge("bot_menu_cache_hits", "Menu cache hits (memory and disk).",
+                  lambda: menu_cache.stats()["hits"] + menu_cache.stats()["disk_hits"])
+    metrics.Gauge("bot_menu_cache_misses", "Menu cache misses.",
+                  lambda: menu_cache.stats()["misses"])
+    metrics.Gauge("bot_menu_generations_coalesced", "Menu generations that joined an identical one in flight.",
+                  lambda: menu_generation.stats()["coalesced"])
+    metrics.Gauge("bot_profile_write_queue", "Profile rows waiting to be flushed.",
+                  lambda: profile_store.queue_length() if isinstance(profile_store, WriteBehindProfileStore) else 0)
+    metrics.Gauge("bot_send_queue_interactive", "Message edits waiting for the rate limiter.",
+                  lambda: rate_limiter.queue_length(PRIORITY_INTERACTIVE) if rate_limiter else 0)
+    metrics.Gauge("bot_send_queue_bulk", "New messages waiting for the rate limiter.",
+                  lambda: rate_limiter.queue_length(PRIORITY_BULK) if rate_limiter else 0)
+    metrics.Gauge("bot_sessions", "Conversation sessions held in memory.",
+                  lambda: session_janitor.stats()["sessions"])
+    metrics.Gauge("bot_session_bytes", "Average memory used by one conversation session, in bytes.",
+                  lambda: session_janitor.stats()["bytes_per_session"])
+    metrics.Gauge("bot_session_menus_evicted", "Menus dropped from idle sessions.",
+                  lambda: session_janitor.stats()["menus_evicted"])
+    metrics.Gauge("bot_update_active_chats", "Chats with an update being handled or waiting.",
+                  lambda: update_processor.waiting_chats() if update_processor else 0)
 
 async def send_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, message: str = "What would you like to do? 🤔"):
     """Helper function to send the main menu."""
@@ -95,10 +358,13 @@ async def send_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, mes
             InlineKeyboardButton("🗓️ Generate Menu", callback_data="generate_menu")
         ]
     ]
+    if menu_store:
+        keyboard.append([InlineKeyboardButton("📋 My Last Plan", callback_data="last_plan")])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     # Clear any ongoing state
     context.user_data['state'] = None
+    context.user_data['menu_message_id'] = None
     
     if update.callback_query:
         await update.callback_query.edit_message_text(
@@ -128,7 +394,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text=welcome_message
     )
     
-    await asyncio.sleep(1.5)
+    await asyncio.sleep(UI_DELAY_SECONDS)
     await send_main_menu(update, context, "What would you like to do first? 🌟")
 
 async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -520,29 +786,18 @@ async def calculate_calories_callback(update: Update, context: ContextTypes.DEFA
         await send_main_menu(update, context)
         return
 
-    # Calculate BMR using Mifflin-St Jeor equation
-    sex = profile_data['sex']
-    weight = profile_data['weight']
-    height = profile_data['height']
-    age = profile_data['age']
-    activity = profile_data['activity']
-
-    if sex == 'man':
-        bmr = (10 * weight) + (6.25 * height) - (5 * age) + 5
-    else:  # woman
-        bmr = (10 * weight) + (6.25 * height) - (5 * age) - 161
-
-    # Apply activity multiplier
-    activity_multiplier = ACTIVITY_MULTIPLIERS.get(activity, 1.2)
-    daily_calories = bmr * activity_multiplier
+    # Mifflin-St Jeor BMR times the activity multiplier
+    bmr, activity_multiplier, daily_calories = calculate_daily_calories(profile_data)
 
     # Save complete profile data to CSV
     complete_profile = profile_data.copy()
     complete_profile['chat_id'] = update.effective_chat.id
     complete_profile['calories'] = int(round(daily_calories))
     store_user_data(complete_profile)
+    if MENU_SPECULATIVE:
+        start_speculative_generation(update.effective_chat.id, complete_profile)
 
-    await asyncio.sleep(1.5)  # Small delay for realism
+    await asyncio.sleep(UI_DELAY_SECONDS)  # Small delay for realism
 
     result_text = (
         f"🎉 **Your Daily Calorie Target** 🎉\n\n"
@@ -568,17 +823,259 @@ async def calculate_calories_callback(update: Update, context: ContextTypes.DEFA
         parse_mode='Markdown'
     )
 
+def build_menu_prompt_inputs(user_data: dict) -> dict:
+    """Extracts the profile values that go into the menu generation prompt."""
+    return {
+        'sex': user_data['sex'],
+        'age': int(user_data['age']),
+        'height': int(user_data['height']),
+        'weight': int(user_data['weight']),
+        'activity': user_data['activity'],
+        'goal': user_data['goal'],
+        'calories': int(round(user_data['calories'])) if user_data.get('calories') else 2000,
+    }
+
+def format_profile_prompt(prompt_inputs: dict) -> str:
+    """The profile lines of a menu prompt."""
+    return (
+        f"Gender: {prompt_inputs['sex']}\n"
+        f"Age: {prompt_inputs['age']}\n"
+        f"Height: {prompt_inputs['height']} cm\n"
+        f"Weight: {prompt_inputs['weight']} kg\n"
+        f"Activity: {prompt_inputs['activity']}\n"
+        f"Goal: {prompt_inputs['goal']}\n"
+        f"Target calories: {prompt_inputs['calories']}"
+    )
+
+async def show_generated_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, menu: list):
+    """Stores a generated menu for pagination and shows its first day."""
+    # A compact copy, so later edits never touch a cached menu shared with other chats
+    context.user_data['menu_data'] = CompactMenu(menu)
+    context.user_data['current_menu_page'] = 0
+    await display_menu_page(update, context, 0)
+
+def format_wait(seconds: float) -> str:
+    """Formats an estimated wait for display to the user."""
+    if seconds < 90:
+        return f"{max(5, int(round(seconds / 5.0)) * 5)} seconds"
+    return f"{int(round(seconds / 60.0))} minutes"
+
+async def show_streamed_days(update: Update, context: ContextTypes.DEFAULT_TYPE, days: list):
+    """Shows streamed days as they arrive: day 1 right away, later days by refreshing navigation."""
+    menu_data = context.user_data.get('menu_data')
+    if menu_data is None:
+        menu_data = context.user_data['menu_data'] = CompactMenu()
+    previous_count = len(menu_data)
+    last_page = len(menu_pages(context, menu_data)) - 1
+    menu_data.extend(days[previous_count:])
+
+    try:
+        if previous_count == 0:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="🎉 **Your Personalized Menu is Arriving!** 🎉\n\n"
+                     "Here's your first day - the rest of the week is on its way.\n"
+                     "Use the navigation buttons to explore each day. 📅"
+            )
+            context.user_data['current_menu_page'] = 0
+            await display_menu_page(update, context, 0)
+        elif (context.user_data.get('menu_message_id') == update.effective_message.message_id
+                and context.user_data.get('current_menu_page') == last_page):
+            # The user is looking at the last finished day, so enable its "Next Day" button
+            await display_menu_page(update, context, last_page)
+    except Exception as e:
+        print(f"Could not show streamed menu day: {e}")
+
+async def generate_menu(prompt_inputs: dict, cache_key: str, on_day=None) -> list:
+    """Asks the AI model for a 7-day menu and caches it if generation succeeded.
+
+    In streaming mode `on_day` is awaited with the days completed so far each
+    time another day has been fully received.
+    """
+    user_message = f"Create a meal plan for:\n{format_profile_prompt(prompt_inputs)}"
+    system_prompt, params = menu_output(MENU_SYSTEM_PROMPT, MENU_COMPACT_SYSTEM_PROMPT, "menu", COMPACT_MENU_SCHEMA)
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+
+    if MENU_STREAMING:
+        parser = MenuStreamParser()
+        async for delta in client.stream(messages=messages, temperature=0.7, **params):
+            if parser.feed(delta) and on_day:
+                await on_day(parser.days)
+        slots = parser.slots[:MENU_DAYS]
+        slots = slots + [None] * (MENU_DAYS - len(slots)) if slots else parse_menu(parser.full_text(), MENU_DAYS)
+    else:
+        response = await client.complete(messages=messages, temperature=0.7, **params)
+        slots = parse_menu(response["choices"][0]["message"]["content"], MENU_DAYS)
+
+    menu = await repair_menu(prompt_inputs, slots)
+    menu_cache.put(cache_key, menu)
+    return menu
+
+async def repair_menu(prompt_inputs: dict, slots: list) -> list:
+    """Generates again only the days of a menu that came back broken or missing.
+
+    Raises MenuFormatError if more than MENU_REPAIR_MAX_DAYS days are broken,
+    since asking for the whole menu again is then no slower.
+    """
+    broken = [index for index, day in enumerate(slots) if day is None]
+    if not broken:
+        return slots
+    if len(broken) > MENU_REPAIR_MAX_DAYS:
+        MENU_REPAIRS.inc(len(broken), outcome="abandoned")
+        raise MenuFormatError(f"{len(broken)} of {len(slots)} days of the AI's menu are broken")
+
+    print(f"Repairing menu days {[index + 1 for index in broken]}")
+    # Called while the generation's inference slot is still held, so these don't queue again
+    days = await asyncio.gather(
+        *(request_menu_day(prompt_inputs, slots, index, DAY_NAMES[index % len(DAY_NAMES)]) for index in broken),
+        return_exceptions=True,
+    )
+    failed = [day for day in days if isinstance(day, Exception)]
+    MENU_REPAIRS.inc(len(broken) - len(failed), outcome="repaired")
+    if failed:
+        MENU_REPAIRS.inc(len(failed), outcome="failed")
+        raise failed[0]
+    menu = list(slots)
+    for index, day in zip(broken, days):
+        menu[index] = day
+    return menu
+
+def start_speculative_generation(chat_id: int, profile: dict):
+    """Starts generating a menu for a freshly saved profile before the user asks for it.
+
+    A speculation for an older profile of the same chat is cancelled. Nothing is
+    started if the menu is already cached or no inference slot is free right now,
+    so speculative work never queues ahead of real requests.
+    """
+    prompt_inputs = build_menu_prompt_inputs(profile)
+    cache_key = menu_cache_key(prompt_inputs, MENU_CACHE_MODELS, MENU_SYSTEM_PROMPT_VERSION)
+
+    slot = speculative_menus.get(chat_id)
+    if slot is not None:
+        if slot[0] == cache_key:
+            return
+        slot[1].cancel()
+        del speculative_menus[chat_id]
+
+    if MENU_ENGINE == "local" or not client or not client.available():
+        return
+    if chat_id in generating_chats or inference_scheduler.estimate()[0]:
+        return
+    if menu_cache.get(cache_key):
+        return
+
+    task = asyncio.create_task(
+        inference_scheduler.submit(chat_id, lambda: generate_menu(prompt_inputs, cache_key))
+    )
+    speculative_menus[chat_id] = (cache_key, task)
+    print(f"Started speculative menu generation for chat_id: {chat_id}")
+
+    def on_done(finished: asyncio.Task):
+        if not finished.cancelled() and finished.exception():
+            print(f"Speculative menu generation error for chat_id {chat_id}: {finished.exception()}")
+        # A finished menu is already in the menu cache, so the slot isn't needed to find it
+        if speculative_menus.get(chat_id, (None, None))[1] is finished:
+            del speculative_menus[chat_id]
+
+    task.add_done_callback(on_done)
+
+async def take_speculative_menu(chat_id: int, cache_key: str):
+    """Returns the chat's speculative menu for this key, waiting for it if still running.
+
+    Returns None if there is no usable speculation, so the caller generates normally.
+    """
+    slot = speculative_menus.pop(chat_id, None)
+    if slot is None:
+        return None
+    key, task = slot
+    if key != cache_key:
+        task.cancel()
+        return None
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if task.cancelled():
+            return None
+        raise
+    except Exception:
+        return None
+
+def build_local_menu(prompt_inputs: dict) -> tuple:
+    """Plans a menu with the local recipe planner and caches it. Returns (menu, cache key)."""
+    cache_key = menu_cache_key(prompt_inputs, LOCAL_MENU_MODEL, PLANNER_VERSION)
+    with LOCAL_MENU_SECONDS.time():
+        menu = local_planner.plan(prompt_inputs, MENU_DAYS)
+    # Cached like AI menus, so an evicted menu can be reloaded without a menu store
+    menu_cache.put(cache_key, menu)
+    return menu, cache_key
+
+async def show_local_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt_inputs: dict,
+                          notice: str = None):
+    """Shows a menu from the local planner, either as the menu engine or in place of a failed AI generation.
+
+    For a fallback, `notice` tells the user why. Days the AI already streamed
+    are kept, and only the rest of the week is planned locally.
+    """
+    chat_id = update.effective_chat.id
+    context.user_data['menu_generating'] = False
+    streamed = context.user_data.get('menu_data')
+    streamed_days = streamed.to_dicts() if streamed else []
+    local_menu, cache_key = build_local_menu(prompt_inputs)
+    menu = streamed_days + local_menu[len(streamed_days):]
+    MENUS_SERVED.inc(source="local" if notice is None else "local_fallback")
+    print(f"Local menu for chat_id: {chat_id} ({len(streamed_days)} streamed days kept)")
+
+    if streamed_days:
+        # A mix of AI and local days matches neither cache key; the menu store keeps it
+        cache_key = None
+    context.user_data['menu_key'] = cache_key
+    await save_menu(context, chat_id, prompt_inputs, menu, cache_key)
+
+    if streamed_days:
+        context.user_data['menu_data'] = CompactMenu(menu)
+        menu_pages(context, context.user_data['menu_data'])
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"{notice}\n\n"
+                 "The days you've already seen came from the AI, "
+                 "and I've planned the rest of the week from my recipe book. 📖"
+        )
+        if context.user_data.get('menu_message_id') == update.effective_message.message_id:
+            await display_menu_page(update, context, context.user_data.get('current_menu_page', 0))
+        return
+
+    intro = (f"{notice}\n\nSo I've planned your week from my own recipe book instead, "
+             "portioned to your calorie target. 📖\n") if notice else "🎉 **Your Personalized Menu is Ready!** 🎉\n\n"
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"{intro}"
+             "I've created a balanced 7-day meal plan just for you!\n"
+             "Use the navigation buttons to explore each day. 📅"
+    )
+    await show_generated_menu(update, context, menu)
+
 async def generate_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Generates a weekly meal plan using AI."""
     query = update.callback_query
-    await query.answer()
+    chat_id = update.effective_chat.id
 
-    if not client:
-        await query.edit_message_text(
-            text="❌ Sorry, the AI service is currently unavailable.\n\n"
-                 "Please try again later! 😔"
-        )
+    if chat_id in generating_chats:
+        await query.answer("⏳ Your menu is already being prepared, please wait!")
         return
+    await query.answer()
+
+    generating_chats.add(chat_id)
+    try:
+        await generate_menu_for_chat(update, context)
+    finally:
+        generating_chats.discard(chat_id)
+
+async def generate_menu_for_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Finds or generates a menu for the chat's latest profile and shows it."""
+    query = update.callback_query
 
     # Get the latest user data
     user_data = get_latest_user_data(update.effective_chat.id)
@@ -590,57 +1087,82 @@ async def generate_menu_callback(update: Update, context: ContextTypes.DEFAULT_T
         await send_main_menu(update, context)
         return
 
-    # Show generating message
+    prompt_inputs = build_menu_prompt_inputs(user_data)
+    if MENU_ENGINE == "local":
+        await show_local_menu(update, context, prompt_inputs)
+        return
+
+    cache_key = menu_cache_key(prompt_inputs, MENU_CACHE_MODELS, MENU_SYSTEM_PROMPT_VERSION)
+    # Lets an evicted menu be reloaded from the cache when the user pages through it again
+    context.user_data['menu_key'] = cache_key
+    cached_menu = menu_cache.get(cache_key)
+    if cached_menu:
+        print(f"Menu cache hit for chat_id: {update.effective_chat.id} {menu_cache.stats()}")
+        speculative_menus.pop(update.effective_chat.id, None)
+        MENUS_SERVED.inc(source="cache")
+        await save_menu(context, update.effective_chat.id, prompt_inputs, cached_menu, cache_key)
+        await show_generated_menu(update, context, cached_menu)
+        return
+
+    if client and not client.available():
+        # Fail fast instead of queueing behind requests to a service known to be failing
+        print(f"AI circuit breaker open, not generating for chat_id: {update.effective_chat.id} {client.stats()}")
+        if MENU_LOCAL_FALLBACK:
+            await show_local_menu(update, context, prompt_inputs, "⚠️ The AI service is having trouble right now.")
+            return
+    if not client and MENU_LOCAL_FALLBACK:
+        await show_local_menu(update, context, prompt_inputs, "🤖 The AI service isn't configured right now.")
+        return
+    if not client or not client.available():
+        await query.edit_message_text(
+            text="❌ Sorry, the AI service is currently unavailable.\n\n"
+                 "Please try again later! 😔"
+        )
+        return
+
+    # Show generating message with the current queue position and expected wait
+    ahead, wait_seconds = inference_scheduler.estimate()
+    speculation = speculative_menus.get(update.effective_chat.id)
+    if speculation and speculation[0] == cache_key:
+        wait_text = "I started on it while you were reading your results - almost there! ⏳"
+    elif ahead:
+        wait_text = (
+            f"👥 You're #{ahead + 1} in line.\n"
+            f"This may take about {format_wait(wait_seconds)}. Please wait! ⏳"
+        )
+    else:
+        wait_text = f"This may take about {format_wait(wait_seconds)}. Please wait! ⏳"
     await query.edit_message_text(
         text="🤖 **Creating Your Personalized Menu** 🤖\n\n"
              "🔄 Analyzing your profile...\n"
              "🥗 Designing balanced meals...\n"
              "📊 Calculating portions...\n\n"
-             "This may take 30-60 seconds. Please wait! ⏳"
+             f"{wait_text}"
     )
 
     # Send typing action
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
 
-    system_prompt = (
-        "You are a professional nutritionist creating personalized 7-day meal plans. "
-        "Create a JSON response with a 'menu' key containing an array of 7 day objects. "
-        "Each day object must have: day, calories, macronutrients, breakfast, snack1, lunch, snack2, dinner. "
-        "Make meals practical, detailed with portions and calories, balanced and realistic for home cooking. "
-        "Adjust calories based on goals: deficit for weight loss, surplus for weight gain. "
-        "RESPOND ONLY WITH VALID JSON - NO OTHER TEXT."
-    )
-
-    user_message = (
-        f"Create a meal plan for:\n"
-        f"Gender: {user_data['sex']}\n"
-        f"Age: {int(user_data['age'])}\n"
-        f"Height: {int(user_data['height'])} cm\n"
-        f"Weight: {int(user_data['weight'])} kg\n"
-        f"Activity: {user_data['activity']}\n"
-        f"Goal: {user_data['goal']}\n"
-        f"Target calories: {user_data.get('calories', 2000)}"
-    )
+    async def on_day(days: list):
+        await show_streamed_days(update, context, days)
 
+    context.user_data['menu_data'] = CompactMenu()
+    context.user_data['menu_generating'] = True
     try:
-        response = await asyncio.to_thread(
-            client.complete,
-            messages=[
-                SystemMessage(system_prompt),
-                UserMessage(user_message)
-            ],
-            model="openai/gpt-4.1-nano",
-            temperature=0.7,
-        )
-
-        ai_response_content = response.choices[0].message.content
-        menu_data = json.loads(ai_response_content)
-
-        # Store menu for pagination
-        context.user_data['menu_data'] = menu_data.get('menu', [])
-        context.user_data['current_menu_day'] = 0
+        menu = await take_speculative_menu(update.effective_chat.id, cache_key)
+        if menu is None:
+            menu = await menu_generation.run(
+                cache_key,
+                lambda: inference_scheduler.submit(
+                    update.effective_chat.id, lambda: generate_menu(prompt_inputs, cache_key, on_day)
+                ),
+            )
+        context.user_data['menu_generating'] = False
 
-        if not context.user_data['menu_data']:
+        if not menu and MENU_LOCAL_FALLBACK:
+            await show_local_menu(update, context, prompt_inputs, "⚠️ The AI couldn't put a menu together this time.")
+            return
+        if not menu:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text="❌ Sorry, I couldn't generate your menu right now.\n\n"
@@ -649,6 +1171,24 @@ async def generate_menu_callback(update: Update, context: ContextTypes.DEFAULT_T
             await send_main_menu(update, context)
             return
 
+        print(
+            f"Menu cache miss for chat_id: {update.effective_chat.id} "
+            f"{menu_cache.stats()} {menu_generation.stats()}"
+        )
+        MENUS_SERVED.inc(source="ai")
+
+        await save_menu(context, update.effective_chat.id, prompt_inputs, menu, cache_key)
+
+        if context.user_data['menu_data']:
+            # Days were already shown while streaming; only the final length may differ
+            context.user_data['menu_data'] = CompactMenu(menu)
+            # Pre-render every page now, so paging through the menu is a lookup
+            menu_pages(context, context.user_data['menu_data'])
+            if (len(menu) != MENU_DAYS
+                    and context.user_data.get('menu_message_id') == update.effective_message.message_id):
+                await display_menu_page(update, context, context.user_data.get('current_menu_page', 0))
+            return
+
         # Success message before showing menu
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -657,10 +1197,26 @@ async def generate_menu_callback(update: Update, context: ContextTypes.DEFAULT_T
                  "Use the navigation buttons to explore each day. 📅"
         )
 
-        await display_menu_page(update, context, 0)
+        await show_generated_menu(update, context, menu)
+
+    except InferenceQueueFull as e:
+        print(f"Menu generation rejected: {e} {inference_scheduler.stats()}")
+        if MENU_LOCAL_FALLBACK:
+            await show_local_menu(update, context, prompt_inputs, "🚦 **The AI is very busy right now** 🚦")
+            return
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="🚦 **I'm very busy right now** 🚦\n\n"
+                 "Lots of people are creating meal plans at the moment.\n"
+                 "💡 **Please try again in a few minutes!**"
+        )
+        await send_main_menu(update, context, "Let's try again later! 🔄")
 
     except (Exception, json.JSONDecodeError) as e:
-        print(f"Menu generation error: {e}")
+        print(f"Menu generation error: {e} {client.stats()}")
+        if MENU_LOCAL_FALLBACK:
+            await show_local_menu(update, context, prompt_inputs, "⚠️ The AI service isn't responding right now.")
+            return
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="❌ **Oops! Something went wrong** 😔\n\n"
@@ -671,51 +1227,207 @@ async def generate_menu_callback(update: Update, context: ContextTypes.DEFAULT_T
         )
         await send_main_menu(update, context, "Let's try again later! 🔄")
 
-async def display_menu_page(update: Update, context: ContextTypes.DEFAULT_TYPE, day_index: int):
-    """Displays a single day of the menu with navigation."""
+    finally:
+        context.user_data['menu_generating'] = False
+
+async def save_menu(context: ContextTypes.DEFAULT_TYPE, chat_id: int, prompt_inputs: dict, menu: list, cache_key: str):
+    """Saves a menu shown to a chat in the menu store and remembers its generation id."""
+    if not menu_store:
+        return
+    try:
+        with STORE_SECONDS.time(operation="menu_save"):
+            generation_id = await asyncio.to_thread(
+                menu_store.save, chat_id, prompt_inputs, [dict(day) for day in menu], cache_key
+            )
+        context.user_data['menu_generation_id'] = generation_id
+    except Exception as e:
+        print(f"Could not save menu for chat_id {chat_id}: {e}")
+
+async def load_menu(context: ContextTypes.DEFAULT_TYPE, chat_id: int, latest: bool = False,
+                    generation_id: int = None):
+    """Restores a menu that is no longer in memory: evicted, lost in a restart or paged from an old message.
+
+    Looks in the menu store first (by `generation_id`, the session's generation
+    id, or the chat's latest menu), then in the menu cache. Returns the stored
+    record, or None.
+    """
+    if context.user_data.get('menu_generating'):
+        return None
+    record = None
+    requested = generation_id
+    if menu_store:
+        if generation_id is None and not latest:
+            generation_id = context.user_data.get('menu_generation_id')
+        with STORE_SECONDS.time(operation="menu_get"):
+            record = await asyncio.to_thread(menu_store.get, chat_id, generation_id)
+    # The cached menu is the session's, not necessarily the requested one
+    if record is None and not latest and requested is None and context.user_data.get('menu_key'):
+        menu = menu_cache.get(context.user_data['menu_key'])
+        if menu:
+            record = {"menu": menu, "cache_key": context.user_data['menu_key']}
+    if record is None:
+        return None
+    context.user_data['menu_data'] = CompactMenu(record["menu"])
+    context.user_data['menu_key'] = record.get("cache_key")
+    if record.get("generation_id"):
+        context.user_data['menu_generation_id'] = record["generation_id"]
+    return record
+
+# Meal fields in display order, with their emoji and label
+MENU_MEALS = (
+    ("breakfast", "🥞", "Breakfast"),
+    ("snack1", "🍎", "Morning snack"),
+    ("lunch", "🍽️", "Lunch"),
+    ("snack2", "🥨", "Afternoon snack"),
+    ("dinner", "🍖", "Dinner"),
+)
+
+def render_day_texts(day_menu, day_index: int) -> list:
+    """Formats one day of a menu, split into several texts if it exceeds Telegram's message limit."""
+    limit = MessageLimit.MAX_TEXT_LENGTH
+    day_name = day_menu.get('day', f'Day {day_index + 1}')
+    header = (
+        f"📅 **{day_name}**\n"
+        f"🔥 **{day_menu.get('calories', 'N/A')} calories**\n"
+        f"📊 **{day_menu.get('macronutrients', 'N/A')}**\n"
+    )[:limit // 2]
+    continued = f"📅 **{day_name} (continued)**\n"[:limit // 2]
+    blocks = [
+        f"\n{emoji} **{label}:**\n{day_menu.get(meal_key)}\n"
+        for meal_key, emoji, label in MENU_MEALS if day_menu.get(meal_key)
+    ]
+
+    texts = []
+    current, filled = header, False
+    for block in blocks:
+        while len(current) + len(block) > limit:
+            if filled:
+                texts.append(current)
+                current, filled = continued, False
+            else:
+                # A single meal too long for one message is cut where the message is full
+                room = limit - len(current)
+                texts.append(current + block[:room])
+                block = block[room:]
+                current = continued
+        current += block
+        filled = True
+    texts.append(current)
+    return texts
+
+def menu_callback_data(action: str, generation_id: int, *fields) -> str:
+    """Callback data for a button acting on a menu, naming the menu if it has been saved.
+
+    The generation id goes right after the action: "menu_page:<generation id>:<page>".
+    """
+    if generation_id:
+        fields = (generation_id,) + fields
+    return ":".join([action] + [str(field) for field in fields])
+
+def split_menu_callback(data: str, field_count: int) -> tuple:
+    """Splits callback data built by `menu_callback_data` into (action, generation id or None, fields)."""
+    action, *fields = data.split(":")
+    generation_id = int(fields.pop(0)) if len(fields) > field_count else None
+    return action, generation_id, fields
+
+async def switch_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, generation_id: int) -> bool:
+    """Makes the menu a button was sent with the session's menu, loading it if it is an older one.
+
+    Returns False, after telling the user, if that menu can't be shown.
+    """
+    if not generation_id or generation_id == context.user_data.get('menu_generation_id'):
+        return True
+    # A button on an older menu's message: act on that menu, not the latest one
+    if update.effective_chat.id in generating_chats:
+        await send_main_menu(update, context, "⏳ Your new menu is still being prepared, please wait!")
+        return False
+    if await load_menu(context, update.effective_chat.id, generation_id=generation_id) is None:
+        await send_main_menu(update, context, "Menu data not found. Let's start over! 🔄")
+        return False
+    return True
+
+def render_menu_pages(menu: CompactMenu, total_days: int, editable: bool = True, generation_id: int = None) -> list:
+    """Renders every page of a menu as (day index, text, keyboard), one or more pages per day.
+
+    With `editable`, each page offers to regenerate its day or swap one of its meals.
+    With `generation_id`, the buttons name the stored menu, so they keep paging
+    through and editing it after a newer menu has been made.
+
+    Texts are kept UTF-8 encoded: the emoji would make Python store them with
+    four bytes per character.
+    """
+    day_pages = [(day_index, render_day_texts(day_menu, day_index)) for day_index, day_menu in enumerate(menu)]
+    page_count = sum(len(texts) for _, texts in day_pages)
+
+    pages = []
+    for day_index, texts in day_pages:
+        for part, text in enumerate(texts):
+            page_index = len(pages)
+            nav_row = []
+            if page_index > 0:
+                nav_row.append(InlineKeyboardButton(
+                    "◀️ Previous Day", callback_data=menu_callback_data("menu_page", generation_id, page_index - 1)
+                ))
+            if page_index < page_count - 1:
+                nav_row.append(InlineKeyboardButton(
+                    "Next Day ▶️", callback_data=menu_callback_data("menu_page", generation_id, page_index + 1)
+                ))
+            elif day_index < total_days - 1:
+                nav_row.append(InlineKeyboardButton(f"⏳ Day {day_index + 2} generating…", callback_data="noop"))
+
+            # Progress indicator
+            progress_text = f"📍 Day {day_index + 1} of {total_days}"
+            if len(texts) > 1:
+                progress_text += f" ({part + 1}/{len(texts)})"
+            keyboard = [nav_row] if nav_row else []
+            if editable:
+                keyboard.append([
+                    InlineKeyboardButton(
+                        "🔄 New day", callback_data=menu_callback_data("menu_regen_day", generation_id, day_index)
+                    ),
+                    InlineKeyboardButton(
+                        "🔁 Swap a meal",
+                        callback_data=menu_callback_data("menu_swap", generation_id, day_index, page_index),
+                    ),
+                ])
+            keyboard.append([InlineKeyboardButton(progress_text, callback_data="noop")])
+            keyboard.append([InlineKeyboardButton("🏠 Back to Main Menu", callback_data="back_to_main")])
+            pages.append((day_index, text.encode("utf-8"), InlineKeyboardMarkup(keyboard)))
+    return pages
+
+def menu_pages(context: ContextTypes.DEFAULT_TYPE, menu: CompactMenu) -> list:
+    """Returns the menu's rendered pages, rendering them only if the menu changed since last time."""
+    # While a menu is still streaming in, days that haven't arrived yet are shown as pending
+    total_days = len(menu)
+    generating = bool(context.user_data.get('menu_generating'))
+    if generating:
+        total_days = max(total_days, MENU_DAYS)
+    # Days can't be changed while the menu is still being generated
+    generation_id = context.user_data.get('menu_generation_id')
+    layout = (total_days, not generating, generation_id)
+    if menu.pages is None or menu.pages[0] != layout:
+        menu.pages = (
+            layout, render_menu_pages(menu, total_days, editable=not generating, generation_id=generation_id)
+        )
+    return menu.pages[1]
+
+async def display_menu_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page_index: int,
+                            new_message: bool = False):
+    """Displays one pre-rendered page of the menu with navigation, editing the current message unless `new_message`."""
+    if not context.user_data.get('menu_data'):
+        await load_menu(context, update.effective_chat.id)
     menu_data = context.user_data.get('menu_data')
-    if not menu_data or day_index < 0 or day_index >= len(menu_data):
+    pages = menu_pages(context, menu_data) if menu_data else []
+    if page_index < 0 or page_index >= len(pages):
         await send_main_menu(update, context, "Menu data not found. Let's start over! 🔄")
         return
 
-    day_menu = menu_data[day_index]
-    
-    # Format the daily menu
-    day_text = f"📅 **{day_menu.get('day', f'Day {day_index + 1}')}**"
-    calories_text = f"🔥 **{day_menu.get('calories', 'N/A')} calories**"
-    macros_text = f"📊 **{day_menu.get('macronutrients', 'N/A')}**"
-    
-    meals_text = ""
-    meal_emojis = {"breakfast": "🥞", "snack1": "🍎", "lunch": "🍽️", "snack2": "🥨", "dinner": "🍖"}
-    
-    for meal_key, emoji in meal_emojis.items():
-        meal_content = day_menu.get(meal_key, "")
-        if meal_content:
-            meal_name = meal_key.replace("snack1", "Morning Snack").replace("snack2", "Afternoon Snack").capitalize()
-            meals_text += f"\n{emoji} **{meal_name}:**\n{meal_content}\n"
-    
-    message_text = f"{day_text}\n{calories_text}\n{macros_text}\n{meals_text}"
-    
-    # Navigation buttons
-    keyboard = []
-    nav_row = []
-    
-    if day_index > 0:
-        nav_row.append(InlineKeyboardButton("◀️ Previous Day", callback_data="menu_prev"))
-    if day_index < len(menu_data) - 1:
-        nav_row.append(InlineKeyboardButton("Next Day ▶️", callback_data="menu_next"))
-    
-    if nav_row:
-        keyboard.append(nav_row)
-    
-    # Progress indicator
-    progress_text = f"📍 Day {day_index + 1} of {len(menu_data)}"
-    keyboard.append([InlineKeyboardButton(progress_text, callback_data="noop")])
-    keyboard.append([InlineKeyboardButton("🏠 Back to Main Menu", callback_data="back_to_main")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    _, encoded_text, reply_markup = pages[page_index]
+    message_text = encoded_text.decode("utf-8")
 
     try:
+        if new_message:
+            raise ValueError("a new message was requested")
         await context.bot.edit_message_text(
             chat_id=update.effective_chat.id,
             message_id=update.effective_message.message_id,
@@ -723,31 +1435,269 @@ async def display_menu_page(update: Update, context: ContextTypes.DEFAULT_TYPE,
             reply_markup=reply_markup,
             parse_mode='Markdown'
         )
+        context.user_data['menu_message_id'] = update.effective_message.message_id
     except Exception:
         # If edit fails, send new message
-        await context.bot.send_message(
+        message = await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=message_text,
             reply_markup=reply_markup,
             parse_mode='Markdown'
         )
+        context.user_data['menu_message_id'] = message.message_id
 
 async def menu_navigation_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles menu navigation (next/previous day)."""
     query = update.callback_query
     await query.answer()
 
-    current_day = context.user_data.get('current_menu_day', 0)
+    current_page = context.user_data.get('current_menu_page', 0)
+    generation_id = None
     
-    if query.data == "menu_next":
-        current_day += 1
+    if query.data.startswith("menu_page:"):
+        # Buttons carry their menu and target page, so they keep working on old messages and after restarts
+        _, generation_id, (page,) = split_menu_callback(query.data, 1)
+        current_page = int(page)
+    elif query.data == "menu_next":
+        current_page += 1
     elif query.data == "menu_prev":
-        current_day -= 1
+        current_page -= 1
     elif query.data == "noop":
         return  # Do nothing for progress indicator
+
+    if not await switch_to_menu(update, context, generation_id):
+        return
     
-    context.user_data['current_menu_day'] = current_day
-    await display_menu_page(update, context, current_day)
+    context.user_data['current_menu_page'] = current_page
+    await display_menu_page(update, context, current_page)
+
+async def last_plan_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the chat's most recently saved menu again, without calling the AI."""
+    query = update.callback_query
+    await query.answer()
+
+    if update.effective_chat.id in generating_chats:
+        await send_main_menu(update, context, "⏳ Your new menu is still being prepared, please wait!")
+        return
+
+    record = await load_menu(context, update.effective_chat.id, latest=True)
+    if record is None:
+        await send_main_menu(update, context, "📋 You don't have a saved meal plan yet.\n\nLet's create one! 🗓️")
+        return
+
+    profile = record["profile"]
+    created = datetime.datetime.fromtimestamp(record["created_at"]).strftime("%d %b %Y")
+    await query.edit_message_text(
+        text=f"📋 **Your meal plan from {created}**\n\n"
+             f"Built for {profile['weight']} kg, goal: {profile['goal']}, "
+             f"{profile['calories']} kcal per day.",
+        parse_mode='Markdown'
+    )
+    context.user_data['current_menu_page'] = 0
+    await display_menu_page(update, context, 0, new_message=True)
+
+def summarize_menu(menu, skip_day: int) -> str:
+    """The dishes of every other day, one short line per day, as context for changing one day."""
+    lines = []
+    for index, day in enumerate(menu):
+        if index != skip_day and day:
+            dishes = " | ".join(
+                recipe_name(day.get(meal)).split("(", 1)[0].strip()[:60]
+                for meal, _, _ in MENU_MEALS if day.get(meal)
+            )
+            lines.append(f"{day.get('day', f'Day {index + 1}')}: {dishes}")
+    return "\n".join(lines)
+
+def menu_output(verbose_prompt: str, compact_prompt: str, schema_name: str, schema: dict) -> tuple:
+    """The system prompt and extra request parameters for the configured menu output format."""
+    if not MENU_COMPACT_OUTPUT:
+        return verbose_prompt, {}
+    if not MENU_STRUCTURED_OUTPUT:
+        return compact_prompt, {}
+    return compact_prompt, {"response_format": response_format(schema_name, schema)}
+
+async def request_menu_json(system_prompt: str, user_message: str, **params) -> dict:
+    """Sends a small menu prompt to the AI model and returns the decoded JSON object.
+
+    Text around the object is ignored.
+    """
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+    # Edits and repairs are small and can go to a cheaper model
+    response = await client.complete(messages=messages, low_priority=True, temperature=0.8, **params)
+    content = response["choices"][0]["message"]["content"]
+    result, _ = json.JSONDecoder().raw_decode(content, max(content.find("{"), 0))
+    if not isinstance(result, dict):
+        raise MenuFormatError("the AI didn't answer with a JSON object")
+    return result
+
+async def complete_menu_json(chat_id: int, system_prompt: str, user_message: str) -> dict:
+    """Sends a small menu prompt through the inference scheduler and returns the decoded JSON object."""
+    return await inference_scheduler.submit(chat_id, lambda: request_menu_json(system_prompt, user_message))
+
+async def request_menu_day(prompt_inputs: dict, menu, day_index: int, day_name: str) -> dict:
+    """Asks the AI model for one day of a plan, different from the other days of `menu`, and validates it."""
+    system_prompt, params = menu_output(
+        MENU_DAY_SYSTEM_PROMPT, MENU_DAY_COMPACT_SYSTEM_PROMPT, "menu_day", COMPACT_DAY_SCHEMA
+    )
+    day = await request_menu_json(
+        system_prompt,
+        f"Profile:\n{format_profile_prompt(prompt_inputs)}\n\n"
+        f"Rest of the plan:\n{summarize_menu(menu, day_index)}\n\n"
+        f"Create a new plan for {day_name}.",
+        **params,
+    )
+    days = day.get('m', day.get('menu'))
+    if isinstance(days, list) and days:
+        day = days[0]  # Answered in the shape of a full plan
+    day = normalize_day(day)
+    day['day'] = day_name
+    return day
+
+async def regenerate_menu_day(chat_id: int, prompt_inputs: dict, menu: CompactMenu, day_index: int) -> tuple:
+    """Generates a replacement for one day of a menu. Returns (day dict, source)."""
+    day_name = menu[day_index].get('day', f'Day {day_index + 1}')
+    if MENU_ENGINE != "local" and client:
+        try:
+            day = await inference_scheduler.submit(
+                chat_id, lambda: request_menu_day(prompt_inputs, menu, day_index, day_name)
+            )
+            return day, "ai"
+        except Exception as e:
+            if not MENU_LOCAL_FALLBACK:
+                raise
+            print(f"Day regeneration failed for chat_id {chat_id}, using the local planner: {e}")
+    return local_planner.replan_day(prompt_inputs, menu, day_index, random.Random()), "local"
+
+async def swap_menu_meal(chat_id: int, prompt_inputs: dict, menu: CompactMenu, day_index: int, meal: str) -> tuple:
+    """Generates a different dish for one meal of a menu day. Returns (meal text, source)."""
+    day = menu[day_index]
+    if MENU_ENGINE != "local" and client:
+        try:
+            meals = "\n".join(f"{key}: {day.get(key)}" for key, _, _ in MENU_MEALS if day.get(key))
+            result = await complete_menu_json(
+                chat_id,
+                MENU_MEAL_SYSTEM_PROMPT,
+                f"Profile:\n{format_profile_prompt(prompt_inputs)}\n\n"
+                f"The day:\n{meals}\n\n"
+                f"Meal to replace: {meal}",
+            )
+            text = result.get(meal)
+            if not isinstance(text, str) or not text.strip():
+                raise ValueError(f"the AI's answer has no {meal}")
+            return text.strip(), "ai"
+        except Exception as e:
+            if not MENU_LOCAL_FALLBACK:
+                raise
+            print(f"Meal swap failed for chat_id {chat_id}, using the local planner: {e}")
+    return local_planner.swap_meal(prompt_inputs, day, meal, random.Random()), "local"
+
+async def save_menu_edit(context: ContextTypes.DEFAULT_TYPE, chat_id: int, menu: CompactMenu):
+    """Saves a menu changed in place, so a reload after eviction or a restart shows the change."""
+    days = menu.to_dicts()
+    generation_id = context.user_data.get('menu_generation_id')
+    if menu_store and generation_id:
+        try:
+            with STORE_SECONDS.time(operation="menu_update"):
+                await asyncio.to_thread(menu_store.update, generation_id, days)
+            return
+        except Exception as e:
+            print(f"Could not save menu edit for chat_id {chat_id}: {e}")
+    # The cached original may be shared with other chats, so the edited menu gets its own entry
+    cache_key = menu_cache_key({"chat_id": chat_id, "menu": days}, MENU_CACHE_MODELS, MENU_SYSTEM_PROMPT_VERSION)
+    menu_cache.put(cache_key, days)
+    context.user_data['menu_key'] = cache_key
+
+def first_page_of_day(context: ContextTypes.DEFAULT_TYPE, menu: CompactMenu, day_index: int) -> int:
+    return next(index for index, page in enumerate(menu_pages(context, menu)) if page[0] == day_index)
+
+async def menu_edit_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Regenerates one day of the shown menu or swaps one of its meals, patching the menu in place."""
+    query = update.callback_query
+    chat_id = update.effective_chat.id
+    field_count = 1 if query.data.startswith("menu_regen_day:") else 2
+    action, generation_id, (day_text, *rest) = split_menu_callback(query.data, field_count)
+    day_index = int(day_text)
+    if action == "menu_swap_meal" and rest[0] not in MEAL_FIELDS:
+        await query.answer()
+        return
+
+    if chat_id in generating_chats:
+        await query.answer("⏳ I'm still working on your menu, please wait!")
+        return
+    # Edits the menu whose message the button is on
+    if not await switch_to_menu(update, context, generation_id):
+        await query.answer()
+        return
+    if not context.user_data.get('menu_data'):
+        await load_menu(context, chat_id)
+    menu_data = context.user_data.get('menu_data')
+    if not menu_data or day_index >= len(menu_data):
+        await query.answer()
+        await send_main_menu(update, context, "Menu data not found. Let's start over! 🔄")
+        return
+
+    if action == "menu_swap":
+        # Only asks which meal to swap
+        await query.answer()
+        day = menu_data[day_index]
+        generation_id = context.user_data.get('menu_generation_id')
+        keyboard = [
+            [InlineKeyboardButton(
+                f"{emoji} {label}",
+                callback_data=menu_callback_data("menu_swap_meal", generation_id, day_index, meal_key),
+            )]
+            for meal_key, emoji, label in MENU_MEALS if day.get(meal_key)
+        ]
+        back_data = menu_callback_data("menu_page", generation_id, int(rest[0]))
+        keyboard.append([InlineKeyboardButton("◀️ Back", callback_data=back_data)])
+        await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    user_data = get_latest_user_data(chat_id)
+    if not user_data:
+        await query.answer("❌ I couldn't find your profile data.")
+        return
+    prompt_inputs = build_menu_prompt_inputs(user_data)
+    day_name = menu_data[day_index].get('day', f'Day {day_index + 1}')
+    if action == "menu_regen_day":
+        kind, status = "day", f"🔄 Planning a new {day_name}…"
+    else:
+        meal = rest[0]
+        label = next((label for key, _, label in MENU_MEALS if key == meal), meal)
+        kind, status = "meal", f"🔁 Finding a new {label.lower()} for {day_name}…"
+    await query.answer()
+
+    generating_chats.add(chat_id)
+    try:
+        if MENU_ENGINE != "local" and client and client.available():
+            await query.edit_message_text(text=f"{status}\n\nThis takes just a few seconds. ⏳")
+        if kind == "day":
+            day, source = await regenerate_menu_day(chat_id, prompt_inputs, menu_data, day_index)
+        else:
+            text, source = await swap_menu_meal(chat_id, prompt_inputs, menu_data, day_index, meal)
+            day = menu_data[day_index].to_dict()
+            day[meal] = text
+        # The menu may have been replaced or evicted while waiting for the AI
+        if context.user_data.get('menu_data') is menu_data:
+            menu_data.replace(day_index, day)
+            await save_menu_edit(context, chat_id, menu_data)
+            MENU_EDITS.inc(kind=kind, source=source)
+        page_index = first_page_of_day(context, menu_data, day_index)
+    except Exception as e:
+        print(f"Menu edit error for chat_id {chat_id}: {e}")
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="❌ Sorry, I couldn't change your menu right now.\n\nYour plan is unchanged. 🔄"
+        )
+        page_index = first_page_of_day(context, menu_data, day_index)
+    finally:
+        generating_chats.discard(chat_id)
+
+    context.user_data['current_menu_page'] = page_index
+    await display_menu_page(update, context, page_index)
 
 async def back_to_main_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Returns to main menu."""
@@ -783,50 +1733,391 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         print(f"Error in error handler: {e}")
 
-def main():
-    """Main function to run the bot."""
-    if not BOT_TOKEN:
-        print("❌ Error: TELEGRAM_BOT_TOKEN not found in environment variables.")
-        print("Please add TELEGRAM_BOT_TOKEN to your .env file.")
-        return
-    
-    initialize_csv()
-    
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+async def run_periodic_compaction():
+    """Compacts the profile store every PROFILE_COMPACT_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(PROFILE_COMPACT_INTERVAL)
+        try:
+            store = profile_store
+            if isinstance(store, WriteBehindProfileStore):
+                await store.flush()
+                store = store.backend
+            with STORE_SECONDS.time(operation="compact"):
+                stats = await asyncio.to_thread(store.compact, PROFILE_COMPACT_KEEP_HISTORY)
+            print(format_compaction_report(stats))
+        except Exception as e:
+            print(f"Profile compaction error: {e}")
+
+async def run_session_sweeps(application: Application):
+    """Trims idle sessions every SESSION_SWEEP_INTERVAL seconds until cancelled."""
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            print(f"Session sweep: {session_janitor.sweep(application)}")
+        except Exception as e:
+            print(f"Session sweep error: {e}")
+
+async def on_startup(application: Application):
+    """Starts background tasks once the event loop is running."""
+    # Generations restored from the state store died with the previous process
+    for user_data in application.user_data.values():
+        user_data.pop('menu_generating', None)
+    if isinstance(profile_store, WriteBehindProfileStore):
+        profile_store.start()
+    if PROFILE_COMPACT_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(run_periodic_compaction()))
+    if SESSION_SWEEP_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(run_session_sweeps(application)))
+    if METRICS_PORT:
+        background_tasks.append(asyncio.create_task(metrics.serve(METRICS_HOST, METRICS_PORT)))
+    if METRICS_DUMP_FILE:
+        background_tasks.append(
+            asyncio.create_task(metrics.dump_periodically(METRICS_DUMP_FILE, METRICS_DUMP_INTERVAL))
+        )
+
+async def on_shutdown(application: Application):
+    """Flushes pending writes and releases resources on shutdown."""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    for _, task in speculative_menus.values():
+        task.cancel()
+    speculative_menus.clear()
+    if isinstance(profile_store, WriteBehindProfileStore):
+        await profile_store.stop()
+    profile_store.close()
+    if menu_store:
+        menu_store.close()
+    if client:
+        await client.aclose()
+
+def build_application(builder=None) -> Application:
+    """Builds the Application and registers all handlers.
+
+    A preconfigured ApplicationBuilder can be passed in (e.g. with a custom
+    request object for benchmarks); by default it uses BOT_TOKEN.
+    """
+    global update_processor, rate_limiter
+    if builder is None:
+        builder = Application.builder().token(BOT_TOKEN)
+    update_processor = ChatOrderedUpdateProcessor(max(1, UPDATE_CONCURRENCY))
+    builder = builder.concurrent_updates(update_processor)
+    if SEND_RATE_LIMIT:
+        rate_limiter = TokenBucketRateLimiter(
+            global_rate=SEND_GLOBAL_RATE,
+            chat_rate=SEND_CHAT_RATE,
+            chat_burst=SEND_CHAT_BURST,
+            group_rate=SEND_GROUP_RATE,
+            max_retries=SEND_MAX_RETRIES,
+        )
+        builder = builder.rate_limiter(rate_limiter)
+    if STATE_STORE_FILE:
+        builder = builder.persistence(SqliteStatePersistence(
+            STATE_STORE_FILE, WORKER_INDEX, WORKER_COUNT, update_interval=STATE_FLUSH_INTERVAL
+        ))
+    application = builder.post_init(on_startup).post_shutdown(on_shutdown).build()
     
+    # Activity tracking for idle-session eviction, runs before the handlers below
+    application.add_handler(TypeHandler(Update, session_janitor.on_update), group=-1)
+
     # Command handlers
-    application.add_handler(CommandHandler('start', start_command))
+    application.add_handler(CommandHandler('start', instrument_handler(start_command)))
     
     # Main menu callbacks
-    application.add_handler(CallbackQueryHandler(main_menu_callback, pattern='^(fill_in|generate_menu)$'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(main_menu_callback), pattern='^(fill_in|generate_menu)$'))
     
     # Profile flow callbacks
-    application.add_handler(CallbackQueryHandler(sex_choice_callback, pattern='^sex_(male|female)$'))
-    application.add_handler(CallbackQueryHandler(activity_choice_callback, pattern='^activity_'))
-    application.add_handler(CallbackQueryHandler(goal_choice_callback, pattern='^goal_'))
-    application.add_handler(CallbackQueryHandler(use_existing_data_callback, pattern='^use_existing_data$'))
-    application.add_handler(CallbackQueryHandler(start_new_profile, pattern='^start_new_profile$'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(sex_choice_callback), pattern='^sex_(male|female)$'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(activity_choice_callback), pattern='^activity_'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(goal_choice_callback), pattern='^goal_'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(use_existing_data_callback), pattern='^use_existing_data$'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(start_new_profile), pattern='^start_new_profile$'))
     
     # Calculation and menu generation
-    application.add_handler(CallbackQueryHandler(calculate_calories_callback, pattern='^calculate_calories$'))
-    application.add_handler(CallbackQueryHandler(generate_menu_callback, pattern='^generate_menu_confirmed$'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(calculate_calories_callback), pattern='^calculate_calories$'))
+    # Generation doesn't block other updates, so users can page through streamed days meanwhile
+    application.add_handler(CallbackQueryHandler(instrument_handler(generate_menu_callback), pattern='^generate_menu_confirmed$', block=False))
     
     # Menu navigation
-    application.add_handler(CallbackQueryHandler(menu_navigation_callback, pattern='^menu_(next|prev|noop)$'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(menu_navigation_callback), pattern=r'^(menu_(next|prev)|menu_page:(\d+:)?\d+|noop)$'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(last_plan_callback), pattern='^last_plan$'))
+    application.add_handler(CallbackQueryHandler(
+        instrument_handler(menu_edit_callback),
+        pattern=r'^menu_(regen_day:(\d+:)?\d+|swap:(\d+:)?\d+:\d+|swap_meal:(\d+:)?\d+:\w+)$',
+        block=False,
+    ))
     
     # Navigation callbacks
-    application.add_handler(CallbackQueryHandler(back_to_main_callback, pattern='^back_to_main$'))
+    application.add_handler(CallbackQueryHandler(instrument_handler(back_to_main_callback), pattern='^back_to_main$'))
     
     # Text input handler
-    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text_input))
+    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), instrument_handler(handle_text_input)))
 
     # Error handler
     application.add_error_handler(error_handler)
+    return application
+
+async def run_webhook(application: Application):
+    """Serves updates from the embedded webhook server until SIGINT/SIGTERM, then drains."""
+    secret_token = WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32)
+    server = WebhookServer(application, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, secret_token)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(stop_signal, stop_event.set)
+        except NotImplementedError:
+            pass  # Not supported on Windows; Ctrl+C still raises KeyboardInterrupt
+
+    await application.initialize()
+    await on_startup(application)
+    try:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + server.path,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        await application.start()
+        await server.start()
+        print("Bot is running in webhook mode... 🤖")
+        await stop_event.wait()
+    finally:
+        print("Shutting down: draining webhook requests and pending updates...")
+        await server.stop()
+        if application.running:
+            # Processes everything already on the update queue before returning
+            await application.stop()
+        await application.shutdown()
+        await on_shutdown(application)
+
+def worker_env(index: int) -> dict:
+    """Environment overrides for worker `index` of the multi-process mode."""
+    env = {
+        "WORKERS": "1",
+        "WORKER_INDEX": str(index),
+        "WORKER_COUNT": str(WORKERS),
+        "BOT_MODE": "webhook",
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(WORKER_BASE_PORT + index),
+        "WEBHOOK_PATH": "/telegram",
+        "WEBHOOK_URL": "",
+        "WEBHOOK_SECRET_TOKEN": worker_secret_token,
+        "PROFILE_STORE_BACKEND": "sqlite",
+        "STATE_STORE_FILE": STATE_STORE_FILE or "bot_state.db",
+        # Only one process compacts the shared profile store
+        "PROFILE_COMPACT_INTERVAL": str(PROFILE_COMPACT_INTERVAL if index == 0 else 0),
+        # Telegram's limit is per bot, so the workers share it; per-chat limits hold since a chat stays on one worker
+        "SEND_GLOBAL_RATE": str(SEND_GLOBAL_RATE / WORKERS),
+        "METRICS_PORT": str(METRICS_PORT + index if METRICS_PORT else 0),
+    }
+    if METRICS_DUMP_FILE:
+        env["METRICS_DUMP_FILE"] = f"{METRICS_DUMP_FILE}.worker{index}"
+    return env
+
+async def run_sharded():
+    """Runs the front-end: receives updates and routes them to worker processes by chat id."""
+    worker_urls = [f"http://127.0.0.1:{WORKER_BASE_PORT + index}/telegram" for index in range(WORKERS)]
+    router = ShardRouter(worker_urls, worker_secret_token)
+    pool = WorkerPool(WORKERS, worker_env)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(stop_signal, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    server = None
+    poller = None
+    await router.start()
+    await pool.start()
+    try:
+        if BOT_MODE == "webhook":
+            secret_token = WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32)
+            server = ShardRouterServer(router, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, secret_token)
+            await server.start()
+            if WEBHOOK_URL:
+                async with Bot(BOT_TOKEN) as bot:
+                    await bot.set_webhook(
+                        url=WEBHOOK_URL.rstrip("/") + server.path,
+                        secret_token=secret_token,
+                        allowed_updates=Update.ALL_TYPES,
+                    )
+        else:
+            bot = Bot(BOT_TOKEN)
+            await bot.initialize()
+            poller = asyncio.create_task(poll_updates(bot, router))
+        print(f"Bot is running with {WORKERS} workers... 🤖")
+        await stop_event.wait()
+    finally:
+        print("Shutting down: routing queued updates, then stopping workers...")
+        if server is not None:
+            await server.stop()
+        if poller is not None:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+            await bot.shutdown()
+        await router.drain()
+        await pool.stop()
+        await router.stop()
+
+def main():
+    """Main function to run the bot."""
+    if not BOT_TOKEN:
+        print("❌ Error: TELEGRAM_BOT_TOKEN not found in environment variables.")
+        print("Please add TELEGRAM_BOT_TOKEN to your .env file.")
+        return
+    
+    if WORKERS > 1:
+        # Creates the shared database (importing any CSV history) before the workers open it
+        open_profile_store("sqlite", CSV_FILE_NAME, SQLITE_FILE_NAME, CSV_HEADERS).close()
+        if BOT_MODE == "webhook" and not WEBHOOK_URL and not WEBHOOK_SECRET_TOKEN:
+            print("❌ Error: webhook mode needs WEBHOOK_URL or WEBHOOK_SECRET_TOKEN.")
+            return
+        asyncio.run(run_sharded())
+        return
+
+    initialize_csv()
+    register_metrics()
+    
+    # Create application
+    application = build_application()
     
     # Run the bot
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL and not WEBHOOK_SECRET_TOKEN:
+            print("❌ Error: webhook mode needs WEBHOOK_URL or WEBHOOK_SECRET_TOKEN.")
+            print("Set WEBHOOK_URL to register the webhook, or WEBHOOK_SECRET_TOKEN if it is registered elsewhere.")
+            return
+        asyncio.run(run_webhook(application))
+        return
+
     print("Bot is running... 🤖")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+def compact_command(args: argparse.Namespace):
+    """Compacts the profile store once and prints how much it saved."""
+    global profile_store
+    profile_store = open_profile_store(
+        PROFILE_STORE_BACKEND, CSV_FILE_NAME, SQLITE_FILE_NAME, CSV_HEADERS
+    )
+    try:
+        stats = profile_store.compact(args.keep_history)
+        print(format_compaction_report(stats))
+    finally:
+        profile_store.close()
+
+def numpy_available(action: str) -> bool:
+    """Checked before bulk commands, so a missing install fails before any file is touched."""
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        print(f"❌ Error: {action} needs NumPy. Install it with: pip install numpy")
+        return False
+    return True
+
+def recalculate_command(args: argparse.Namespace):
+    """Recomputes the calorie target of every user's latest profile in bulk and saves it."""
+    if not numpy_available("recalculating"):
+        return
+    store = open_profile_store(PROFILE_STORE_BACKEND, CSV_FILE_NAME, SQLITE_FILE_NAME, CSV_HEADERS)
+    try:
+        stats = store.recalculate_calories(calculate_daily_calories_batch, chunk_size=args.chunk_size)
+    finally:
+        store.close()
+    rate = stats["rows_updated"] / stats["seconds"] if stats["seconds"] else 0
+    print(
+        f"Recalculated {stats['rows_updated']} profiles in {stats['seconds']:.2f} s "
+        f"({rate:,.0f} profiles/sec), {stats['rows_changed']} calorie targets changed."
+    )
+
+def snapshot_command(args: argparse.Namespace):
+    """Writes the columnar snapshot of the latest profiles."""
+    if not numpy_available("the snapshot"):
+        return
+    store = open_profile_store(PROFILE_STORE_BACKEND, CSV_FILE_NAME, SQLITE_FILE_NAME, CSV_HEADERS)
+    try:
+        schema = write_snapshot(store, args.output, chunk_size=args.chunk_size)
+    finally:
+        store.close()
+    print(f"Wrote snapshot of {schema['rows']} profiles to {args.output} in {schema['seconds']:.2f} s")
+
+def stats_command(args: argparse.Namespace):
+    """Prints aggregate profile statistics from the snapshot, writing it first if needed."""
+    if not numpy_available("stats"):
+        return
+    if args.refresh or not os.path.exists(os.path.join(args.snapshot, "schema.json")):
+        args.output = args.snapshot
+        snapshot_command(args)
+    try:
+        snapshot = ProfileSnapshot(args.snapshot)
+    except (OSError, ValueError) as e:
+        print(f"❌ Error: cannot read the snapshot in {args.snapshot}: {e}")
+        return
+    print(format_stats(snapshot.stats()))
+
+def parse_args():
+    """Parses command line arguments. Running without a command starts the bot."""
+    parser = argparse.ArgumentParser(description="Personal Nutrition Assistant Bot")
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser("run", help="Run the bot (default)")
+    run_parser.add_argument(
+        "--workers", type=int, default=None,
+        help="Number of worker processes; more than 1 routes updates to them by chat id"
+    )
+    compact_parser = subparsers.add_parser(
+        "compact",
+        help="Rewrite the profile store keeping only the latest row per user (stop the bot first with the csv backend)"
+    )
+    compact_parser.add_argument(
+        "--keep-history", type=int, default=0,
+        help="Number of older rows to keep per user in addition to the latest one"
+    )
+    recalculate_parser = subparsers.add_parser(
+        "recalculate",
+        help="Recompute the calorie target of every user's latest profile (stop the bot first with the csv backend)"
+    )
+    recalculate_parser.add_argument(
+        "--chunk-size", type=int, default=100000,
+        help="Number of rows processed at a time"
+    )
+    snapshot_parser = subparsers.add_parser(
+        "snapshot", help="Write the latest profile of every user to a columnar snapshot for analytics"
+    )
+    snapshot_parser.add_argument(
+        "--output", default=PROFILE_SNAPSHOT_DIR, help="Snapshot directory"
+    )
+    stats_parser = subparsers.add_parser(
+        "stats", help="Print goal, activity and calorie statistics from the profile snapshot"
+    )
+    stats_parser.add_argument(
+        "--snapshot", default=PROFILE_SNAPSHOT_DIR, help="Snapshot directory"
+    )
+    stats_parser.add_argument(
+        "--refresh", action="store_true", help="Write a fresh snapshot first"
+    )
+    for bulk_parser in (snapshot_parser, stats_parser):
+        bulk_parser.add_argument(
+            "--chunk-size", type=int, default=100000,
+            help="Number of rows read at a time when writing the snapshot"
+        )
+    return parser.parse_args()
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.command == "compact":
+        compact_command(args)
+    elif args.command == "recalculate":
+        recalculate_command(args)
+    elif args.command == "snapshot":
+        snapshot_command(args)
+    elif args.command == "stats":
+        stats_command(args)
+    else:
+        if getattr(args, "workers", None):
+            WORKERS = args.workers
+        main()
\ No newline at end of file
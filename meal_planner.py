@@ -0,0 +1,243 @@
+import bisect
+import hashlib
+import json
+import random
+import re
+
+from menu_model import MEAL_FIELDS
+from recipes import INGREDIENTS, RECIPES
+
+# Bump whenever the recipes or the planning rules change, so cached local menus are rebuilt
+PLANNER_VERSION = 2
+
+DAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+# Share of the day's calories per meal, and the recipe course each meal is picked from
+MEAL_SHARES = {"breakfast": 0.25, "snack1": 0.10, "lunch": 0.30, "snack2": 0.10, "dinner": 0.25}
+MEAL_COURSES = {"breakfast": "breakfast", "snack1": "snack", "lunch": "lunch", "snack2": "snack", "dinner": "dinner"}
+
+# Daily calories relative to the maintenance target, never below the floor for the sex.
+# Goals are keyed as the profile stores them (see goal_choice_callback)
+GOAL_CALORIE_FACTORS = {"lost weight": 0.80, "keep as it is": 1.00, "take weight": 1.12}
+MIN_DAILY_CALORIES = {"man": 1500, "woman": 1200}
+# Protein target in grams per kg of body weight
+PROTEIN_PER_KG = {"lost weight": 1.8, "keep as it is": 1.4, "take weight": 1.8}
+
+# A recipe's base portion is scaled within these bounds to hit a meal's calories
+MIN_PORTION_SCALE = 0.6
+MAX_PORTION_SCALE = 2.5
+
+# Added to a recipe's cost for each earlier use this week, and when it was served today or yesterday
+REPEAT_PENALTY = 0.05
+RECENT_PENALTY = 0.5
+# Random cost spread, so equally good recipes take turns
+VARIETY_JITTER = 0.04
+
+
+class Recipe:
+    """A recipe with the nutrition of its base portion."""
+
+    __slots__ = ("name", "course", "ingredients", "kcal", "protein", "carbs", "fat", "protein_share")
+
+    def __init__(self, name: str, course: str, ingredients: tuple):
+        self.name = name
+        self.course = course
+        self.ingredients = ingredients
+        self.kcal = self.protein = self.carbs = self.fat = 0.0
+        for ingredient, amount in ingredients:
+            _, kcal, protein, carbs, fat = INGREDIENTS[ingredient]
+            self.kcal += kcal * amount / 100
+            self.protein += protein * amount / 100
+            self.carbs += carbs * amount / 100
+            self.fat += fat * amount / 100
+        # Fraction of the calories that come from protein
+        self.protein_share = self.protein * 4 / self.kcal
+
+
+class RecipeIndex:
+    """Recipes grouped by course and calorie bucket, each bucket sorted by protein share.
+
+    A lookup visits only the buckets whose recipes can be scaled to the wanted
+    calories, and within each bucket bisects to the recipes closest to the
+    wanted protein share.
+    """
+
+    def __init__(self, recipes: list, bucket_kcal: int = 100):
+        self.bucket_kcal = bucket_kcal
+        self.by_course = {}
+        buckets = {}
+        for recipe in recipes:
+            self.by_course.setdefault(recipe.course, []).append(recipe)
+            buckets.setdefault((recipe.course, int(recipe.kcal // bucket_kcal)), []).append(recipe)
+        self._buckets = {}
+        for key, bucket in buckets.items():
+            bucket.sort(key=lambda recipe: recipe.protein_share)
+            self._buckets[key] = ([recipe.protein_share for recipe in bucket], bucket)
+
+    def candidates(self, course: str, kcal: float, protein_share: float, per_bucket: int = 3) -> list:
+        """Recipes of a course that can be portioned to `kcal`, nearest to `protein_share` first per bucket.
+
+        For targets no recipe can be scaled to, the recipes closest in calories are returned.
+        """
+        low, high = kcal / MAX_PORTION_SCALE, kcal / MIN_PORTION_SCALE
+        found = []
+        for bucket in range(int(low // self.bucket_kcal), int(high // self.bucket_kcal) + 1):
+            entry = self._buckets.get((course, bucket))
+            if entry is None:
+                continue
+            shares, recipes = entry
+            position = bisect.bisect_left(shares, protein_share)
+            found.extend(
+                recipe for recipe in recipes[max(0, position - per_bucket):position + per_bucket]
+                if low <= recipe.kcal <= high
+            )
+        if not found:
+            found = sorted(self.by_course.get(course, ()), key=lambda recipe: abs(recipe.kcal - kcal))
+            found = found[:2 * per_bucket]
+        return found
+
+
+def profile_seed(prompt_inputs: dict) -> int:
+    """A seed derived from the profile, so the same profile always gets the same plan."""
+    canonical = json.dumps(prompt_inputs, sort_keys=True, default=str)
+    return int.from_bytes(hashlib.sha256(canonical.encode("utf-8")).digest()[:8], "big")
+
+
+def recipe_name(meal_text: str) -> str:
+    """The dish of a planned meal: its text before the ingredient list."""
+    return meal_text.split(":", 1)[0].strip()
+
+
+def meal_calories(meal_text: str):
+    """The calories stated in a meal's text, like "(450 kcal", or None."""
+    match = re.search(r"\((\d+)\s*kcal", meal_text or "")
+    return int(match.group(1)) if match else None
+
+
+def _round_amount(amount: float) -> int:
+    step = 5 if amount < 100 else 10
+    return max(step, int(round(amount / step)) * step)
+
+
+class LocalMenuPlanner:
+    """Builds meal plans from the local recipe database, without the AI model.
+
+    Each day's calories follow the profile's maintenance target adjusted for the
+    goal, split over the meals by MEAL_SHARES. Every meal is the indexed recipe
+    closest to the protein target, portioned to its share, with repeats within
+    the week made costlier. Plans are deterministic per profile and seed, and
+    use the same day schema as AI menus.
+    """
+
+    def __init__(self, recipes: tuple = RECIPES):
+        self.index = RecipeIndex([Recipe(*recipe) for recipe in recipes])
+
+    @staticmethod
+    def daily_calories(prompt_inputs: dict) -> int:
+        """The day's calorie target for the goal."""
+        factor = GOAL_CALORIE_FACTORS.get(prompt_inputs['goal'], 1.0)
+        floor = MIN_DAILY_CALORIES.get(prompt_inputs['sex'], MIN_DAILY_CALORIES["woman"])
+        return int(round(max(prompt_inputs['calories'] * factor, floor)))
+
+    @staticmethod
+    def protein_share(prompt_inputs: dict, calories: int) -> float:
+        """Wanted fraction of the calories from protein, kept within sensible bounds."""
+        grams = prompt_inputs['weight'] * PROTEIN_PER_KG.get(prompt_inputs['goal'], 1.4)
+        return min(0.35, max(0.15, grams * 4 / calories))
+
+    def plan(self, prompt_inputs: dict, days: int = 7, seed: int = None) -> list:
+        """Returns a menu of `days` day dicts for the profile."""
+        rng = random.Random(profile_seed(prompt_inputs) if seed is None else seed)
+        used = {}
+        return [self.plan_day(prompt_inputs, day_index, rng, used) for day_index in range(days)]
+
+    def replan_day(self, prompt_inputs: dict, menu, day_index: int, rng: random.Random) -> dict:
+        """Plans a replacement for one day of a menu, unlike the other days and the day it replaces."""
+        used = {}
+        for index, day in enumerate(menu):
+            if index != day_index:
+                for meal in MEAL_FIELDS:
+                    if day.get(meal):
+                        used.setdefault(recipe_name(day.get(meal)), []).append(index)
+        for days in used.values():
+            days.sort()
+        replaced = menu[day_index]
+        avoid = {recipe_name(replaced.get(meal)) for meal in MEAL_FIELDS if replaced.get(meal)}
+        day = self.plan_day(prompt_inputs, day_index, rng, used, avoid)
+        day["day"] = replaced.get("day", day["day"])
+        return day
+
+    def swap_meal(self, prompt_inputs: dict, day, meal: str, rng: random.Random) -> str:
+        """Returns a different dish for one meal of a day, with about the calories of the one it replaces."""
+        calories = self.daily_calories(prompt_inputs)
+        kcal = meal_calories(day.get(meal)) or calories * MEAL_SHARES[meal]
+        protein_share = self.protein_share(prompt_inputs, calories)
+        avoid = {recipe_name(day.get(other)) for other in MEAL_FIELDS if day.get(other)}
+        course = MEAL_COURSES[meal]
+        candidates = [
+            recipe for recipe in self.index.candidates(course, kcal, protein_share) if recipe.name not in avoid
+        ]
+        if not candidates:
+            candidates = [recipe for recipe in self.index.by_course[course] if recipe.name not in avoid]
+        # Wider spread than for whole plans, so swapping the same meal again gives something else
+        recipe = min(
+            candidates or self.index.by_course[course],
+            key=lambda recipe: abs(recipe.protein_share - protein_share) + rng.random() * 5 * VARIETY_JITTER,
+        )
+        return self._serve(recipe, kcal)[0]
+
+    def plan_day(self, prompt_inputs: dict, day_index: int, rng: random.Random, used: dict = None,
+                 avoid: set = frozenset()) -> dict:
+        """Plans one day without the recipes in `avoid`, where possible.
+
+        `used` maps recipe names to the days they were served, and is updated.
+        """
+        used = {} if used is None else used
+        calories = self.daily_calories(prompt_inputs)
+        protein_share = self.protein_share(prompt_inputs, calories)
+
+        chosen = {}
+        for meal in MEAL_FIELDS:
+            candidates = self.index.candidates(MEAL_COURSES[meal], calories * MEAL_SHARES[meal], protein_share)
+            candidates = [recipe for recipe in candidates if recipe.name not in avoid] or candidates
+
+            def cost(recipe: Recipe) -> float:
+                days = used.get(recipe.name, ())
+                penalty = REPEAT_PENALTY * len(days)
+                if days and day_index - days[-1] <= 1:
+                    penalty += RECENT_PENALTY
+                return abs(recipe.protein_share - protein_share) + penalty + rng.random() * VARIETY_JITTER
+
+            chosen[meal] = min(candidates, key=cost)
+            used.setdefault(chosen[meal].name, []).append(day_index)
+
+        servings = {meal: self._serve(recipe, calories * MEAL_SHARES[meal]) for meal, recipe in chosen.items()}
+        # Rounded portions drift from the target; dinner takes up the difference
+        served = sum(serving[1] for meal, serving in servings.items() if meal != "dinner")
+        servings["dinner"] = self._serve(chosen["dinner"], calories - served)
+
+        day = {
+            "day": DAY_NAMES[day_index % len(DAY_NAMES)],
+            "calories": sum(serving[1] for serving in servings.values()),
+            "macronutrients": "Protein {}g, Carbs {}g, Fat {}g".format(
+                *(int(round(sum(serving[position] for serving in servings.values()))) for position in (2, 3, 4))
+            ),
+        }
+        day.update((meal, servings[meal][0]) for meal in MEAL_FIELDS)
+        return day
+
+    @staticmethod
+    def _serve(recipe: Recipe, kcal: float) -> tuple:
+        """Portions a recipe to about `kcal`. Returns (text, kcal, protein, carbs, fat)."""
+        scale = min(MAX_PORTION_SCALE, max(MIN_PORTION_SCALE, kcal / recipe.kcal))
+        parts = []
+        totals = [0.0, 0.0, 0.0, 0.0]
+        for ingredient, base_amount in recipe.ingredients:
+            unit, *nutrition = INGREDIENTS[ingredient]
+            amount = _round_amount(base_amount * scale)
+            parts.append(f"{amount} {unit} {ingredient}")
+            for position, value in enumerate(nutrition):
+                totals[position] += value * amount / 100
+        kcal, protein, carbs, fat = totals
+        text = f"{recipe.name}: {', '.join(parts)} ({int(round(kcal))} kcal, {int(round(protein))}g protein)"
+        return text, int(round(kcal)), protein, carbs, fat
@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def menu_cache_key(prompt_inputs: dict, model: str, system_prompt_version: int) -> str:
+    """Returns a canonical hash of everything that shapes a generated menu."""
+    payload = dict(prompt_inputs, model=model, system_prompt_version=system_prompt_version)
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class MenuCache:
+    """LRU + TTL cache of generated menus bounded by total size in bytes.
+
+    Entries live in memory and, if `disk_dir` is set, are also written there as
+    JSON files so they survive restarts. A memory miss falls back to the disk tier.
+    """
+
+    def __init__(self, ttl: float = 7 * 24 * 3600, max_bytes: int = 16 * 1024 * 1024, disk_dir: str = None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _evict_until(self, limit: int):
+        while self._size > limit and self._entries:
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+
+    def _remember(self, key: str, menu: list, created: float, size: int):
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[2]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (menu, created, size)
+        self._size += size
+        self._evict_until(self.max_bytes)
+
+    def get(self, key: str):
+        """Returns the cached menu for a key, or None if missing or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                menu, created, _ = entry
+                if now - created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return menu
+                self._size -= self._entries.pop(key)[2]
+
+        if self.disk_dir:
+            menu = self._read_disk(key, now)
+            if menu is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, menu[0], menu[1], menu[2])
+                return menu[0]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _read_disk(self, key: str, now: float):
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+            record = json.loads(raw)
+        except (OSError, ValueError):
+            return None
+        if now - record.get("created", 0) > self.ttl:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return record["menu"], record["created"], len(raw)
+
+    def put(self, key: str, menu: list):
+        """Stores a menu under a key in memory and, if enabled, on disk."""
+        created = time.time()
+        raw = json.dumps({"created": created, "menu": menu}, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            self._remember(key, menu, created, len(raw))
+        if self.disk_dir:
+            try:
+                with tempfile.NamedTemporaryFile("wb", dir=self.disk_dir, delete=False) as f:
+                    f.write(raw)
+                os.replace(f.name, self._disk_path(key))
+            except OSError as e:
+                print(f"Could not write menu cache entry to disk: {e}")
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and current memory usage."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+            }
+
+
+class SingleFlight:
+    """Runs at most one coroutine per key at a time; concurrent callers share its result.
+
+    The shared task is shielded, so a caller that gets cancelled doesn't cancel the
+    work for everyone else waiting on the same key.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def is_running(self, key: str) -> bool:
+        """Returns True if a call for this key is in flight."""
+        return key in self._inflight
+
+    async def run(self, key: str, factory):
+        """Awaits the in-flight call for a key, starting `factory()` if there is none."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        """Returns how many calls were started and how many joined an existing one."""
+        return {"started": self.started, "coalesced": self.coalesced, "in_flight": len(self._inflight)}
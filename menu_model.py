@@ -0,0 +1,103 @@
+import base64
+import json
+import sys
+import zlib
+
+MEAL_FIELDS = ("breakfast", "snack1", "lunch", "snack2", "dinner")
+DAY_FIELDS = ("day", "calories", "macronutrients") + MEAL_FIELDS
+
+
+def _compact_value(field: str, value):
+    if isinstance(value, str) and field not in MEAL_FIELDS:
+        # Day names, calorie and macro lines repeat across menus and users
+        return sys.intern(value)
+    return value
+
+
+class MenuDay:
+    """One day of a menu with fixed fields, much smaller than the dict it is built from.
+
+    `get` behaves like `dict.get`, so code written for day dicts keeps working.
+    Keys outside the known fields are dropped.
+    """
+
+    __slots__ = DAY_FIELDS
+
+    def __init__(self, **fields):
+        for field in DAY_FIELDS:
+            setattr(self, field, _compact_value(field, fields.get(field)))
+
+    @classmethod
+    def from_dict(cls, day: dict) -> "MenuDay":
+        return cls(**{field: day.get(field) for field in DAY_FIELDS})
+
+    def get(self, field: str, default=None):
+        value = getattr(self, field, None) if field in DAY_FIELDS else None
+        return default if value is None else value
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in DAY_FIELDS if getattr(self, field) is not None}
+
+
+class CompactMenu:
+    """The days of a generated menu, as a sequence of MenuDay.
+
+    `pages` holds the rendered message pages, set by the bot and cleared whenever
+    the days change. It is never stored, since it can be rendered again.
+    """
+
+    __slots__ = ("days", "pages")
+
+    def __init__(self, days=()):
+        self.days = [day if isinstance(day, MenuDay) else MenuDay.from_dict(day) for day in days]
+        self.pages = None
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def __getitem__(self, index: int) -> MenuDay:
+        return self.days[index]
+
+    def __iter__(self):
+        return iter(self.days)
+
+    def extend(self, days):
+        """Appends days given as dicts or MenuDay objects."""
+        self.days.extend(day if isinstance(day, MenuDay) else MenuDay.from_dict(day) for day in days)
+        self.pages = None
+
+    def replace(self, index: int, day):
+        """Replaces one day, given as a dict or MenuDay."""
+        self.days[index] = day if isinstance(day, MenuDay) else MenuDay.from_dict(day)
+        self.pages = None
+
+    def to_dicts(self) -> list:
+        return [day.to_dict() for day in self.days]
+
+    def pack(self) -> str:
+        """Returns the menu as compressed, base64-encoded JSON for storage."""
+        raw = json.dumps(self.to_dicts(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return base64.b64encode(zlib.compress(raw, 6)).decode("ascii")
+
+    @classmethod
+    def unpack(cls, packed: str) -> "CompactMenu":
+        return cls(json.loads(zlib.decompress(base64.b64decode(packed)).decode("utf-8")))
+
+
+def deep_size(value, seen: set = None) -> int:
+    """Approximate memory used by a value and everything it references, counting shared objects once."""
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in value)
+    elif isinstance(value, CompactMenu):
+        size += deep_size(value.days, seen) + deep_size(value.pages, seen)
+    elif isinstance(value, MenuDay):
+        size += sum(deep_size(getattr(value, field), seen) for field in DAY_FIELDS)
+    return size
@@ -0,0 +1,208 @@
+import json
+import re
+
+from menu_model import MEAL_FIELDS
+
+# Compact menu format: short keys, with calories and macros as plain numbers. It costs
+# fewer output tokens than the verbose format and can be enforced with a JSON schema
+COMPACT_MEAL_KEYS = {"b": "breakfast", "s1": "snack1", "l": "lunch", "s2": "snack2", "n": "dinner"}
+COMPACT_MACRO_KEYS = (("p", "Protein"), ("c", "Carbs"), ("f", "Fat"))
+
+COMPACT_DAY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "d": {"type": "string"},
+        "k": {"type": "integer"},
+        **{key: {"type": "integer"} for key, _ in COMPACT_MACRO_KEYS},
+        **{key: {"type": "string"} for key in COMPACT_MEAL_KEYS},
+    },
+    "required": ["d", "k"] + [key for key, _ in COMPACT_MACRO_KEYS] + list(COMPACT_MEAL_KEYS),
+    "additionalProperties": False,
+}
+COMPACT_MENU_SCHEMA = {
+    "type": "object",
+    "properties": {"m": {"type": "array", "items": COMPACT_DAY_SCHEMA}},
+    "required": ["m"],
+    "additionalProperties": False,
+}
+
+# Meals a day can't do without; a missing snack is tolerated
+REQUIRED_MEALS = ("breakfast", "lunch", "dinner")
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+class MenuFormatError(ValueError):
+    """A menu or day from the AI model doesn't have the expected shape."""
+
+
+def response_format(name: str, schema: dict) -> dict:
+    """The `response_format` request parameter asking the model for JSON matching `schema`."""
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+def _number(value, field: str) -> int:
+    if isinstance(value, bool):
+        raise MenuFormatError(f"{field} isn't a number")
+    if isinstance(value, (int, float)):
+        return int(round(value))
+    # "2,100 kcal" -> 2100
+    match = _NUMBER.search(value.replace(",", "")) if isinstance(value, str) else None
+    if match is None:
+        raise MenuFormatError(f"{field} isn't a number: {value!r}")
+    return int(round(float(match.group())))
+
+
+def _macros(value) -> str:
+    if isinstance(value, dict):
+        # {"protein": "120g", ...}, as the verbose format is sometimes answered
+        parts = []
+        for _, label in COMPACT_MACRO_KEYS:
+            amount = value.get(label.lower(), value.get(label))
+            if amount is not None:
+                parts.append(f"{label} {_number(amount, label.lower())}g")
+        value = ", ".join(parts)
+    if not isinstance(value, str) or not value.strip():
+        raise MenuFormatError("macronutrients are missing")
+    return value.strip()
+
+
+def normalize_day(raw) -> dict:
+    """Validates a day in the compact or the verbose format and returns it as a day dict.
+
+    The result has the fields the menu pages are rendered from: day, calories
+    (an int), macronutrients ("Protein 120g, Carbs 200g, Fat 60g") and the meals.
+    Raises MenuFormatError for a day that can't be shown.
+    """
+    if not isinstance(raw, dict):
+        raise MenuFormatError("a day isn't a JSON object")
+    if "k" in raw or any(key in raw for key in COMPACT_MEAL_KEYS):
+        fields = {meal: raw.get(key) for key, meal in COMPACT_MEAL_KEYS.items()}
+        fields["day"] = raw.get("d")
+        fields["calories"] = raw.get("k")
+        macros = {label: raw.get(key) for key, label in COMPACT_MACRO_KEYS if raw.get(key) is not None}
+        fields["macronutrients"] = _macros(macros) if macros else None
+    else:
+        fields = {field: raw.get(field) for field in ("day", "calories") + MEAL_FIELDS}
+        macros = raw.get("macronutrients")
+        fields["macronutrients"] = _macros(macros) if macros else None
+
+    day = {}
+    if isinstance(fields["day"], str) and fields["day"].strip():
+        day["day"] = fields["day"].strip()
+    day["calories"] = _number(fields["calories"], "calories")
+    if fields["macronutrients"]:
+        day["macronutrients"] = fields["macronutrients"]
+    for meal in MEAL_FIELDS:
+        text = fields[meal]
+        if isinstance(text, str) and text.strip():
+            day[meal] = text.strip()
+        elif meal in REQUIRED_MEALS:
+            raise MenuFormatError(f"{meal} is missing")
+    return day
+
+
+def _menu_days(value) -> list:
+    if isinstance(value, dict):
+        value = value.get("m", value.get("menu"))
+    if not isinstance(value, list):
+        raise MenuFormatError("the answer has no list of days")
+    return value
+
+
+def parse_menu(text: str, days: int) -> list:
+    """Parses a complete menu answer into `days` slots: a day dict, or None for a day that is broken or missing.
+
+    Text around the JSON (code fences, a sentence of prose) is ignored. If the
+    JSON itself is damaged, for example cut off, the days before the damage
+    are still recovered, so only the rest has to be generated again.
+    """
+    start = text.find("{")
+    try:
+        if start < 0:
+            raise MenuFormatError("the answer has no JSON")
+        raw_days = _menu_days(json.JSONDecoder().raw_decode(text, start)[0])
+        slots = []
+        for raw in raw_days[:days]:
+            try:
+                slots.append(normalize_day(raw))
+            except MenuFormatError as e:
+                print(f"Invalid menu day {len(slots) + 1}: {e}")
+                slots.append(None)
+    except (json.JSONDecodeError, MenuFormatError):
+        parser = MenuStreamParser()
+        parser.feed(text)
+        slots = parser.slots[:days]
+    return slots + [None] * (days - len(slots))
+
+
+class MenuStreamParser:
+    """Incrementally parses a streamed `{"menu": [{...}, {...}]}` response.
+
+    Text is fed in arbitrary chunks as it arrives. Every time a day object
+    inside the top-level array is closed, it is validated with `normalize_day`
+    and returned by `feed`, so callers can show day 1 while the rest of the week
+    is still streaming. Anything outside the JSON structure (such as markdown
+    code fences) is ignored.
+
+    `slots` has an entry for every day object received, None for a broken one;
+    `days` holds the days up to the first broken one, in order, ready to show.
+    """
+
+    def __init__(self):
+        self.days = []
+        self.slots = []
+        self.text = []
+        self._buffer = []
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._capturing = False
+
+    def feed(self, chunk: str) -> list:
+        """Consumes a chunk of text and returns the day objects it completed."""
+        self.text.append(chunk)
+        completed = []
+        for char in chunk:
+            if self._capturing:
+                self._buffer.append(char)
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                if char == "{" and self._stack == ["{", "["]:
+                    self._capturing = True
+                    self._buffer = [char]
+                self._stack.append(char)
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if self._capturing and self._stack == ["{", "["]:
+                    self._capturing = False
+                    day = self._decode("".join(self._buffer))
+                    self.slots.append(day)
+                    if day is not None and len(self.days) == len(self.slots) - 1:
+                        self.days.append(day)
+                        completed.append(day)
+        return completed
+
+    @staticmethod
+    def _decode(raw: str):
+        try:
+            return normalize_day(json.loads(raw))
+        except (json.JSONDecodeError, MenuFormatError) as e:
+            print(f"Skipping malformed streamed day: {e}")
+            return None
+
+    def full_text(self) -> str:
+        """Returns everything fed so far."""
+        return "".join(self.text)
@@ -0,0 +1,202 @@
+import asyncio
+import functools
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from fast store lookups up to long AI generations
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0,
+)
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Monotonically increasing count, optionally split by labels."""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with _lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """Value read from a callback each time metrics are rendered."""
+
+    def __init__(self, name: str, documentation: str, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        _registry.append(self)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            lines.append(f"{self.name} {float(self.function())}")
+        except Exception as e:
+            print(f"Could not read gauge {self.name}: {e}")
+        return lines
+
+
+class Histogram:
+    """Cumulative bucketed distribution of observed values, optionally split by labels."""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with _lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), [0.0, 0]))
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+            total[0] += value
+            total[1] += 1
+            self._values[key] = (counts, total)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the wrapped block took."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            for key, (counts, (total, count)) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(self.labels, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _format_labels(self.labels, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+def render() -> str:
+    """Renders every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Metrics shared across modules
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Time spent in each update handler.", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Update handlers that raised an exception.", ("handler",))
+STORE_SECONDS = Histogram("bot_store_seconds", "Profile store operation latency.", ("operation",))
+AI_SECONDS = Histogram("bot_ai_request_seconds", "AI inference request latency.", ("model", "mode"))
+AI_REQUESTS = Counter("bot_ai_requests_total", "AI inference requests by outcome.", ("model", "outcome"))
+AI_TOKENS = Counter("bot_ai_tokens_total", "Tokens reported by the AI service.", ("model", "kind"))
+AI_RETRIES = Counter("bot_ai_retries_total", "AI requests retried after a transient failure.", ("model", "reason"))
+AI_HEDGES = Counter("bot_ai_hedges_total", "Second AI requests sent for slow ones, by which answered first.",
+                    ("model", "winner"))
+AI_FAILOVERS = Counter("bot_ai_failovers_total", "AI requests moved on to another model after failing.", ("route",))
+AI_BREAKER_TRANSITIONS = Counter("bot_ai_breaker_transitions_total", "AI circuit breaker state changes.", ("state",))
+SEND_WAIT_SECONDS = Histogram("bot_send_wait_seconds", "Time Bot API calls waited for the rate limiter.", ("priority",))
+SEND_RETRIES = Counter("bot_send_retries_total", "Bot API calls retried after Telegram answered 429.", ("endpoint",))
+MENUS_SERVED = Counter("bot_menus_total", "Menus shown to users by where they came from.", ("source",))
+LOCAL_MENU_SECONDS = Histogram("bot_local_menu_seconds", "Time to plan a menu with the local recipe planner.")
+MENU_EDITS = Counter("bot_menu_edits_total", "Days regenerated and meals swapped in shown menus.", ("kind", "source"))
+MENU_REPAIRS = Counter(
+    "bot_menu_repairs_total", "Menu days the AI model answered broken or not at all, by how they ended up.",
+    ("outcome",),
+)
+
+
+def instrument_handler(callback):
+    """Wraps an update handler so its latency and failures are recorded under its function name."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+async def serve(host: str, port: int):
+    """Serves the metrics text on http://host:port/metrics until cancelled."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            path = request_line.split(b" ")[1] if request_line.count(b" ") >= 2 else b"/"
+            if path.split(b"?")[0] in (b"/", b"/metrics"):
+                status, body = "200 OK", render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode("ascii") + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
+
+
+async def dump_periodically(file_name: str, interval: float):
+    """Writes the metrics text to a file every `interval` seconds until cancelled."""
+    directory = os.path.dirname(os.path.abspath(file_name))
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as f:
+                f.write(render())
+            os.replace(f.name, file_name)
+        except OSError as e:
+            print(f"Could not write metrics to {file_name}: {e}")
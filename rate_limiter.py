@@ -0,0 +1,161 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import SEND_RETRIES, SEND_WAIT_SECONDS
+
+# Interactive edits (the user is looking at the message) go before new messages
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+
+
+class TokenBucket:
+    """Token bucket whose waiters are served by priority, then in arrival order."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []
+        self._counter = itertools.count()
+        self._waker = None
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _time_until_token(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self._paused_until - now)
+
+    def pause(self, seconds: float):
+        """Grants no tokens for `seconds`, e.g. after Telegram answered with 429."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def waiting(self, priority: int = None) -> int:
+        """Returns the number of waiters, optionally only those of one priority."""
+        return sum(
+            1 for waiter_priority, _, future in self._waiters
+            if not future.done() and (priority is None or waiter_priority == priority)
+        )
+
+    def idle(self) -> bool:
+        """Returns True if the bucket is full and nobody waits on it."""
+        return not self._waiters and self._time_until_token() == 0 and self.tokens >= self.capacity
+
+    async def acquire(self, priority: int = PRIORITY_BULK):
+        """Waits until a token is available and takes it."""
+        if not self._waiters and self._time_until_token() == 0:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if self._waker is None or self._waker.done():
+            self._waker = asyncio.create_task(self._wake())
+        await future
+
+    async def _wake(self):
+        while self._waiters:
+            wait = self._time_until_token()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(None)
+
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """Keeps outgoing Bot API calls under Telegram's global and per-chat limits.
+
+    Every message-sending or -editing call takes a token from its chat's bucket,
+    then from the global bucket. Edits of an existing message are interactive and
+    are served before new messages. When Telegram still answers with 429, the
+    affected chat (or everything, for calls without a chat) is paused for the
+    given time and the call is retried, up to `max_retries` times. Other calls
+    such as answerCallbackQuery are not limited.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 group_rate: float = 20 / 60, max_retries: int = 3):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_buckets = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self.chat_buckets.clear()
+
+    @staticmethod
+    def _priority(endpoint: str) -> int:
+        return PRIORITY_INTERACTIVE if endpoint.lower().startswith("edit") else PRIORITY_BULK
+
+    @staticmethod
+    def _is_limited(endpoint: str) -> bool:
+        return endpoint.lower().startswith(("send", "edit", "copy", "forward"))
+
+    def _chat_bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 1000:
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if not value.idle()}
+            # Negative ids are groups and channels, which have a much lower limit
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, 1.0 if is_group else self.chat_burst)
+        return bucket
+
+    def queue_length(self, priority: int = None) -> int:
+        """Returns the number of calls waiting for a token."""
+        return self.global_bucket.waiting(priority) + sum(
+            bucket.waiting(priority) for bucket in self.chat_buckets.values()
+        )
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = rate_limit_args if isinstance(rate_limit_args, int) else self.max_retries
+        limited = self._is_limited(endpoint)
+        priority = self._priority(endpoint)
+        chat_bucket = self._chat_bucket(data.get("chat_id")) if limited else None
+
+        attempt = 0
+        while True:
+            if limited:
+                started = time.perf_counter()
+                if chat_bucket is not None:
+                    await chat_bucket.acquire(priority)
+                await self.global_bucket.acquire(priority)
+                SEND_WAIT_SECONDS.observe(time.perf_counter() - started, priority=PRIORITY_NAMES[priority])
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= max_retries:
+                    raise
+                attempt += 1
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    retry_after = retry_after.total_seconds()
+                SEND_RETRIES.inc(endpoint=endpoint)
+                print(f"Telegram asked to slow down on {endpoint}, retrying in {retry_after}s")
+                (chat_bucket or self.global_bucket).pause(float(retry_after))
+                if not limited:
+                    await asyncio.sleep(float(retry_after))
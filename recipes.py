@@ -0,0 +1,127 @@
+# Local meal database used by the menu planner. Recipes list their ingredients for
+# one base portion, which the planner scales up or down as a whole.
+
+# name -> (unit, kcal, protein g, carbs g, fat g) per 100 g or 100 ml
+INGREDIENTS = {
+    "rolled oats": ("g", 379, 13.2, 67.7, 6.5),
+    "granola": ("g", 471, 10.0, 64.0, 20.0),
+    "whole-grain bread": ("g", 247, 13.0, 41.0, 3.4),
+    "whole-wheat tortilla": ("g", 306, 9.2, 50.2, 7.7),
+    "rice cakes": ("g", 387, 8.2, 81.5, 2.8),
+    "quinoa (cooked)": ("g", 120, 4.4, 21.3, 1.9),
+    "brown rice (cooked)": ("g", 123, 2.7, 25.6, 1.0),
+    "whole-wheat pasta (cooked)": ("g", 149, 6.0, 30.1, 1.7),
+    "potatoes": ("g", 87, 1.9, 20.1, 0.1),
+    "sweet potato": ("g", 90, 2.0, 20.7, 0.2),
+    "lentils (cooked)": ("g", 116, 9.0, 20.1, 0.4),
+    "chickpeas (cooked)": ("g", 164, 8.9, 27.4, 2.6),
+    "chicken breast": ("g", 165, 31.0, 0.0, 3.6),
+    "turkey mince": ("g", 189, 27.4, 0.0, 8.3),
+    "lean beef": ("g", 217, 26.1, 0.0, 11.8),
+    "salmon fillet": ("g", 206, 22.1, 0.0, 12.4),
+    "cod fillet": ("g", 105, 22.8, 0.0, 0.9),
+    "tuna in water": ("g", 116, 25.5, 0.0, 0.8),
+    "firm tofu": ("g", 144, 15.8, 2.8, 8.7),
+    "eggs": ("g", 143, 12.6, 0.7, 9.5),
+    "Greek yogurt": ("g", 73, 9.9, 3.9, 1.9),
+    "cottage cheese": ("g", 98, 11.1, 3.4, 4.3),
+    "kefir": ("ml", 41, 3.6, 4.5, 1.0),
+    "milk": ("ml", 47, 3.4, 4.8, 1.5),
+    "feta": ("g", 264, 14.2, 4.1, 21.3),
+    "mozzarella": ("g", 254, 24.3, 2.8, 15.9),
+    "parmesan": ("g", 431, 38.0, 4.1, 29.0),
+    "hummus": ("g", 166, 7.9, 14.3, 9.6),
+    "almonds": ("g", 579, 21.2, 21.6, 49.9),
+    "walnuts": ("g", 654, 15.2, 13.7, 65.2),
+    "peanut butter": ("g", 588, 25.0, 20.0, 50.0),
+    "chia seeds": ("g", 486, 16.5, 42.1, 30.7),
+    "olive oil": ("ml", 884, 0.0, 0.0, 100.0),
+    "honey": ("g", 304, 0.3, 82.4, 0.0),
+    "avocado": ("g", 160, 2.0, 8.5, 14.7),
+    "banana": ("g", 89, 1.1, 22.8, 0.3),
+    "apple": ("g", 52, 0.3, 13.8, 0.2),
+    "orange": ("g", 47, 0.9, 11.8, 0.1),
+    "blueberries": ("g", 57, 0.7, 14.5, 0.3),
+    "strawberries": ("g", 32, 0.7, 7.7, 0.3),
+    "spinach": ("g", 23, 2.9, 3.6, 0.4),
+    "broccoli": ("g", 35, 2.4, 7.2, 0.4),
+    "mixed vegetables": ("g", 40, 2.0, 7.0, 0.3),
+    "mixed salad leaves": ("g", 17, 1.2, 3.3, 0.2),
+    "tomatoes": ("g", 18, 0.9, 3.9, 0.2),
+    "cucumber": ("g", 15, 0.7, 3.6, 0.1),
+    "bell pepper": ("g", 31, 1.0, 6.0, 0.3),
+    "carrots": ("g", 41, 0.9, 9.6, 0.2),
+    "mushrooms": ("g", 22, 3.1, 3.3, 0.3),
+}
+
+# (name, course, ((ingredient, amount), ...)). Snacks serve both snack slots.
+RECIPES = (
+    ("Oatmeal with blueberries and Greek yogurt", "breakfast",
+     (("rolled oats", 60), ("milk", 200), ("blueberries", 100), ("Greek yogurt", 100))),
+    ("Scrambled eggs with spinach on whole-grain toast", "breakfast",
+     (("eggs", 150), ("spinach", 60), ("whole-grain bread", 60), ("olive oil", 5))),
+    ("Greek yogurt with granola and strawberries", "breakfast",
+     (("Greek yogurt", 200), ("granola", 40), ("strawberries", 120))),
+    ("Avocado toast with eggs and tomatoes", "breakfast",
+     (("whole-grain bread", 70), ("avocado", 70), ("eggs", 100), ("tomatoes", 60))),
+    ("Cottage cheese pancakes with berries", "breakfast",
+     (("cottage cheese", 150), ("eggs", 50), ("rolled oats", 40), ("blueberries", 80), ("honey", 10))),
+    ("Peanut butter banana oatmeal", "breakfast",
+     (("rolled oats", 60), ("milk", 200), ("banana", 100), ("peanut butter", 15))),
+    ("Vegetable omelette with feta and toast", "breakfast",
+     (("eggs", 150), ("bell pepper", 60), ("mushrooms", 60), ("feta", 30), ("whole-grain bread", 40),
+      ("olive oil", 5))),
+    ("Chia pudding with kefir and banana", "breakfast",
+     (("kefir", 250), ("chia seeds", 30), ("banana", 80), ("honey", 10))),
+
+    ("Apple with almonds", "snack", (("apple", 180), ("almonds", 20))),
+    ("Cottage cheese with cucumber", "snack", (("cottage cheese", 150), ("cucumber", 100))),
+    ("Greek yogurt with honey and walnuts", "snack", (("Greek yogurt", 150), ("honey", 10), ("walnuts", 15))),
+    ("Hummus with carrot sticks", "snack", (("hummus", 60), ("carrots", 120))),
+    ("Banana with peanut butter", "snack", (("banana", 120), ("peanut butter", 15))),
+    ("Rice cakes with tuna and tomatoes", "snack", (("rice cakes", 20), ("tuna in water", 80), ("tomatoes", 50))),
+    ("Kefir with strawberries", "snack", (("kefir", 250), ("strawberries", 100))),
+    ("Orange and walnuts", "snack", (("orange", 150), ("walnuts", 15))),
+    ("Boiled eggs with tomatoes", "snack", (("eggs", 100), ("tomatoes", 100))),
+    ("Mozzarella and tomato salad", "snack", (("mozzarella", 60), ("tomatoes", 120), ("olive oil", 5))),
+
+    ("Grilled chicken with quinoa and roasted vegetables", "lunch",
+     (("chicken breast", 150), ("quinoa (cooked)", 150), ("mixed vegetables", 150), ("olive oil", 10))),
+    ("Lentil soup with whole-grain bread", "lunch",
+     (("lentils (cooked)", 200), ("carrots", 60), ("tomatoes", 100), ("whole-grain bread", 50), ("olive oil", 10))),
+    ("Tuna and chickpea salad", "lunch",
+     (("tuna in water", 100), ("chickpeas (cooked)", 120), ("mixed salad leaves", 80), ("cucumber", 80),
+      ("olive oil", 10))),
+    ("Turkey and vegetable wrap", "lunch",
+     (("whole-wheat tortilla", 70), ("turkey mince", 100), ("mixed salad leaves", 50), ("tomatoes", 60),
+      ("hummus", 30))),
+    ("Beef and brown rice bowl with broccoli", "lunch",
+     (("lean beef", 120), ("brown rice (cooked)", 180), ("broccoli", 120), ("olive oil", 5))),
+    ("Whole-wheat pasta with chicken and spinach", "lunch",
+     (("whole-wheat pasta (cooked)", 200), ("chicken breast", 100), ("spinach", 60), ("parmesan", 15),
+      ("olive oil", 10))),
+    ("Tofu stir-fry with brown rice", "lunch",
+     (("firm tofu", 150), ("brown rice (cooked)", 160), ("bell pepper", 80), ("broccoli", 80), ("olive oil", 10))),
+    ("Greek salad with chicken and feta", "lunch",
+     (("chicken breast", 120), ("feta", 40), ("tomatoes", 120), ("cucumber", 100), ("mixed salad leaves", 60),
+      ("olive oil", 10), ("whole-grain bread", 40))),
+
+    ("Baked salmon with sweet potato and salad", "dinner",
+     (("salmon fillet", 150), ("sweet potato", 200), ("mixed salad leaves", 80), ("olive oil", 5))),
+    ("Cod with boiled potatoes and broccoli", "dinner",
+     (("cod fillet", 180), ("potatoes", 250), ("broccoli", 150), ("olive oil", 10))),
+    ("Chicken and vegetable curry with brown rice", "dinner",
+     (("chicken breast", 150), ("brown rice (cooked)", 150), ("tomatoes", 100), ("bell pepper", 60),
+      ("olive oil", 10))),
+    ("Turkey meatballs with whole-wheat pasta and tomato sauce", "dinner",
+     (("turkey mince", 130), ("whole-wheat pasta (cooked)", 160), ("tomatoes", 150), ("parmesan", 10))),
+    ("Chickpea and spinach stew with quinoa", "dinner",
+     (("chickpeas (cooked)", 180), ("spinach", 100), ("tomatoes", 150), ("quinoa (cooked)", 120), ("olive oil", 10))),
+    ("Lean beef steak with potatoes and vegetables", "dinner",
+     (("lean beef", 150), ("potatoes", 220), ("mixed vegetables", 150), ("olive oil", 5))),
+    ("Tofu and mushroom stir-fry with quinoa", "dinner",
+     (("firm tofu", 180), ("mushrooms", 120), ("broccoli", 100), ("quinoa (cooked)", 150), ("olive oil", 10))),
+    ("Stuffed bell peppers with turkey and rice", "dinner",
+     (("bell pepper", 200), ("turkey mince", 120), ("brown rice (cooked)", 120), ("tomatoes", 100),
+      ("mozzarella", 30))),
+)
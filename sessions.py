@@ -0,0 +1,90 @@
+import random
+import time
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes
+
+from menu_model import deep_size
+
+# Measuring every session on each sweep would stall the event loop for large user counts
+SIZE_SAMPLE = 1000
+
+
+class SessionJanitor:
+    """Tracks when each user was last active and trims idle conversation state.
+
+    Menus are by far the largest part of a session. A menu is dropped from
+    memory once its user has been idle for `idle_ttl` seconds, or when more than
+    `max_menus` users hold one, least recently active first. Only the menu's
+    cache key is kept, so it can be reloaded when the user comes back. Sessions
+    idle for `drop_after` seconds are removed entirely (0 keeps them forever).
+    """
+
+    def __init__(self, idle_ttl: float, max_menus: int, drop_after: float = 0):
+        self.idle_ttl = idle_ttl
+        self.max_menus = max_menus
+        self.drop_after = drop_after
+        self.last_seen = OrderedDict()
+        self.menus_evicted = 0
+        self.sessions_dropped = 0
+        self.sessions = 0
+        self.menus_held = 0
+        self.bytes_per_session = 0.0
+
+    def touch(self, user_id: int):
+        """Marks a user as active now."""
+        self.last_seen[user_id] = time.monotonic()
+        self.last_seen.move_to_end(user_id)
+
+    async def on_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Update handler that records user activity; register it in a group before the others."""
+        if update.effective_user:
+            self.touch(update.effective_user.id)
+
+    def sweep(self, application: Application) -> dict:
+        """Evicts idle menus and sessions and refreshes the size figures. Returns the stats."""
+        now = time.monotonic()
+        user_data = application.user_data
+
+        # Sessions restored from the state store count as active since startup, but older than any seen user
+        for user_id in user_data:
+            if user_id not in self.last_seen:
+                self.last_seen[user_id] = now
+                self.last_seen.move_to_end(user_id, last=False)
+
+        holding = sum(1 for data in user_data.values() if data.get('menu_data'))
+        for user_id, seen in list(self.last_seen.items()):
+            data = user_data.get(user_id)
+            if data is None:
+                del self.last_seen[user_id]
+                continue
+            if data.get('menu_generating'):
+                continue
+            idle = now - seen
+            if self.drop_after and idle > self.drop_after:
+                if data.get('menu_data'):
+                    holding -= 1
+                application.drop_user_data(user_id)
+                del self.last_seen[user_id]
+                self.sessions_dropped += 1
+            elif data.get('menu_data') and (idle > self.idle_ttl or holding > self.max_menus):
+                data['menu_data'] = None
+                holding -= 1
+                self.menus_evicted += 1
+
+        sessions = list(user_data.values())
+        sample = random.sample(sessions, SIZE_SAMPLE) if len(sessions) > SIZE_SAMPLE else sessions
+        self.sessions = len(sessions)
+        self.menus_held = holding
+        self.bytes_per_session = sum(deep_size(data) for data in sample) / len(sample) if sample else 0.0
+        return self.stats()
+
+    def stats(self) -> dict:
+        return {
+            "sessions": self.sessions,
+            "menus_held": self.menus_held,
+            "bytes_per_session": round(self.bytes_per_session),
+            "menus_evicted": self.menus_evicted,
+            "sessions_dropped": self.sessions_dropped,
+        }
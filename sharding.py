@@ -0,0 +1,181 @@
+import asyncio
+import os
+import signal
+import sys
+
+import httpx
+from telegram import Bot, Update
+from telegram.error import NetworkError
+
+from state_store import shard_for
+from webhook import WebhookServer
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def update_shard_key(data: dict) -> int:
+    """Returns the id an update is routed by: its chat, else its user, else the update itself."""
+    update = Update.de_json(data, None)
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
+
+
+class ShardRouter:
+    """Forwards raw updates to worker processes by chat id.
+
+    Every worker has its own queue and one forwarding task, so updates for a
+    worker (and therefore for a chat) are delivered in the order they arrived.
+    While a worker is down, its updates wait in the queue and are retried until
+    it is back, so a restart loses nothing.
+    """
+
+    def __init__(self, worker_urls: list, secret_token: str, max_pending: int = 10000):
+        self.worker_urls = worker_urls
+        self.secret_token = secret_token
+        self.queues = [asyncio.Queue(maxsize=max_pending) for _ in worker_urls]
+        self.forwarded = [0] * len(worker_urls)
+        self.retries = 0
+        self._client = None
+        self._tasks = []
+
+    async def start(self):
+        """Starts one forwarding task per worker."""
+        self._client = httpx.AsyncClient(timeout=httpx.Timeout(10.0))
+        self._tasks = [asyncio.create_task(self._forward(index)) for index in range(len(self.worker_urls))]
+
+    async def put(self, data: dict):
+        """Queues an update for the worker that owns its chat."""
+        index = shard_for(update_shard_key(data), len(self.worker_urls))
+        await self.queues[index].put(data)
+
+    def pending(self) -> int:
+        """Returns the number of updates not yet accepted by a worker."""
+        return sum(queue.qsize() for queue in self.queues)
+
+    async def _forward(self, index: int):
+        queue = self.queues[index]
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret_token}
+        while True:
+            data = await queue.get()
+            delay = 0.1
+            try:
+                while True:
+                    try:
+                        response = await self._client.post(self.worker_urls[index], json=data, headers=headers)
+                    except httpx.HTTPError:
+                        response = None
+                    if response is not None and response.status_code < 500:
+                        if response.status_code != 200:
+                            print(f"Worker {index} rejected update {data.get('update_id')}: {response.status_code}")
+                        break
+                    # Worker restarting or draining: keep the update and try again
+                    self.retries += 1
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5.0)
+                self.forwarded[index] += 1
+            finally:
+                queue.task_done()
+
+    async def drain(self, timeout: float = 10.0):
+        """Waits until every queued update has been accepted by its worker."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            print(f"{self.pending()} updates were still queued for workers at shutdown.")
+
+    async def stop(self):
+        """Stops forwarding and closes the HTTP client."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class ShardRouterServer(WebhookServer):
+    """Webhook server of the front-end process: validated updates go to the router, not to a bot."""
+
+    def __init__(self, router: ShardRouter, host: str, port: int, path: str, secret_token: str):
+        super().__init__(None, host, port, path, secret_token)
+        self.router = router
+
+    async def dispatch(self, data: dict):
+        if not isinstance(data, dict) or "update_id" not in data:
+            raise ValueError("not a Telegram update")
+        await self.router.put(data)
+
+    def pending_updates(self) -> int:
+        return self.router.pending()
+
+
+async def poll_updates(bot: Bot, router: ShardRouter):
+    """Long-polls Telegram and hands every update to the router until cancelled."""
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+        except NetworkError as e:
+            print(f"Polling failed, retrying: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await router.put(update.to_dict())
+            offset = update.update_id + 1
+
+
+class WorkerPool:
+    """Runs `main.py run` once per shard and restarts any worker that exits."""
+
+    def __init__(self, count: int, worker_env):
+        self.count = count
+        self.worker_env = worker_env
+        self.processes = [None] * count
+        self.restarts = 0
+        self._stopping = False
+        self._tasks = []
+
+    async def start(self):
+        """Starts and supervises every worker."""
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._supervise(index)) for index in range(self.count)]
+
+    async def _supervise(self, index: int):
+        delay = 1.0
+        while not self._stopping:
+            env = {**os.environ, **self.worker_env(index)}
+            process = await asyncio.create_subprocess_exec(sys.executable, MAIN_SCRIPT, "run", env=env)
+            self.processes[index] = process
+            print(f"Started worker {index} (pid {process.pid})")
+            started = asyncio.get_running_loop().time()
+            code = await process.wait()
+            if self._stopping:
+                break
+            if asyncio.get_running_loop().time() - started > 60:
+                delay = 1.0  # It ran fine for a while, so this is not a crash loop
+            self.restarts += 1
+            print(f"Worker {index} exited with code {code}, restarting in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    async def stop(self, timeout: float = 30.0):
+        """Asks every worker to drain and exit, killing those that don't in time."""
+        self._stopping = True
+        running = [process for process in self.processes if process and process.returncode is None]
+        for process in running:
+            process.send_signal(signal.SIGTERM)
+        if running:
+            await asyncio.wait([asyncio.create_task(process.wait()) for process in running], timeout=timeout)
+            for process in running:
+                if process.returncode is None:
+                    print(f"Worker pid {process.pid} did not stop in time, killing it")
+                    process.kill()
+                    await process.wait()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,173 @@
+import datetime
+import json
+import os
+import re
+import time
+import uuid
+
+SNAPSHOT_VERSION = 1
+SCHEMA_FILE = "schema.json"
+
+# Column types in the snapshot. Categorical columns are stored as small integer
+# codes, with the category names listed in the schema.
+NUMERIC_COLUMNS = {
+    "chat_id": "<i8",
+    "weight": "<f4",
+    "height": "<f4",
+    "age": "<i2",
+    "calories": "<f4",  # NaN when no target was calculated
+}
+CATEGORY_COLUMNS = ("sex", "activity", "goal")
+
+# A column file: "<column>.<snapshot id>.npy"
+COLUMN_FILE_PATTERN = re.compile(r"(\w+)\.([0-9a-f]{12})\.npy")
+
+
+def _category_codes(values: list):
+    import numpy as np
+
+    categories, codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    dtype = np.uint8 if len(categories) <= 256 else np.uint16
+    return categories.tolist(), codes.astype(dtype)
+
+
+def write_snapshot(profile_store, directory: str, chunk_size: int = 100000) -> dict:
+    """Writes the latest profile of every user as one .npy file per column plus a schema.
+
+    Column files carry the snapshot id in their name and the schema is replaced
+    last, so readers always see one complete snapshot. Files of the previous
+    snapshot are removed afterwards; other files in the directory are left
+    alone. Returns the schema.
+    """
+    import numpy as np  # Only needed for analytics, not to run the bot
+
+    started = time.perf_counter()
+    columns = {name: [] for name in list(NUMERIC_COLUMNS) + list(CATEGORY_COLUMNS)}
+    for chunk in profile_store.iter_latest(chunk_size):
+        columns["chat_id"].append(np.array(
+            [int(row["chat_id"]) for row in chunk], dtype=NUMERIC_COLUMNS["chat_id"]
+        ))
+        for name in ("weight", "height", "age"):
+            columns[name].append(np.array([row[name] for row in chunk], dtype=NUMERIC_COLUMNS[name]))
+        columns["calories"].append(np.array(
+            [np.nan if row["calories"] is None else row["calories"] for row in chunk],
+            dtype=NUMERIC_COLUMNS["calories"],
+        ))
+        for name in CATEGORY_COLUMNS:
+            columns[name].extend(row[name] for row in chunk)
+
+    os.makedirs(directory, exist_ok=True)
+    snapshot_id = uuid.uuid4().hex[:12]
+    schema = {
+        "version": SNAPSHOT_VERSION,
+        "id": snapshot_id,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "rows": sum(len(part) for part in columns["chat_id"]),
+        "columns": {},
+    }
+    for name, parts in columns.items():
+        if name in CATEGORY_COLUMNS:
+            categories, array = _category_codes(parts) if parts else ([], np.zeros(0, dtype=np.uint8))
+        else:
+            categories, array = None, np.concatenate(parts) if parts else np.zeros(0, dtype=NUMERIC_COLUMNS[name])
+        file_name = f"{name}.{snapshot_id}.npy"
+        np.save(os.path.join(directory, file_name), array)
+        schema["columns"][name] = {"file": file_name, "dtype": array.dtype.str}
+        if categories is not None:
+            schema["columns"][name]["categories"] = categories
+    schema["seconds"] = round(time.perf_counter() - started, 3)
+
+    schema_path = os.path.join(directory, SCHEMA_FILE)
+    with open(schema_path + ".tmp", "w") as f:
+        json.dump(schema, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(schema_path + ".tmp", schema_path)
+
+    current = {column["file"] for column in schema["columns"].values()}
+    for file_name in os.listdir(directory):
+        match = COLUMN_FILE_PATTERN.fullmatch(file_name)
+        if match and match.group(1) in columns and file_name not in current:
+            os.remove(os.path.join(directory, file_name))
+    return schema
+
+
+class ProfileSnapshot:
+    """Read-only view of a snapshot written by `write_snapshot`.
+
+    Columns are memory-mapped, so opening is instant and aggregations only page
+    in the columns they touch.
+    """
+
+    def __init__(self, directory: str):
+        import numpy as np
+
+        with open(os.path.join(directory, SCHEMA_FILE)) as f:
+            self.schema = json.load(f)
+        if self.schema.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {self.schema.get('version')} in {directory}")
+        self.rows = self.schema["rows"]
+        self._columns = {}
+        for name, column in self.schema["columns"].items():
+            array = np.load(os.path.join(directory, column["file"]), mmap_mode="r")
+            if len(array) != self.rows or array.dtype.str != column["dtype"]:
+                raise ValueError(f"Column {name} in {directory} doesn't match the snapshot schema")
+            self._columns[name] = array
+
+    def column(self, name: str):
+        """The raw array of a column; category codes for categorical columns."""
+        return self._columns[name]
+
+    def categories(self, name: str) -> list:
+        return self.schema["columns"][name].get("categories", [])
+
+    def counts(self, name: str) -> dict:
+        """Number of users per category of a categorical column, most common first."""
+        import numpy as np
+
+        categories = self.categories(name)
+        counts = np.bincount(self._columns[name], minlength=len(categories))
+        return dict(sorted(zip(categories, counts.tolist()), key=lambda item: -item[1]))
+
+    def stats(self) -> dict:
+        """Aggregates over all users: averages, calorie spread and the category mixes."""
+        import numpy as np
+
+        calories = self._columns["calories"]
+        known = calories[~np.isnan(calories)]
+        stats = {
+            "users": self.rows,
+            "created_at": self.schema["created_at"],
+            "with_calorie_target": int(len(known)),
+        }
+        for name in ("age", "weight", "height"):
+            stats[f"average_{name}"] = float(self._columns[name].mean(dtype=np.float64)) if self.rows else 0.0
+        if len(known):
+            stats["average_calories"] = float(known.mean(dtype=np.float64))
+            stats["calories_p10"], stats["calories_median"], stats["calories_p90"] = (
+                float(value) for value in np.percentile(known, [10, 50, 90])
+            )
+        for name in CATEGORY_COLUMNS:
+            stats[name] = self.counts(name)
+        return stats
+
+
+def format_stats(stats: dict) -> str:
+    """Formats snapshot statistics for the CLI."""
+    lines = [
+        f"Profiles snapshot from {stats['created_at']}: {stats['users']} users, "
+        f"{stats['with_calorie_target']} with a calorie target",
+        f"Average age {stats['average_age']:.1f}, weight {stats['average_weight']:.1f} kg, "
+        f"height {stats['average_height']:.1f} cm",
+    ]
+    if "average_calories" in stats:
+        lines.append(
+            f"Calorie target: average {stats['average_calories']:.0f} kcal, "
+            f"10th percentile {stats['calories_p10']:.0f}, median {stats['calories_median']:.0f}, "
+            f"90th percentile {stats['calories_p90']:.0f}"
+        )
+    for name in CATEGORY_COLUMNS:
+        total = sum(stats[name].values()) or 1
+        mix = ", ".join(f"{category} {100 * count / total:.1f}%" for category, count in stats[name].items())
+        lines.append(f"{name.capitalize()}: {mix or '-'}")
+    return "\n".join(lines)
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import sqlite3
+import threading
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from menu_model import CompactMenu
+
+
+def shard_for(chat_id: int, shards: int) -> int:
+    """Returns the worker index that owns a chat. Stable across processes and restarts."""
+    return chat_id % shards
+
+
+def _encode(value):
+    if isinstance(value, CompactMenu):
+        return {"__compact_menu__": value.pack()}
+    raise TypeError(f"Cannot store {type(value).__name__} in the state store")
+
+
+def _decode(value: dict):
+    if "__compact_menu__" in value:
+        return CompactMenu.unpack(value["__compact_menu__"])
+    return value
+
+
+class SqliteStatePersistence(BasePersistence):
+    """Conversation state (`context.user_data`) kept in a SQLite database in WAL mode.
+
+    Several worker processes can share one database file. Each worker loads only
+    the users of its own shard, and since updates are routed to workers by chat
+    id, a user's state is only ever written by one worker. A restarted worker
+    picks up every conversation where it was left, at most `update_interval`
+    seconds behind. Menus are stored compressed.
+    """
+
+    def __init__(self, file_name: str, shard: int = 0, shards: int = 1, update_interval: float = 1.0):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.file_name = file_name
+        self.shard = shard
+        self.shards = shards
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(file_name, check_same_thread=False, timeout=30)
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+            )
+
+    def _load_user_data(self) -> dict:
+        with self._lock:
+            rows = self.conn.execute("SELECT user_id, data FROM user_state").fetchall()
+        user_data = {}
+        for user_id, data in rows:
+            if shard_for(user_id, self.shards) != self.shard:
+                continue
+            try:
+                user_data[user_id] = json.loads(data, object_hook=_decode)
+            except json.JSONDecodeError as e:
+                print(f"Skipping unreadable state for user {user_id}: {e}")
+        return user_data
+
+    def _save_user_data(self, user_id: int, data: str):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO user_state (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                (user_id, data),
+            )
+
+    def _delete_user_data(self, user_id: int):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+    async def get_user_data(self) -> dict:
+        return await asyncio.to_thread(self._load_user_data)
+
+    async def update_user_data(self, user_id: int, data: dict):
+        # Serialized right away: the live dict keeps changing while the write is pending
+        await asyncio.to_thread(self._save_user_data, user_id, json.dumps(data, default=_encode))
+
+    async def drop_user_data(self, user_id: int):
+        await asyncio.to_thread(self._delete_user_data, user_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass  # Only this worker writes its shard, so memory is always current
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object):
+        pass
+
+    async def flush(self):
+        with self._lock:
+            self.conn.close()
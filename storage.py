@@ -0,0 +1,809 @@
+import asyncio
+import contextlib
+import csv
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+from metrics import STORE_SECONDS
+
+# Fields that must be present for a stored profile to be usable
+REQUIRED_PROFILE_FIELDS = ['weight', 'height', 'age', 'sex', 'activity', 'goal']
+
+
+def parse_profile_row(row: dict):
+    """Converts a raw profile row to typed values. Returns None for incomplete or corrupt rows."""
+    if not all(key in row for key in REQUIRED_PROFILE_FIELDS):
+        return None
+    try:
+        row['weight'] = float(row['weight'])
+        row['height'] = float(row['height'])
+        row['age'] = int(row['age'])
+        row['calories'] = float(row['calories']) if row['calories'] else None
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Skipping incomplete or corrupt row for chat_id {row.get('chat_id')}: {e}")
+        return None
+    return row
+
+
+class CsvProfileStore:
+    """Append-only CSV profile log with an in-memory chat_id -> row offset index.
+
+    The index is rebuilt with a single pass over the file at startup, after which
+    every lookup is one seek and one line read regardless of the file size. If
+    another process replaces the file (such as `python main.py compact`), the
+    index is rebuilt on the next access.
+    """
+
+    def __init__(self, file_name: str, headers: list):
+        self.file_name = file_name
+        self.headers = headers
+        self._file_headers = headers
+        self._offsets = {}
+        self._file_id = None  # inode of the file the index was built from
+        self._lock = threading.Lock()
+        self._initialize()
+        self.rebuild_index()
+
+    def _initialize(self):
+        """Creates the CSV file with headers if it doesn't exist."""
+        if not os.path.exists(self.file_name):
+            with open(self.file_name, "w", newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(self.headers)
+            print(f"Created new CSV file: {self.file_name}")
+
+    @staticmethod
+    def _split_line(line: bytes):
+        """Splits one raw CSV line into its values, or returns None if it can't be decoded."""
+        try:
+            text = line.decode("utf-8")
+            if '"' not in text:
+                # Fast path: without quotes a CSV line is a plain comma-separated list
+                return text.rstrip("\r\n").split(",")
+            return next(csv.reader([text]))
+        except (StopIteration, UnicodeDecodeError, csv.Error):
+            return None
+
+    @staticmethod
+    def _join_values(values: list) -> bytes:
+        """Serializes values into one CSV line, like csv.writer does."""
+        text_values = ["" if value is None else str(value) for value in values]
+        if any(char in value for value in text_values for char in ',"\r\n'):
+            buffer = io.StringIO()
+            csv.writer(buffer).writerow(text_values)
+            return buffer.getvalue().encode("utf-8")
+        return (",".join(text_values) + "\r\n").encode("utf-8")
+
+    def _parse_line(self, line: bytes):
+        """Parses one raw CSV line into a typed profile dict."""
+        values = self._split_line(line)
+        if values is None:
+            return None
+        row = dict(zip(self._file_headers, values))
+        try:
+            int(row["chat_id"])
+        except (ValueError, KeyError):
+            return None
+        return parse_profile_row(row)
+
+    def _encode_row(self, user_data: dict) -> bytes:
+        """Serializes a profile into one CSV line in file column order."""
+        return self._join_values([user_data.get(header) for header in self._file_headers])
+
+    def _valid_chat_id(self, values: list, positions: dict):
+        """Returns the chat_id of a row that `_parse_line` would accept, else None, without building a dict."""
+        if values is None or positions is None or len(values) < positions["width"]:
+            return None
+        try:
+            chat_id = int(values[positions["chat_id"]])
+        except ValueError:
+            return None
+        try:
+            float(values[positions["weight"]])
+            float(values[positions["height"]])
+            int(values[positions["age"]])
+            if values[positions["calories"]]:
+                float(values[positions["calories"]])
+        except ValueError as e:
+            print(f"Skipping incomplete or corrupt row for chat_id {chat_id}: {e}")
+            return None
+        return chat_id
+
+    def _column_positions(self):
+        """Maps the columns a valid row needs to their index in the file, or None if any is missing."""
+        required = ["chat_id", "calories"] + REQUIRED_PROFILE_FIELDS
+        if not all(column in self._file_headers for column in required):
+            return None
+        # zip() in _parse_line drops columns beyond a short row, so every needed column must be present
+        positions = {column: self._file_headers.index(column) for column in required}
+        positions["width"] = max(positions.values()) + 1
+        return positions
+
+    def _scan_offsets(self, csvfile, start: int = 0, offsets: dict = None) -> dict:
+        """Reads an open file from `start` and maps each chat to its latest valid row offset."""
+        offsets = {} if offsets is None else offsets
+        csvfile.seek(0)
+        header_line = csvfile.readline()
+        if header_line:
+            self._file_headers = next(csv.reader([header_line.decode("utf-8")]))
+        positions = self._column_positions()
+        offset = max(start, len(header_line))
+        csvfile.seek(offset)
+        for line in csvfile:
+            chat_id = self._valid_chat_id(self._split_line(line), positions)
+            if chat_id is not None:
+                offsets[chat_id] = offset
+            offset += len(line)
+        return offsets
+
+    def rebuild_index(self):
+        """Scans the whole file once and records the offset of each chat's latest valid row."""
+        with self._lock:
+            with open(self.file_name, "rb") as csvfile:
+                self._offsets = self._scan_offsets(csvfile)
+                self._file_id = os.fstat(csvfile.fileno()).st_ino
+
+    def _refresh_if_replaced(self, csvfile=None):
+        """Rebuilds the index if the file was replaced behind our back. Called with the lock held.
+
+        `csvfile` is an open read handle of the file, used instead of opening it again.
+        """
+        if csvfile is None:
+            with open(self.file_name, "rb") as csvfile:
+                self._refresh_if_replaced(csvfile)
+            return
+        file_id = os.fstat(csvfile.fileno()).st_ino
+        if file_id != self._file_id:
+            print(f"{self.file_name} was replaced by another process, rebuilding its index")
+            self._offsets = self._scan_offsets(csvfile)
+            self._file_id = file_id
+
+    def compact(self, keep_history: int = 0) -> dict:
+        """Rewrites the file so each chat keeps only its latest valid row plus `keep_history` older ones.
+
+        The bulk of the work happens without holding the lock; rows appended in the
+        meantime are copied over before the new file atomically replaces the old one.
+        Only rows appended through this store are seen, so another process must not
+        write to the file meanwhile.
+        """
+        with self._lock:
+            self._refresh_if_replaced()
+            end = os.path.getsize(self.file_name)
+
+        started = time.perf_counter()
+        with open(self.file_name, "rb") as csvfile:
+            header_line = csvfile.readline()
+            entries = []
+            while csvfile.tell() < end:
+                line = csvfile.readline()
+                row = self._parse_line(line)
+                if row is not None:
+                    entries.append((int(row["chat_id"]), line))
+        read_seconds_before = time.perf_counter() - started
+
+        kept_per_chat = {}
+        keep = [False] * len(entries)
+        for position in range(len(entries) - 1, -1, -1):
+            chat_id = entries[position][0]
+            kept = kept_per_chat.get(chat_id, 0)
+            if kept <= keep_history:
+                keep[position] = True
+                kept_per_chat[chat_id] = kept + 1
+
+        # The index of the new file is built here too, so the lock is only held to copy the tail
+        offsets = {}
+        offset = len(header_line)
+        directory = os.path.dirname(os.path.abspath(self.file_name))
+        with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as tmpfile:
+            tmpfile.write(header_line)
+            for (chat_id, line), kept in zip(entries, keep):
+                if kept:
+                    tmpfile.write(line)
+                    offsets[chat_id] = offset
+                    offset += len(line)
+
+        with self._lock:
+            with open(self.file_name, "rb") as csvfile:
+                csvfile.seek(end)
+                tail = csvfile.read()
+            with open(tmpfile.name, "ab") as compacted:
+                compacted.write(tail)
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            os.replace(tmpfile.name, self.file_name)
+            with open(self.file_name, "rb") as csvfile:
+                if tail:
+                    self._scan_offsets(csvfile, start=offset, offsets=offsets)
+                self._file_id = os.fstat(csvfile.fileno()).st_ino
+            self._offsets = offsets
+
+        started = time.perf_counter()
+        with open(self.file_name, "rb") as csvfile:
+            csvfile.readline()
+            for line in csvfile:
+                self._parse_line(line)
+        read_seconds_after = time.perf_counter() - started
+
+        return {
+            "rows_before": len(entries),
+            "rows_after": sum(keep),
+            "bytes_before": end,
+            "bytes_after": os.path.getsize(self.file_name) - len(tail),
+            "read_seconds_before": read_seconds_before,
+            "read_seconds_after": read_seconds_after,
+        }
+
+    def recalculate_calories(self, compute, chunk_size: int = 100000) -> dict:
+        """Rewrites the calories of every chat's latest row with `compute`, streaming the file in chunks.
+
+        `compute(sex, weight, height, age, activity)` gets the columns of a chunk as
+        lists and returns the new calorie values. Like `compact`, the file is
+        rewritten without holding the lock, and rows appended meanwhile are kept.
+        """
+        with self._lock:
+            self._refresh_if_replaced()
+            end = os.path.getsize(self.file_name)
+            latest = set(self._offsets.values())
+
+        started = time.perf_counter()
+        stats = {"rows_updated": 0, "rows_changed": 0}
+        position = {header: index for index, header in enumerate(self._file_headers)}
+        calories_position = position["calories"]
+
+        def rewrite_chunk(lines: list, selected: list):
+            if not selected:
+                return
+            rows = [self._split_line(lines[index]) for index in selected]
+            calories = compute(*(
+                [row[position[field]] for row in rows]
+                for field in ("sex", "weight", "height", "age", "activity")
+            ))
+            for index, row, value in zip(selected, rows, calories):
+                value = str(int(value))
+                if row[calories_position] != value:
+                    stats["rows_changed"] += 1
+                    row[calories_position] = value
+                    lines[index] = self._join_values(row)
+            stats["rows_updated"] += len(rows)
+
+        directory = os.path.dirname(os.path.abspath(self.file_name))
+        with open(self.file_name, "rb") as csvfile, \
+                tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as tmpfile:
+            header_line = csvfile.readline()
+            tmpfile.write(header_line)
+            offset = len(header_line)
+            new_offset = len(header_line)
+            moved = {}  # old offset of each latest row -> its offset in the rewritten file
+
+            def write_chunk(lines: list, selected: list, old_offsets: list):
+                nonlocal new_offset
+                rewrite_chunk(lines, selected)
+                selected_positions = dict(zip(selected, old_offsets))
+                for index, line in enumerate(lines):
+                    if index in selected_positions:
+                        moved[selected_positions[index]] = new_offset
+                    new_offset += len(line)
+                tmpfile.writelines(lines)
+
+            lines, selected, old_offsets = [], [], []
+            for line in csvfile:
+                if offset >= end:
+                    break
+                if offset in latest:
+                    selected.append(len(lines))
+                    old_offsets.append(offset)
+                lines.append(line)
+                offset += len(line)
+                if len(lines) >= chunk_size:
+                    write_chunk(lines, selected, old_offsets)
+                    lines, selected, old_offsets = [], [], []
+            write_chunk(lines, selected, old_offsets)
+
+        with self._lock:
+            with open(self.file_name, "rb") as csvfile:
+                csvfile.seek(end)
+                tail = csvfile.read()
+            with open(tmpfile.name, "ab") as rewritten:
+                rewritten.write(tail)
+                rewritten.flush()
+                os.fsync(rewritten.fileno())
+            os.replace(tmpfile.name, self.file_name)
+            self._file_id = os.stat(self.file_name).st_ino
+            # Latest rows moved with the rewrite, rows appended meanwhile by the length difference
+            shift = new_offset - end
+            self._offsets = {
+                chat_id: offset + shift if offset >= end else moved[offset]
+                for chat_id, offset in self._offsets.items()
+                if offset >= end or offset in moved
+            }
+
+        stats["seconds"] = time.perf_counter() - started
+        return stats
+
+    def iter_latest(self, chunk_size: int = 100000):
+        """Yields the latest valid profile of every chat in file order, in lists of up to `chunk_size`."""
+        with self._lock:
+            self._refresh_if_replaced()
+            end = os.path.getsize(self.file_name)
+            latest = set(self._offsets.values())
+        # A compaction replacing the file meanwhile doesn't affect the open handle
+        with open(self.file_name, "rb") as csvfile:
+            offset = len(csvfile.readline())
+            chunk = []
+            for line in csvfile:
+                if offset >= end:
+                    break
+                if offset in latest:
+                    row = self._parse_line(line)
+                    if row is not None:
+                        chunk.append(row)
+                    if len(chunk) >= chunk_size:
+                        yield chunk
+                        chunk = []
+                offset += len(line)
+            if chunk:
+                yield chunk
+
+    def store(self, user_data: dict):
+        """Appends a profile row and points the index at it."""
+        self.store_many([user_data])
+
+    def store_many(self, rows: list):
+        """Appends several profile rows with a single file open and updates the index."""
+        lines = [self._encode_row(user_data) for user_data in rows]
+        with self._lock:
+            self._refresh_if_replaced()
+            with open(self.file_name, "ab") as csvfile:
+                offset = csvfile.tell()
+                csvfile.write(b"".join(lines))
+            for user_data, line in zip(rows, lines):
+                if self._parse_line(line) is not None:
+                    self._offsets[int(user_data["chat_id"])] = offset
+                offset += len(line)
+
+    def get_latest(self, chat_id: int):
+        """Returns the latest valid profile for a chat, or None."""
+        with self._lock:
+            with open(self.file_name, "rb") as csvfile:
+                self._refresh_if_replaced(csvfile)
+                row = self._read_indexed_row(csvfile, chat_id)
+                if row is None and chat_id in self._offsets:
+                    # The index doesn't match the file: rebuild it rather than return another chat's row
+                    print(f"Index of {self.file_name} is stale at chat_id {chat_id}, rebuilding it")
+                    self._offsets = self._scan_offsets(csvfile)
+                    row = self._read_indexed_row(csvfile, chat_id)
+        return row
+
+    def _read_indexed_row(self, csvfile, chat_id: int):
+        """Parses the row the index points at for a chat, or returns None if it isn't that chat's valid row."""
+        offset = self._offsets.get(chat_id)
+        if offset is None:
+            return None
+        csvfile.seek(offset)
+        row = self._parse_line(csvfile.readline())
+        if row is None or int(row["chat_id"]) != chat_id:
+            return None
+        return row
+
+    def close(self):
+        """Nothing to release; files are opened per operation."""
+        pass
+
+
+class SqliteProfileStore:
+    """Profile history kept in SQLite with an index on (chat_id, id)."""
+
+    def __init__(self, file_name: str, headers: list):
+        self.file_name = file_name
+        self.headers = headers
+        self._lock = threading.Lock()
+        # WAL lets several worker processes read while one of them writes
+        self.conn = sqlite3.connect(file_name, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        columns = ", ".join(
+            "chat_id INTEGER NOT NULL" if header == "chat_id" else f'"{header}" TEXT'
+            for header in headers
+        )
+        with self.conn:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS profiles (id INTEGER PRIMARY KEY AUTOINCREMENT, {columns})"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_profiles_chat_id ON profiles (chat_id, id)"
+            )
+
+    def is_empty(self) -> bool:
+        """Returns True if no profile has been stored yet."""
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM profiles LIMIT 1").fetchone() is None
+
+    def import_csv(self, csv_file_name: str) -> int:
+        """Copies every row of a legacy CSV profile file into the database."""
+        if not os.path.exists(csv_file_name):
+            return 0
+        with open(csv_file_name, "r", newline='') as csvfile:
+            rows = [
+                row for row in csv.DictReader(csvfile)
+                if row.get("chat_id", "").lstrip("-").isdigit()
+            ]
+        self._insert_many(rows)
+        return len(rows)
+
+    def _insert_many(self, rows: list):
+        placeholders = ", ".join("?" for _ in self.headers)
+        quoted = ", ".join(f'"{header}"' for header in self.headers)
+        with self._lock, self.conn:
+            self.conn.executemany(
+                f"INSERT INTO profiles ({quoted}) VALUES ({placeholders})",
+                [[row.get(header) for header in self.headers] for row in rows],
+            )
+
+    def store(self, user_data: dict):
+        """Inserts a profile row."""
+        self._insert_many([user_data])
+
+    def store_many(self, rows: list):
+        """Inserts several profile rows in one transaction."""
+        self._insert_many(rows)
+
+    def get_latest(self, chat_id: int):
+        """Returns the latest valid profile for a chat, or None."""
+        quoted = ", ".join(f'"{header}"' for header in self.headers)
+        with self._lock:
+            cursor = self.conn.execute(
+                f"SELECT {quoted} FROM profiles WHERE chat_id = ? ORDER BY id DESC",
+                (chat_id,),
+            )
+            for values in cursor:
+                row = parse_profile_row(dict(zip(self.headers, values)))
+                if row is not None:
+                    cursor.close()
+                    return row
+        return None
+
+    def iter_latest(self, chunk_size: int = 100000):
+        """Yields the latest valid profile of every chat, by chat id, in lists of up to `chunk_size`."""
+        chunk = []
+        for _, row, kept in self._scan_by_chat(1):
+            if kept:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def recalculate_calories(self, compute, chunk_size: int = 100000) -> dict:
+        """Rewrites the calories of every chat's latest row with `compute`, one chunk per transaction.
+
+        `compute(sex, weight, height, age, activity)` gets the columns of a chunk as
+        lists and returns the new calorie values.
+        """
+        started = time.perf_counter()
+        rows_updated = rows_changed = 0
+        fields = ("id", "sex", "weight", "height", "age", "activity", "goal", "calories")
+        # Each chat's latest valid row, which is what get_latest serves
+        latest = [(row_id,) for row_id, _, kept in self._scan_by_chat(1) if kept]
+        with self._lock, self.conn:
+            self.conn.execute("DROP TABLE IF EXISTS temp.latest_profiles")
+            self.conn.execute(
+                "CREATE TEMP TABLE latest_profiles (id INTEGER PRIMARY KEY)"
+            )
+            self.conn.executemany("INSERT INTO latest_profiles VALUES (?)", latest)
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT p.id, p.sex, p.weight, p.height, p.age, p.activity, p.goal, p.calories"
+                    " FROM latest_profiles l JOIN profiles p ON p.id = l.id"
+                    " WHERE l.id > ? ORDER BY l.id LIMIT ?",
+                    (last_id, chunk_size),
+                ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            valid = []
+            for values in rows:
+                row = parse_profile_row(dict(zip(fields, values)))
+                if row is not None:
+                    valid.append((row, values[-1]))
+            if not valid:
+                continue
+            calories = compute(*(
+                [row[field] for row, _ in valid] for field in ("sex", "weight", "height", "age", "activity")
+            ))
+            updates = [(str(int(value)), row["id"]) for (row, _), value in zip(valid, calories)]
+            # Only rows whose target changed are written
+            changed = [update for (_, old), update in zip(valid, updates) if old != update[0]]
+            if changed:
+                with self._lock, self.conn:
+                    self.conn.executemany("UPDATE profiles SET calories = ? WHERE id = ?", changed)
+            rows_changed += len(changed)
+            rows_updated += len(updates)
+        with self._lock:
+            self.conn.execute("DROP TABLE IF EXISTS temp.latest_profiles")
+        return {"rows_updated": rows_updated, "rows_changed": rows_changed,
+                "seconds": time.perf_counter() - started}
+
+    def _scan_by_chat(self, per_chat: int, max_id: int = None, chunk_size: int = 10000):
+        """Walks the rows chat by chat, newest first, yielding (id, parsed row or None, kept).
+
+        `kept` marks each chat's newest `per_chat` valid rows: the rows `get_latest`
+        and the CSV index consider, so both backends agree on them. The lock is
+        only held while fetching each chunk.
+        """
+        quoted = ", ".join(f'"{header}"' for header in self.headers)
+        where = "" if max_id is None else f" WHERE id <= {int(max_id)}"
+        with self._lock:
+            cursor = self.conn.execute(f"SELECT id, {quoted} FROM profiles{where} ORDER BY chat_id, id DESC")
+        current_chat, kept = None, 0
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row_id, *values in rows:
+                    row = dict(zip(self.headers, values))
+                    if row["chat_id"] != current_chat:
+                        current_chat, kept = row["chat_id"], 0
+                    row = parse_profile_row(row)
+                    keep = row is not None and kept < per_chat
+                    kept += keep
+                    yield row_id, row, keep
+        finally:
+            cursor.close()
+
+    def _count_rows(self) -> tuple:
+        """Reads every row on a separate connection. Returns (rows, seconds)."""
+        started = time.perf_counter()
+        with contextlib.closing(sqlite3.connect(self.file_name, timeout=30)) as conn:
+            rows = len(conn.execute("SELECT * FROM profiles").fetchall())
+        return rows, time.perf_counter() - started
+
+    def compact(self, keep_history: int = 0, batch_size: int = 1000) -> dict:
+        """Deletes all but each chat's latest `keep_history + 1` valid rows and vacuums the database.
+
+        Invalid rows are deleted too, like the CSV backend does. Rows are deleted
+        in small transactions and the vacuum runs on its own connection, so
+        lookups only ever wait for one batch.
+        """
+        bytes_before = os.path.getsize(self.file_name)
+        rows_before, read_seconds_before = self._count_rows()
+
+        with self._lock:
+            max_id = self.conn.execute("SELECT MAX(id) FROM profiles").fetchone()[0] or 0
+        # Rows stored after this point are newer than anything scanned, so they are never deleted
+        doomed = [row_id for row_id, _, kept in self._scan_by_chat(keep_history + 1, max_id) if not kept]
+        for start in range(0, len(doomed), batch_size):
+            batch = doomed[start:start + batch_size]
+            with self._lock, self.conn:
+                self.conn.execute(
+                    f"DELETE FROM profiles WHERE id IN ({', '.join('?' for _ in batch)})", batch
+                )
+        with contextlib.closing(sqlite3.connect(self.file_name, timeout=30)) as conn:
+            conn.execute("VACUUM")
+
+        rows_after, read_seconds_after = self._count_rows()
+        return {
+            "rows_before": rows_before,
+            "rows_after": rows_after,
+            "bytes_before": bytes_before,
+            "bytes_after": os.path.getsize(self.file_name),
+            "read_seconds_before": read_seconds_before,
+            "read_seconds_after": read_seconds_after,
+        }
+
+    def close(self):
+        """Closes the database connection."""
+        self.conn.close()
+
+
+class SqliteMenuStore:
+    """Generated menus per chat in SQLite, each with the profile it was built from.
+
+    Every saved menu gets a generation id. Menus are stored as compressed JSON,
+    and only the latest `keep_per_chat` menus of a chat are kept.
+    """
+
+    def __init__(self, file_name: str, keep_per_chat: int = 5):
+        self.file_name = file_name
+        self.keep_per_chat = keep_per_chat
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(file_name, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS menus ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " chat_id INTEGER NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " cache_key TEXT,"
+                " profile TEXT NOT NULL,"
+                " menu BLOB NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_menus_chat_id ON menus (chat_id, id)")
+
+    @staticmethod
+    def _encode_menu(menu: list) -> bytes:
+        return zlib.compress(json.dumps(menu, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    @staticmethod
+    def _row_to_record(row):
+        if row is None:
+            return None
+        generation_id, chat_id, created_at, cache_key, profile, menu = row
+        return {
+            "generation_id": generation_id,
+            "chat_id": chat_id,
+            "created_at": created_at,
+            "cache_key": cache_key,
+            "profile": json.loads(profile),
+            "menu": json.loads(zlib.decompress(menu).decode("utf-8")),
+        }
+
+    def save(self, chat_id: int, profile: dict, menu: list, cache_key: str = None) -> int:
+        """Stores a menu for a chat and returns its generation id."""
+        with self._lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO menus (chat_id, created_at, cache_key, profile, menu) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, time.time(), cache_key, json.dumps(profile), self._encode_menu(menu)),
+            )
+            self.conn.execute(
+                "DELETE FROM menus WHERE chat_id = ? AND id NOT IN ("
+                " SELECT id FROM menus WHERE chat_id = ? ORDER BY id DESC LIMIT ?)",
+                (chat_id, chat_id, self.keep_per_chat),
+            )
+            return cursor.lastrowid
+
+    def update(self, generation_id: int, menu: list):
+        """Replaces the days of a stored menu, e.g. after one of them was regenerated."""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE menus SET menu = ? WHERE id = ?", (self._encode_menu(menu), generation_id)
+            )
+
+    def get(self, chat_id: int, generation_id: int = None):
+        """Returns a chat's menu by generation id, or its latest one, or None."""
+        columns = "id, chat_id, created_at, cache_key, profile, menu"
+        with self._lock:
+            if generation_id is None:
+                row = self.conn.execute(
+                    f"SELECT {columns} FROM menus WHERE chat_id = ? ORDER BY id DESC LIMIT 1", (chat_id,)
+                ).fetchone()
+            else:
+                row = self.conn.execute(
+                    f"SELECT {columns} FROM menus WHERE chat_id = ? AND id = ?", (chat_id, generation_id)
+                ).fetchone()
+        return self._row_to_record(row)
+
+    def close(self):
+        """Closes the database connection."""
+        self.conn.close()
+
+class WriteBehindProfileStore:
+    """Queues profile writes in memory and flushes them to another store in batches.
+
+    Writes never touch the disk on the event loop: a background task hands each
+    batch to a worker thread once `batch_size` rows are queued or every
+    `flush_interval` seconds. Reads check the queued rows first, so a chat always
+    sees its own latest profile even before it has been flushed.
+    """
+
+    def __init__(self, backend, batch_size: int = 50, flush_interval: float = 1.0):
+        self.backend = backend
+        self.headers = backend.headers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = []
+        self._pending = {}
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+
+    def start(self):
+        """Starts the background flush task on the running event loop."""
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stops the background task after flushing everything still queued."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    def store(self, user_data: dict):
+        """Queues a profile row. Writes through directly if the flush task isn't running."""
+        if self._task is None:
+            self.backend.store(user_data)
+            return
+        row = dict(user_data)
+        self._queue.append(row)
+        self._pending[int(row["chat_id"])] = row
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def queue_length(self) -> int:
+        """Returns the number of rows waiting to be flushed."""
+        return len(self._queue)
+
+    def get_latest(self, chat_id: int):
+        """Returns the latest profile for a chat, preferring rows not yet flushed."""
+        row = self._pending.get(chat_id)
+        if row is not None:
+            return parse_profile_row({header: row.get(header) for header in self.headers})
+        return self.backend.get_latest(chat_id)
+
+    async def flush(self):
+        """Writes all queued rows to the backend in a worker thread."""
+        if not self._queue:
+            return
+        batch, self._queue = self._queue, []
+        try:
+            with STORE_SECONDS.time(operation="flush"):
+                await asyncio.to_thread(self.backend.store_many, batch)
+        except Exception as e:
+            print(f"Error flushing {len(batch)} profile rows: {e}")
+            self._queue = batch + self._queue
+            return
+        for row in batch:
+            chat_id = int(row["chat_id"])
+            if self._pending.get(chat_id) is row:
+                del self._pending[chat_id]
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if self._stopping:
+                if self._queue:
+                    # The last flush failed; write through synchronously rather than lose rows
+                    self.backend.store_many(self._queue)
+                    self._queue = []
+                return
+
+    def close(self):
+        """Closes the underlying store."""
+        self.backend.close()
+
+
+def format_compaction_report(stats: dict) -> str:
+    """Formats the result of a compaction for logs and the CLI."""
+    saved_bytes = stats["bytes_before"] - stats["bytes_after"]
+    saved_seconds = stats["read_seconds_before"] - stats["read_seconds_after"]
+    percent = 100 * saved_bytes / stats["bytes_before"] if stats["bytes_before"] else 0
+    return (
+        f"Compacted profile store: {stats['rows_before']} -> {stats['rows_after']} rows, "
+        f"{stats['bytes_before']} -> {stats['bytes_after']} bytes "
+        f"(saved {saved_bytes} bytes, {percent:.1f}%), "
+        f"full read {stats['read_seconds_before'] * 1000:.1f} ms -> "
+        f"{stats['read_seconds_after'] * 1000:.1f} ms (saved {saved_seconds * 1000:.1f} ms)"
+    )
+
+
+def open_profile_store(backend: str, csv_file_name: str, sqlite_file_name: str, headers: list):
+    """Creates the profile store selected by configuration ("csv" or "sqlite")."""
+    if backend == "sqlite":
+        store = SqliteProfileStore(sqlite_file_name, headers)
+        if store.is_empty():
+            imported = store.import_csv(csv_file_name)
+            if imported:
+                print(f"Imported {imported} rows from {csv_file_name} into {sqlite_file_name}")
+        return store
+    if backend != "csv":
+        print(f"Warning: unknown PROFILE_STORE_BACKEND '{backend}', falling back to csv.")
+    return CsvProfileStore(csv_file_name, headers)
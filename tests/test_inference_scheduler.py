@@ -0,0 +1,63 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference import InferenceScheduler  # noqa: E402
+
+
+class CancelQueuedWaiterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cancel_while_slot_is_released(self):
+        scheduler = InferenceScheduler(max_concurrency=1)
+        release_first = asyncio.Event()
+
+        async def held():
+            await release_first.wait()
+            return "first"
+
+        async def quick(result):
+            return result
+
+        first = asyncio.create_task(scheduler.submit(1, held))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(scheduler.submit(2, lambda: quick("cancelled")))
+        last = asyncio.create_task(scheduler.submit(3, lambda: quick("last")))
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.stats()["queued"], 2)
+
+        # The slot is released and the queued waiter cancelled in the same tick
+        release_first.set()
+        cancelled.cancel()
+
+        self.assertEqual(await first, "first")
+        with self.assertRaises(asyncio.CancelledError):
+            await cancelled
+        self.assertEqual(await asyncio.wait_for(last, 1), "last")
+        stats = scheduler.stats()
+        self.assertEqual((stats["running"], stats["queued"], stats["waiting_chats"]), (0, 0, 0))
+
+    async def test_cancel_queued_waiter(self):
+        scheduler = InferenceScheduler(max_concurrency=1)
+        release_first = asyncio.Event()
+
+        async def held():
+            await release_first.wait()
+
+        first = asyncio.create_task(scheduler.submit(1, held))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(scheduler.submit(1, held))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(scheduler.stats()["queued"], 0)
+
+        release_first.set()
+        await first
+        self.assertEqual(scheduler.stats()["running"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different chats concurrently, but one at a time per chat.
+
+    Up to `max_concurrent_updates` updates are handled at once. Updates from the
+    same chat wait for each other in arrival order, so the conversation state in
+    `context.user_data` never sees two blocking handlers at once. The per-chat
+    lock is taken before a global slot, so a chat with a backlog waits without
+    holding slots other chats could use.
+
+    Handlers registered with `block=False` (menu generation and menu edits)
+    are only started under the lock: they keep running after it is released,
+    alongside the chat's later updates. They must guard their own state, as
+    the menu handlers do with `generating_chats` and the `menu_generating` flag.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = {}
+
+    @staticmethod
+    def _ordering_key(update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def process_update(self, update: object, coroutine):
+        key = self._ordering_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[key]
+
+    async def do_process_update(self, update: object, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def waiting_chats(self) -> int:
+        """Returns the number of chats with an update being processed or waiting."""
+        return len(self._chat_locks)
@@ -0,0 +1,145 @@
+import asyncio
+import hmac
+import json
+
+from telegram import Update
+from telegram.ext import Application
+
+# Telegram sends updates well below this size; anything larger is rejected
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class WebhookServer:
+    """Minimal asyncio HTTP server that receives Telegram webhook updates.
+
+    POST requests to `path` must carry the configured secret in the
+    X-Telegram-Bot-Api-Secret-Token header; their JSON body is decoded into an
+    Update and put on the application's update queue. GET /health reports
+    readiness and the queue depth. On stop the listener closes first, then
+    in-flight requests are allowed to finish, so no accepted update is lost.
+    """
+
+    def __init__(self, application: Application, host: str, port: int, path: str, secret_token: str):
+        self.application = application
+        self.host = host
+        self.port = port
+        self.path = "/" + path.strip("/")
+        self.secret_token = secret_token
+        self.received = 0
+        self.rejected = 0
+        self._server = None
+        self._connections = set()
+        self._busy = set()
+        self._draining = False
+
+    async def start(self):
+        """Starts listening for webhook requests."""
+        self._draining = False
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        if not self.port:
+            self.port = self._server.sockets[0].getsockname()[1]
+        print(f"Webhook server listening on http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self, timeout: float = 10.0):
+        """Stops accepting requests and waits for in-flight ones to finish."""
+        self._draining = True
+        if self._server is not None:
+            self._server.close()
+        # Idle keep-alive connections can go right away; busy ones finish their request first
+        for task in self._connections - self._busy:
+            task.cancel()
+        if self._busy:
+            await asyncio.wait(list(self._busy), timeout=timeout)
+        for task in list(self._connections):
+            task.cancel()
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while not self._draining:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                self._busy.add(task)
+                try:
+                    method, path, headers, body = request
+                    status, payload = await self._route(method, path, headers, body)
+                    keep_alive = headers.get("connection", "").lower() != "close" and not self._draining
+                    self._write_response(writer, status, payload, keep_alive)
+                    await writer.drain()
+                finally:
+                    self._busy.discard(task)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", "0"))
+        if length > MAX_BODY_BYTES:
+            raise ValueError("request body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method, path.split("?")[0], headers, body
+
+    async def _route(self, method: str, path: str, headers: dict, body: bytes):
+        if path == "/health" and method == "GET":
+            status = "503 Service Unavailable" if self._draining else "200 OK"
+            return status, {
+                "status": "draining" if self._draining else "ok",
+                "pending_updates": self.pending_updates(),
+                "received": self.received,
+            }
+        if path != self.path:
+            return "404 Not Found", {"ok": False}
+        if method != "POST":
+            return "405 Method Not Allowed", {"ok": False}
+
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode("utf-8"), self.secret_token.encode("utf-8")):
+            self.rejected += 1
+            return "403 Forbidden", {"ok": False}
+
+        try:
+            await self.dispatch(json.loads(body))
+        except (ValueError, TypeError, KeyError) as e:
+            print(f"Rejected malformed webhook update: {e}")
+            return "400 Bad Request", {"ok": False}
+        self.received += 1
+        return "200 OK", {"ok": True}
+
+    async def dispatch(self, data: dict):
+        """Hands a decoded update over for processing."""
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
+    def pending_updates(self) -> int:
+        """Returns the number of received updates not yet processed."""
+        return self.application.update_queue.qsize()
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: str, payload: dict, keep_alive: bool):
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("ascii") + body
+        )